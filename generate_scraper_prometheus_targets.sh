@@ -11,14 +11,16 @@ for project in mlab-sandbox mlab-staging mlab-oti ; do
   mkdir -p ${BASEDIR}/gen/${project}/prometheus/{legacy-targets,blackbox-targets,blackbox-targets-ipv6,snmp-targets,script-targets}
 done
 
+# Per-project files of selected hostname patterns, in the plsync directory.
+
 # All testing sites and machines.
-SELECT_mlab_sandbox=$( cat ${SCRIPTDIR}/plsync/testing_patterns.txt | xargs | sed -e 's/ /|/g' )
+SELECT_FILE_mlab_sandbox=testing_patterns.txt
 
 # All mlab4's and the set of canary machines.
-SELECT_mlab_staging=$( cat ${SCRIPTDIR}/plsync/staging_patterns.txt | xargs | sed -e 's/ /|/g' )
+SELECT_FILE_mlab_staging=staging_patterns.txt
 
 # All sites *excluding* test sites.
-SELECT_mlab_oti=$( cat ${SCRIPTDIR}/plsync/production_patterns.txt | xargs | sed -e 's/ /|/g' )
+SELECT_FILE_mlab_oti=production_patterns.txt
 
 # GCP doesn't support IPv6, so we have a Linode VM running three instances of
 # the blackbox_exporter, on three separate ports... one port/instance for each
@@ -28,47 +30,63 @@ BBE_IPV6_PORT_mlab_oti="9115"
 BBE_IPV6_PORT_mlab_staging="8115"
 BBE_IPV6_PORT_mlab_sandbox="7115"
 
+# Every output of every project is listed in one manifest, so that the sites
+# and slices configuration is only loaded once.
+MANIFEST=$( mktemp )
+trap "rm -f ${MANIFEST}" EXIT
 
+sep=""
+echo "[" > ${MANIFEST}
 for project in mlab-sandbox mlab-staging mlab-oti ; do
-  pushd ${SCRIPTDIR}/plsync
-    output=${BASEDIR}/gen/${project}/prometheus
-
-    # Construct the per-project SELECT variable name to use below.
-    pattern=SELECT_${project/-/_}
-
-    # Construct the per-project blackbox_exporter port variable to use below.
-    # blackbox_exporter on for IPv6 targets.
-    bbe_port=BBE_IPV6_PORT_${project/-/_}
+  output=${BASEDIR}/gen/${project}/prometheus
 
-    # Rsyncd on port 7999.
-    ./legacyconfig.py --format=prom-targets \
-        --template_target={{hostname}}:7999 \
-        --label service=rsyncd \
-        --label module=rsyncd_online \
-        --rsync \
-        --select "${!pattern}" > ${output}/blackbox-targets/rsyncd.json
+  # Construct the per-project SELECT_FILE variable name to use below.
+  select_file=SELECT_FILE_${project/-/_}
 
-    # SSH on port 806 over IPv4
-    ./legacyconfig.py --format=prom-targets-nodes \
-        --template_target={{hostname}}:806 \
-        --label service=ssh806 \
-        --label module=ssh_v4_online \
-        --select "${!pattern}" > ${output}/blackbox-targets/ssh806.json
+  # Construct the per-project blackbox_exporter port variable to use below.
+  # blackbox_exporter on for IPv6 targets.
+  bbe_port=BBE_IPV6_PORT_${project/-/_}
 
-    # SSH on port 806 over IPv6
-    ./legacyconfig.py --format=prom-targets-nodes \
-        --template_target={{hostname}}:806 \
-        --label service=ssh806 \
-        --label module=ssh_v6_online \
-        --label __blackbox_port=${!bbe_port} \
-        --select "${!pattern}" \
-        --decoration "v6" > ${output}/blackbox-targets-ipv6/ssh806_ipv6.json
-
-    # Sidestream exporter in the npad experiment.
-    ./legacyconfig.py --format=prom-targets \
-        --template_target={{hostname}}:9090 \
-        --label service=sidestream \
-        --select "npad.iupui.(${!pattern})" > \
-            ${output}/legacy-targets/sidestream.json
-  popd
+  # Rsyncd on port 7999, SSH on port 806 over IPv4 and IPv6, and the
+  # sidestream exporter in the npad experiment.
+  cat >> ${MANIFEST} <<EOF
+  ${sep}{
+    "format": "prom-targets",
+    "output": "${output}/blackbox-targets/rsyncd.json",
+    "template_target": ["{{hostname}}:7999"],
+    "labels": {"service": "rsyncd", "module": "rsyncd_online"},
+    "rsync": true,
+    "select_file": "${!select_file}"
+  },
+  {
+    "format": "prom-targets-nodes",
+    "output": "${output}/blackbox-targets/ssh806.json",
+    "template_target": ["{{hostname}}:806"],
+    "labels": {"service": "ssh806", "module": "ssh_v4_online"},
+    "select_file": "${!select_file}"
+  },
+  {
+    "format": "prom-targets-nodes",
+    "output": "${output}/blackbox-targets-ipv6/ssh806_ipv6.json",
+    "template_target": ["{{hostname}}:806"],
+    "labels": {"service": "ssh806", "module": "ssh_v6_online",
+               "__blackbox_port": "${!bbe_port}"},
+    "select_file": "${!select_file}",
+    "decoration": "v6"
+  },
+  {
+    "format": "prom-targets",
+    "output": "${output}/legacy-targets/sidestream.json",
+    "template_target": ["{{hostname}}:9090"],
+    "labels": {"service": "sidestream"},
+    "select": "^npad\\\\.iupui\\\\.",
+    "select_file": "${!select_file}"
+  }
+EOF
+  sep=","
 done
+echo "]" >> ${MANIFEST}
+
+pushd ${SCRIPTDIR}/plsync
+  ./legacyconfig.py --format=manifest --manifest=${MANIFEST}
+popd
@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+"""Benchmarks the legacyconfig and mlabconfig exporters on synthetic fleets.
+
+A synthetic fleet has the same number of nodes per site and the same slices as
+today's fleet (sites.py and slices.py), with the number of sites multiplied by
+every scale. Every format runs in a child process, so that the reported peak
+RSS of one format does not include the memory of the formats before it.
+
+For every scale and format, the report includes:
+    wall: seconds to generate the output.
+    peak rss: the maximum resident set size of the child process.
+    objects: the net number of objects tracked by the garbage collector that
+        were created by the format and are still alive when it finishes,
+        including its output records. Python 2 does not count every
+        allocation, so this is the closest available measure.
+
+The child processes start with the fleet in memory, so the peak RSS of every
+format includes the fleet. Compare it with the peak RSS of model/build.
+
+Examples:
+    ./benchmark.py --scales=1,10
+    ./benchmark.py --save_baseline=baseline.json
+    ./benchmark.py --baseline=baseline.json --tolerance=0.25
+      (exits with status 1 if any result is slower or larger than the
+       baseline by more than 25%)
+"""
+
+import gc
+import json
+import logging
+import optparse
+import os
+import resource
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
+
+import legacyconfig
+import mlabconfig
+from planetlab import model
+
+NODES_PER_SITE = 4
+DEFAULT_SCALES = '10,100,1000'
+DEFAULT_TOLERANCE = 0.25
+# Measurements below these floors are too noisy to compare with a baseline.
+MIN_WALL = 0.05
+MIN_RSS_KB = 1024
+
+NETWORK_TEMPLATE = 'ip={{ipv4_address}} gw={{ipv4_gateway}} v6={{ipv6_address}}'
+KUBERNETES_TEMPLATE = ('host: {{rsync_host}}\nsite: {{site_safe}}\n'
+                       'node: {{node_safe}}\nmodule: {{rsync_module}}\n')
+
+
+class NullOutput(object):
+    """NullOutput counts and discards everything written to it."""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+def site_name(i):
+    """Returns a unique site name for i, e.g. 'aaa01'."""
+    letters = ''
+    n = i // 99
+    for _ in range(3):
+        letters = chr(ord('a') + n % 26) + letters
+        n //= 26
+    return '%s%02d' % (letters, i % 99 + 1)
+
+
+def make_fleet(site_count, slice_list, users):
+    """Creates a synthetic fleet and assigns every slice to every node.
+
+    Args:
+        site_count: int, the number of sites to create.
+        slice_list: list of model.Slice, slices copied into the fleet.
+        users: list of (first, last, email) tuples, the users of every site.
+
+    Returns:
+        (list of model.Site, list of model.Slice)
+    """
+    sites = []
+    for i in range(site_count):
+        # Every site uses a /26 of 10.0.0.0/8.
+        v4 = (10 << 24) + i * 64
+        v4prefix = '%d.%d.%d.%d' % (
+            v4 >> 24, (v4 >> 16) & 255, (v4 >> 8) & 255, v4 & 255)
+        v6prefix = '2001:db8:%x:%x::' % (i >> 16, i & 0xffff)
+        sites.append(model.makesite(
+            site_name(i), v4prefix, v6prefix, 'City', 'US', 40.0, -74.0,
+            users, count=NODES_PER_SITE, nodegroup='MeasurementLabCentos'))
+    experiments = []
+    for s in slice_list:
+        kwargs = {}
+        if s['ipv6']:
+            kwargs['ipv6'] = 'all'
+        experiments.append(model.Slice(
+            name=s['name'], index=s['index'], attrs=s['attrs'],
+            users=s['users'], use_initscript=s['use_initscript'],
+            rsync_modules=s['rsync_modules'], **kwargs))
+    for experiment in experiments:
+        for site in sites:
+            for node in site.sorted_nodes():
+                experiment.add_node_address(node)
+    return sites, experiments
+
+
+def make_siteinfo(sites, experiments):
+    """Returns a siteinfo sites.json document for the fleet."""
+    documents = []
+    for site in sites:
+        nodes = []
+        for node in site.sorted_nodes():
+            interface = node.interface()
+            nodes.append({
+                'hostname': node.hostname(),
+                'v4': {
+                    'ip': interface['ip'],
+                    'gateway': interface['gateway'],
+                    'netmask': interface['netmask'],
+                },
+                'v6': {
+                    'ip': node.ipv6(),
+                    'gateway': node.v6gw(),
+                },
+                'experiments': [{
+                    'name': e.dnsname(),
+                    'hostname': e.hostname(node),
+                    'rsync_modules': e['rsync_modules'],
+                } for e in experiments if e['index'] is not None],
+            })
+        documents.append({
+            'name': site['name'],
+            'annotations': {'type': 'physical'},
+            'nodes': nodes,
+        })
+    return json.dumps(documents)
+
+
+def legacyconfig_formats(sites, experiments, tmpdir):
+    """Returns (format, function) pairs that run every legacyconfig format."""
+    def zone():
+        legacyconfig.export_mlab_zone_records(NullOutput(), sites, experiments)
+
+    def hostips():
+        records = legacyconfig.export_mlab_host_ips(sites, experiments)
+        output = NullOutput()
+        for record in records:
+            output.write('%(hostname)s,%(ipv4)s,%(ipv6)s\n' % record)
+        return records
+
+    def hostips_json():
+        records = legacyconfig.export_mlab_host_ips(sites, experiments)
+        json.dump(records, NullOutput(), indent=2)
+        return records
+
+    def sitestats():
+        records = legacyconfig.export_mlab_site_stats(sites)
+        json.dump(records, NullOutput())
+        return records
+
+    def prom_targets():
+        records = legacyconfig.select_prometheus_experiment_targets(
+            experiments, None, ['{{hostname}}:7999'], {'service': 'rsyncd'},
+            True, False, '')
+        json.dump(records, NullOutput(), indent=4)
+        return records
+
+    def prom_targets_nodes():
+        records = legacyconfig.select_prometheus_node_targets(
+            sites, None, ['{{hostname}}:806'], {'service': 'ssh806'}, 'v6')
+        json.dump(records, NullOutput(), indent=4)
+        return records
+
+    def prom_targets_sites():
+        records = legacyconfig.select_prometheus_site_targets(
+            sites, None, ['s1.{{sitename}}.measurement-lab.org'], {})
+        json.dump(records, NullOutput(), indent=4)
+        return records
+
+    def prom_metric_relabel():
+        records = legacyconfig.export_prometheus_metric_relabel_configs(
+            {}, experiments)
+        NullOutput().write('\n'.join(records))
+        return records
+
+    def scraper_kubernetes():
+        legacyconfig.export_scraper_kubernetes_config(
+            os.path.join(tmpdir, '{{site}}-{{node}}-{{experiment}}-'
+                         '{{rsync_module}}.yml'),
+            experiments, KUBERNETES_TEMPLATE, None)
+
+    def server_network_config():
+        legacyconfig.export_mlab_server_network_config(
+            NullOutput(), sites, os.path.join(tmpdir, '{{hostname}}.ipxe'),
+            StringIO.StringIO(NETWORK_TEMPLATE), None, {})
+
+    return [
+        ('zone', zone),
+        ('hostips', hostips),
+        ('hostips-json', hostips_json),
+        ('sitestats', sitestats),
+        ('prom-targets', prom_targets),
+        ('prom-targets-nodes', prom_targets_nodes),
+        ('prom-targets-sites', prom_targets_sites),
+        ('prom-metric-relabel', prom_metric_relabel),
+        ('scraper_kubernetes', scraper_kubernetes),
+        ('server-network-config', server_network_config),
+    ]
+
+
+def mlabconfig_formats(document, tmpdir):
+    """Returns (format, function) pairs that run every mlabconfig format.
+
+    Every function parses the siteinfo document, like mlabconfig.main().
+    """
+    def sites():
+        return mlabconfig.iter_sites(StringIO.StringIO(document))
+
+    def prom_targets():
+        mlabconfig.dump_records(mlabconfig.iter_prometheus_experiment_targets(
+            sites(), None, ['{{hostname}}:7999'], {'service': 'rsyncd'},
+            True, False, '', False), NullOutput())
+
+    def prom_targets_nodes():
+        mlabconfig.dump_records(mlabconfig.iter_prometheus_node_targets(
+            sites(), None, ['{{hostname}}:806'], {'service': 'ssh806'}, 'v6',
+            False), NullOutput())
+
+    def prom_targets_sites():
+        mlabconfig.dump_records(mlabconfig.iter_prometheus_site_targets(
+            sites(), None, ['s1.{{sitename}}.measurement-lab.org'], {},
+            False), NullOutput())
+
+    def server_network_config():
+        mlabconfig.export_mlab_server_network_config(
+            NullOutput(), sites(), os.path.join(tmpdir, '{{hostname}}.ipxe'),
+            StringIO.StringIO(NETWORK_TEMPLATE), None, {}, False)
+
+    return [
+        ('prom-targets', prom_targets),
+        ('prom-targets-nodes', prom_targets_nodes),
+        ('prom-targets-sites', prom_targets_sites),
+        ('server-network-config', server_network_config),
+    ]
+
+
+def measure(func):
+    """Runs func in a child process and returns its measurements.
+
+    Args:
+        func: callable, called without arguments in the child process.
+
+    Returns:
+        dict, with 'wall' seconds, 'peak_rss_kb' and 'objects'.
+
+    Raises:
+        Exception, func failed in the child process.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            gc.collect()
+            objects = len(gc.get_objects())
+            start = time.time()
+            result = func()
+            wall = time.time() - start
+            gc.collect()
+            report = {
+                'wall': wall,
+                'peak_rss_kb': resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss,
+                'objects': len(gc.get_objects()) - objects,
+            }
+            del result
+        except BaseException as err:
+            report = {'error': '%s: %s' % (type(err).__name__, err)}
+            status = 1
+        with os.fdopen(write_fd, 'w') as pipe:
+            json.dump(report, pipe)
+        os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        report = json.loads(pipe.read() or '{"error": "no report"}')
+    os.waitpid(pid, 0)
+    if 'error' in report:
+        raise Exception(report['error'])
+    return report
+
+
+def run_benchmarks(scales, base_sites, slice_list, users):
+    """Measures every format at every scale.
+
+    Args:
+        scales: list of int, multiples of base_sites to benchmark.
+        base_sites: int, the number of sites in today's fleet.
+        slice_list: list of model.Slice, the slices of every fleet.
+        users: list of (first, last, email) tuples, the users of every site.
+
+    Returns:
+        dict of str to dict, measurements by '<scale>x/<module>/<format>'.
+    """
+    results = {}
+    for scale in scales:
+        fleet = {}
+
+        def build():
+            fleet['sites'], fleet['experiments'] = make_fleet(
+                base_sites * scale, slice_list, users)
+            fleet['document'] = make_siteinfo(
+                fleet['sites'], fleet['experiments'])
+            return fleet
+
+        # NOTE: the fleet is built in this process, so every format in the
+        # child processes uses it. So, measure a separate build for the report.
+        results['%dx/model/build' % scale] = measure(build)
+        build()
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            benchmarks = [
+                ('legacyconfig', name, func)
+                for name, func in legacyconfig_formats(
+                    fleet['sites'], fleet['experiments'], tmpdir)]
+            benchmarks += [
+                ('mlabconfig', name, func)
+                for name, func in mlabconfig_formats(fleet['document'],
+                                                     tmpdir)]
+            for module, name, func in benchmarks:
+                key = '%dx/%s/%s' % (scale, module, name)
+                results[key] = measure(func)
+                logging.info('%s: %.3fs', key, results[key]['wall'])
+        finally:
+            shutil.rmtree(tmpdir)
+        fleet.clear()
+        gc.collect()
+    return results
+
+
+def format_report(results):
+    """Returns the results as a table, sorted by scale, module and format."""
+    lines = ['%-45s %10s %14s %12s' % ('benchmark', 'wall', 'peak rss',
+                                       'objects')]
+    for key in sorted(results, key=lambda k: (int(k.split('x/')[0]), k)):
+        r = results[key]
+        lines.append('%-45s %9.3fs %11d KB %12d' % (
+            key, r['wall'], r['peak_rss_kb'], r['objects']))
+    return '\n'.join(lines) + '\n'
+
+
+def check_baseline(results, baseline, tolerance):
+    """Returns a description of every result that regressed from baseline.
+
+    Args:
+        results: dict, measurements returned by run_benchmarks.
+        baseline: dict, saved measurements returned by run_benchmarks.
+        tolerance: float, the allowed fractional increase, e.g. 0.25.
+
+    Returns:
+        list of str, one message per regression.
+    """
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        for field, floor in (('wall', MIN_WALL), ('peak_rss_kb', MIN_RSS_KB)):
+            old = baseline[key][field]
+            new = results[key][field]
+            if new > max(old, floor) * (1 + tolerance):
+                regressions.append('%s: %s increased from %s to %s' % (
+                    key, field, old, new))
+    return regressions
+
+
+def parse_flags():
+    """Parses and returns the command line options."""
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option(
+        '',
+        '--scales',
+        dest='scales',
+        default=DEFAULT_SCALES,
+        help='Comma separated multiples of the current fleet to benchmark.')
+    parser.add_option(
+        '',
+        '--sites_config',
+        dest='sites_config',
+        default='sites',
+        help='The name of the module with Site() definitions.')
+    parser.add_option(
+        '',
+        '--experiments_config',
+        dest='experiments_config',
+        default='slices',
+        help='The name of the module with Slice() definitions.')
+    parser.add_option(
+        '',
+        '--baseline',
+        dest='baseline',
+        default=None,
+        help='Fail if results regressed from this saved baseline.')
+    parser.add_option(
+        '',
+        '--save_baseline',
+        dest='save_baseline',
+        default=None,
+        help='Save the results as a baseline to this file.')
+    parser.add_option(
+        '',
+        '--tolerance',
+        dest='tolerance',
+        type='float',
+        default=DEFAULT_TOLERANCE,
+        help='Allowed fractional increase over the baseline.')
+
+    (options, args) = parser.parse_args()
+    try:
+        options.scales = [int(scale) for scale in options.scales.split(',')]
+    except ValueError:
+        logging.error('Invalid --scales %s; use e.g. "10,100".',
+                      options.scales)
+        sys.exit(1)
+    return (options, args)
+
+
+def main():
+    (options, _) = parse_flags()
+    logging.basicConfig(level=logging.INFO)
+
+    sites = getattr(__import__(options.sites_config), 'site_list')
+    experiments = getattr(__import__(options.experiments_config), 'slice_list')
+    users = sites[0]['users']
+
+    results = run_benchmarks(options.scales, len(sites), experiments, users)
+    sys.stdout.write(format_report(results))
+
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as baseline:
+            json.dump(results, baseline, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            regressions = check_baseline(results, json.load(baseline),
+                                         options.tolerance)
+        for regression in regressions:
+            logging.error(regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Tests for benchmark."""
+
+import benchmark
+import mlabconfig
+import StringIO
+import unittest
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.users = [('User', 'Name', 'username@gmail.com')]
+        self.slices = [
+            {'name': 'abc_foo', 'index': 1, 'attrs': [], 'users': self.users,
+             'use_initscript': True, 'rsync_modules': ['test1'],
+             'ipv6': 'all'}]
+
+    def test_site_name_is_unique(self):
+        names = [benchmark.site_name(i) for i in range(3000)]
+
+        self.assertEqual(len(set(names)), 3000)
+        self.assertEqual(names[0], 'aaa01')
+
+    def test_make_fleet(self):
+        sites, experiments = benchmark.make_fleet(3, self.slices, self.users)
+
+        self.assertEqual(len(sites), 3)
+        self.assertEqual(len(experiments[0]['network_list']),
+                         3 * benchmark.NODES_PER_SITE)
+        self.assertEqual(sites[2]['nodes']['mlab1.aaa03.measurement-lab.org']
+                         .ipv4(), '10.0.0.137')
+
+    def test_make_siteinfo_is_readable_by_mlabconfig(self):
+        sites, experiments = benchmark.make_fleet(2, self.slices, self.users)
+
+        document = benchmark.make_siteinfo(sites, experiments)
+        records = list(mlabconfig.iter_sites(StringIO.StringIO(document)))
+
+        self.assertEqual([r.name for r in records], ['aaa01', 'aaa02'])
+        self.assertEqual(records[0].nodes[0].experiments[0].hostname,
+                         'foo.abc.mlab1.aaa01.measurement-lab.org')
+
+    def test_check_baseline_reports_regressions(self):
+        baseline = {
+            '1x/a/slower': {'wall': 1.0, 'peak_rss_kb': 10000},
+            '1x/a/larger': {'wall': 1.0, 'peak_rss_kb': 10000},
+            '1x/a/noise': {'wall': 0.001, 'peak_rss_kb': 10000},
+        }
+        results = {
+            '1x/a/slower': {'wall': 1.5, 'peak_rss_kb': 10000},
+            '1x/a/larger': {'wall': 1.0, 'peak_rss_kb': 20000},
+            '1x/a/noise': {'wall': 0.01, 'peak_rss_kb': 10000},
+            '1x/a/new': {'wall': 1.0, 'peak_rss_kb': 10000},
+        }
+
+        regressions = benchmark.check_baseline(results, baseline, 0.25)
+
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('1x/a/larger: peak_rss_kb'))
+        self.assertTrue(regressions[1].startswith('1x/a/slower: wall'))
+
+    def test_measure_runs_function_in_child_process(self):
+        report = benchmark.measure(lambda: [[i] for i in range(100)])
+
+        self.assertGreaterEqual(report['objects'], 100)
+        self.assertGreater(report['peak_rss_kb'], 0)
+
+    def test_measure_when_function_fails_raises(self):
+        with self.assertRaises(Exception):
+            benchmark.measure(lambda: 1 / 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
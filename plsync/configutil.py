@@ -0,0 +1,266 @@
+"""configutil has the templates, selectors and file writers of the exporters.
+
+legacyconfig.py and mlabconfig.py both evaluate output templates for every
+node, select hostnames with --select and --select_file, and write many output
+files in one run.
+"""
+
+import collections
+import multiprocessing.pool
+import os
+import re
+import string
+import tempfile
+
+WRITE_WORKERS = 8
+PLAIN_NAME = re.compile(r'^[A-Za-z0-9-]+(\.[A-Za-z0-9-]+)*$')
+
+
+class BracketTemplate(string.Template):
+    """Process templates using variable delimiters like: {{var}}.
+
+    The default string.Template delimiter is "$". This makes it difficult to
+    make templates from shell scripts or ipxe scripts (which contain many
+    natural "$" characters).
+
+    BracketTemplate uses a beginning ("{{") and ending delimiter ("}}"), that
+    does not conflict with the syntax of these languages.
+    """
+
+    delimiter = '{{'
+    pattern = r'''
+        \{\{(?:
+        (?P<escaped>\{\{)|
+        (?P<named>[_a-z][_a-z0-9]*)\}\}|
+        (?P<braced>[_a-z][_a-z0-9]*)\}\}|
+        (?P<invalid>)
+        )'''
+
+    # TODO(#116): Delete this class and local definition of safe_substitute once
+    # the resolution for http://bugs.python.org/issue17078 is in all
+    # contemporary python packages.
+    class _multimap:
+        """Helper class for combining multiple mappings.
+
+        Used by .{safe_,}substitute() to combine the mapping and keyword
+        arguments.
+        """
+        def __init__(self, primary, secondary):
+            self._primary = primary
+            self._secondary = secondary
+
+        def __getitem__(self, key):
+            try:
+                return self._primary[key]
+            except KeyError:
+                return self._secondary[key]
+
+    def safe_substitute(self, *args, **kws):
+        if len(args) > 1:
+            raise TypeError('Too many positional arguments')
+        if not args:
+            mapping = kws
+        elif kws:
+            mapping = BracketTemplate._multimap(kws, args[0])
+        else:
+            mapping = args[0]
+        # Helper function for .sub()
+        def convert(mo):
+            named = mo.group('named') or mo.group('braced')
+            if named is not None:
+                try:
+                    # We use this idiom instead of str() because the latter
+                    # will fail if val is a Unicode containing non-ASCII
+                    return '%s' % (mapping[named],)
+                except KeyError:
+                    return mo.group()
+            if mo.group('escaped') is not None:
+                return self.delimiter
+            if mo.group('invalid') is not None:
+                return mo.group()
+            raise ValueError('Unrecognized named group in pattern',
+                             self.pattern)
+        return self.pattern.sub(convert, self.template)
+
+
+class CompiledTemplate(object):
+    """A BracketTemplate parsed once into literal text and field slots.
+
+    render(mapping) returns the same result as
+    BracketTemplate(template).safe_substitute(mapping), but only joins the
+    literal text with the values of the fields. Use CompiledTemplate when one
+    template is evaluated many times.
+    """
+
+    def __init__(self, template):
+        self.parts = []
+        literal = []
+        pos = 0
+        for mo in BracketTemplate.pattern.finditer(template):
+            literal.append(template[pos:mo.start()])
+            pos = mo.end()
+            named = mo.group('named') or mo.group('braced')
+            if named is not None:
+                self.parts.append(''.join(literal))
+                # A slot is the field name and the text used when it is missing.
+                self.parts.append((named, mo.group()))
+                literal = []
+            elif mo.group('escaped') is not None:
+                literal.append(BracketTemplate.delimiter)
+            else:
+                literal.append(mo.group())
+        literal.append(template[pos:])
+        self.parts.append(''.join(literal))
+
+    def render(self, mapping):
+        """Returns the template with fields replaced by values from mapping."""
+        output = []
+        for part in self.parts:
+            if type(part) is tuple:
+                if part[0] in mapping:
+                    part = '%s' % (mapping[part[0]],)
+                else:
+                    part = part[1]
+            output.append(part)
+        return ''.join(output)
+
+
+class Selector(object):
+    """Selector chooses hostnames by a regex and the lines of select files.
+
+    A hostname is selected when it matches the regex (if any) and, when select
+    files are given, any line of the select files. A line that is a plain name,
+    e.g. "abc01" or "mlab1.abc01.measurement-lab.org", matches hostnames that
+    contain the name as whole dot-separated labels. Plain names are found with
+    a set lookup, so long lists cost no more than short ones. Every other line
+    is a regex, and all regex lines are combined into one compiled pattern.
+
+    Because a run evaluates the same hostnames many times, the result for
+    every hostname is saved.
+    """
+
+    def __init__(self, select_regex=None, select_files=()):
+        self.regex = re.compile(select_regex) if select_regex else None
+        self.use_files = bool(select_files)
+        self.names = set()
+        patterns = []
+        for filename in select_files:
+            with open(filename) as select_file:
+                for line in select_file:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    if PLAIN_NAME.match(line):
+                        self.names.add(line)
+                    else:
+                        patterns.append('(?:%s)' % line)
+        self.patterns = re.compile('|'.join(patterns)) if patterns else None
+        self.results = {}
+
+    def search(self, hostname):
+        """Returns True if hostname is selected."""
+        result = self.results.get(hostname)
+        if result is None:
+            result = self._match(hostname)
+            self.results[hostname] = result
+        return result
+
+    def _match(self, hostname):
+        if self.regex and not self.regex.search(hostname):
+            return False
+        if not self.use_files:
+            return True
+        if self.names:
+            labels = hostname.split('.')
+            for i in range(len(labels)):
+                for j in range(i + 1, len(labels) + 1):
+                    if '.'.join(labels[i:j]) in self.names:
+                        return True
+        return bool(self.patterns and self.patterns.search(hostname))
+
+
+# Selectors returned by compile_select, by regex and select files.
+_selectors = {}
+
+
+def compile_select(select_regex, select_files=()):
+    """Returns a Selector for select_regex and select_files, or None.
+
+    Selectors are shared, so that every output of one run reuses the saved
+    results. A Selector given as select_regex is returned unchanged.
+    """
+    if isinstance(select_regex, Selector):
+        return select_regex
+    if not select_regex and not select_files:
+        return None
+    key = (select_regex, tuple(select_files))
+    if key not in _selectors:
+        _selectors[key] = Selector(select_regex, select_files)
+    return _selectors[key]
+
+
+def write_file(filename, content, mode):
+    """Writes content to filename, unless filename already has that content.
+
+    The content is first written to a temporary file in the same directory,
+    which is then renamed to filename. So, readers never see a partial file.
+
+    Args:
+        filename: str, the name of the output file.
+        content: str, the complete new content of the file.
+        mode: int, permission bits of a newly written file.
+
+    Returns:
+        bool, True if the file was written, False if it was unchanged.
+
+    Raises:
+        IOError, OSError, could not create or write to a file.
+    """
+    try:
+        if os.path.getsize(filename) == len(content):
+            with open(filename, 'rb') as current:
+                if current.read() == content:
+                    return False
+    except (IOError, OSError):
+        # The file does not exist or cannot be read, so write it.
+        pass
+    fd, tmpname = tempfile.mkstemp(
+        prefix='.' + os.path.basename(filename) + '.',
+        dir=os.path.dirname(filename) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(content)
+        os.chmod(tmpname, mode)
+        os.rename(tmpname, filename)
+    except:
+        os.remove(tmpname)
+        raise
+    return True
+
+
+def write_files(files, workers=WRITE_WORKERS):
+    """Writes files in parallel using write_file.
+
+    Args:
+        files: list of (filename, content) tuples. When a filename is repeated,
+            the last content is written.
+        workers: int, the number of files written concurrently.
+
+    Returns:
+        int, the number of files written; the rest were unchanged.
+    """
+    contents = collections.OrderedDict(files)
+    if not contents:
+        return 0
+    # Like open(), create new files with the default permissions.
+    umask = os.umask(0)
+    os.umask(umask)
+    mode = 0666 & ~umask
+    pool = multiprocessing.pool.ThreadPool(min(workers, len(contents)))
+    try:
+        written = pool.map(lambda item: write_file(item[0], item[1], mode),
+                           contents.items())
+    finally:
+        pool.close()
+        pool.join()
+    return sum(written)
@@ -0,0 +1,140 @@
+"""Tests for configutil."""
+
+import configutil
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class BracketTemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.vars = {'var1': 'Spot', 'var2': 'Dog'}
+
+    def test_substitute_when_template_is_correct(self):
+        tmpl = configutil.BracketTemplate('{{var1}} is a {{var2}}')
+
+        actual = tmpl.safe_substitute(self.vars)
+
+        self.assertEqual(actual, 'Spot is a Dog')
+
+    def test_substitute_when_template_is_broken(self):
+        tmpl = configutil.BracketTemplate('var1}} is a {{var2')
+
+        actual = tmpl.safe_substitute(self.vars)
+
+        self.assertEqual(actual, 'var1}} is a {{var2')
+
+    def test_substitute_when_template_is_shell(self):
+        tmpl1 = configutil.BracketTemplate('$var1 == {{var1}}')
+        tmpl2 = configutil.BracketTemplate('${var2} == {{var2}}')
+
+        actual1 = tmpl1.safe_substitute(self.vars)
+        actual2 = tmpl2.safe_substitute(self.vars)
+
+        self.assertEqual(actual1, '$var1 == Spot')
+        self.assertEqual(actual2, '${var2} == Dog')
+
+    def test_substitute_without_value_returns_unchanged_template(self):
+        tmpl = configutil.BracketTemplate('{{evaluated}} {{unevaluated}}')
+
+        actual = tmpl.safe_substitute({'evaluated': 'okay'})
+
+        self.assertEqual(actual, 'okay {{unevaluated}}')
+
+
+class CompiledTemplateTest(unittest.TestCase):
+
+    def test_render_matches_bracket_template(self):
+        vars = {'var1': 'Spot', 'var2': 'Dog'}
+        templates = ['{{var1}} is a {{var2}}', 'var1}} is a {{var2',
+                     '${var2} == {{var2}}', '{{{{var1}} {{unevaluated}}',
+                     '{{var1}}{{var2}}', '', 'no fields']
+
+        for template in templates:
+            expected = configutil.BracketTemplate(template).safe_substitute(
+                vars)
+            actual = configutil.CompiledTemplate(template).render(vars)
+            self.assertEqual(actual, expected)
+
+
+class SelectorTest(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.select_file = os.path.join(tmpdir, 'patterns.txt')
+        with open(self.select_file, 'w') as f:
+            f.write('abc01\nmlab2.xyz02.measurement-lab.org\n\n'
+                    '(mlab4\\.[a-z]{3}[0-9]t)\n')
+
+    def test_selector_matches_names_as_whole_labels(self):
+        selector = configutil.Selector(None, [self.select_file])
+
+        self.assertTrue(selector.search('mlab1.abc01.measurement-lab.org'))
+        self.assertTrue(selector.search('mlab2.xyz02.measurement-lab.org'))
+        self.assertFalse(selector.search('mlab1.xyz02.measurement-lab.org'))
+        self.assertFalse(selector.search('mlab1.abc011.measurement-lab.org'))
+        self.assertEqual(selector.names, set(
+            ['abc01', 'mlab2.xyz02.measurement-lab.org']))
+
+    def test_selector_matches_regex_lines(self):
+        selector = configutil.Selector(None, [self.select_file])
+
+        self.assertTrue(selector.search('mlab4.lga0t.measurement-lab.org'))
+        self.assertFalse(selector.search('mlab4.lga01.measurement-lab.org'))
+
+    def test_selector_requires_regex_and_file(self):
+        selector = configutil.Selector('^npad', [self.select_file])
+
+        self.assertTrue(
+            selector.search('npad.iupui.mlab1.abc01.measurement-lab.org'))
+        self.assertFalse(selector.search('mlab1.abc01.measurement-lab.org'))
+
+    def test_compile_select_shares_selectors(self):
+        first = configutil.compile_select('mlab1', [self.select_file])
+        second = configutil.compile_select('mlab1', [self.select_file])
+
+        first.search('mlab1.abc01.measurement-lab.org')
+
+        self.assertIs(first, second)
+        self.assertEqual(second.results,
+                         {'mlab1.abc01.measurement-lab.org': True})
+        self.assertIs(configutil.compile_select(first), first)
+        self.assertIsNone(configutil.compile_select(None))
+
+
+class WriteFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_write_files_writes_new_and_changed_files(self):
+        first = os.path.join(self.tmpdir, 'first.txt')
+        second = os.path.join(self.tmpdir, 'second.txt')
+        with open(second, 'w') as f:
+            f.write('old')
+
+        written = configutil.write_files([(first, 'one'), (second, 'two')])
+
+        self.assertEqual(written, 2)
+        self.assertEqual(open(first).read(), 'one')
+        self.assertEqual(open(second).read(), 'two')
+        self.assertItemsEqual(os.listdir(self.tmpdir),
+                              ['first.txt', 'second.txt'])
+
+    def test_write_files_skips_unchanged_files(self):
+        filename = os.path.join(self.tmpdir, 'same.txt')
+        configutil.write_files([(filename, 'content')])
+        os.utime(filename, (1000, 1000))
+
+        written = configutil.write_files([(filename, 'content')])
+
+        self.assertEqual(written, 0)
+        self.assertEqual(os.stat(filename).st_mtime, 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
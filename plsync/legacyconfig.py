@@ -1,14 +1,21 @@
 #!/usr/bin/env python
 
+import configutil
+import hashlib
 import json
 import logging
 import optparse
 import os
 import re
-import string
+import StringIO
 import sys
 import time
 
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
 ZONE_TTL = 60 * 5
 ZONE_MIN_TTL = 60 * 5
 ZONE_REFRESH = 60 * 60
@@ -16,74 +23,9 @@ ZONE_RETRY = 60 * 10
 ZONE_EXPIRE = 7 * 60 * 60 * 24
 ZONE_HEADER_TEMPLATE = 'mlabzone.header.in'
 ZONE_SERIAL_COUNTER = '/tmp/mlabconfig.serial'
+ZONE_STATE = '/tmp/mlabconfig.zonestate'
 SSL_EXPERIMENTS = ['iupui_ndt']
-
-
-class BracketTemplate(string.Template):
-    """Process templates using variable delimiters like: {{var}}.
-
-    The default string.Template delimiter is "$". This makes it difficult to
-    make templates from shell scripts or ipxe scripts (which contain many
-    natural "$" characters).
-
-    BracketTemplate uses a beginning ("{{") and ending delimiter ("}}"), that
-    does not conflict with the syntax of these languages.
-    """
-
-    delimiter = '{{'
-    pattern = r'''
-        \{\{(?:
-        (?P<escaped>\{\{)|
-        (?P<named>[_a-z][_a-z0-9]*)\}\}|
-        (?P<braced>[_a-z][_a-z0-9]*)\}\}|
-        (?P<invalid>)
-        )'''
-
-    # TODO(#116): Delete this class and local definition of safe_substitute once
-    # the resolution for http://bugs.python.org/issue17078 is in all
-    # contemporary python packages.
-    class _multimap:
-        """Helper class for combining multiple mappings.
-
-        Used by .{safe_,}substitute() to combine the mapping and keyword
-        arguments.
-        """
-        def __init__(self, primary, secondary):
-            self._primary = primary
-            self._secondary = secondary
-
-        def __getitem__(self, key):
-            try:
-                return self._primary[key]
-            except KeyError:
-                return self._secondary[key]
-
-    def safe_substitute(self, *args, **kws):
-        if len(args) > 1:
-            raise TypeError('Too many positional arguments')
-        if not args:
-            mapping = kws
-        elif kws:
-            mapping = BracketTemplate._multimap(kws, args[0])
-        else:
-            mapping = args[0]
-        # Helper function for .sub()
-        def convert(mo):
-            named = mo.group('named') or mo.group('braced')
-            if named is not None:
-                try:
-                    # We use this idiom instead of str() because the latter
-                    # will fail if val is a Unicode containing non-ASCII
-                    return '%s' % (mapping[named],)
-                except KeyError:
-                    return mo.group()
-            if mo.group('escaped') is not None:
-                return self.delimiter
-            if mo.group('invalid') is not None:
-                return mo.group()
-            raise ValueError('Unrecognized named group in pattern',
-                             self.pattern)
-        return self.pattern.sub(convert, self.template)
+MANIFEST_FORMATS = ['prom-targets', 'prom-targets-nodes', 'prom-targets-sites']
 
 
 def usage():
@@ -102,6 +44,10 @@ EXAMPLES:
     mlabconfig.py --format=zone
       (e.g. gen_zones.py)
 
+    mlabconfig.py --format=zone --zonefile=measurement-lab.org.zone \
+        --skip_unchanged --zone_diff=measurement-lab.org.ixfr
+      (only rewrite the zone and increase the serial when records change)
+
     mlabconfig.py --format=server-network-config  \
         --template_input=file.template \
         --template_output="$PATH/file-{{hostname}}.xyz" \
@@ -130,10 +76,26 @@ EXAMPLES:
         --label service=machine_online \
         --select=".*lga0t.*"
 
+    mlabconfig.py --format=prom-targets-nodes \
+        --template_target={{hostname}}:806 \
+        --label module=ssh_v4_online \
+        --label service=machine_online \
+        --select_file=production_patterns.txt
+      (select hostnames matching any line of production_patterns.txt)
+
     mlabconfig.py --format=prom-targets-sites \
         --template_target=s1.{{sitename}}.measurement-lab.org \
         --label service=snmp \
         --label __exporter_project=sandbox
+
+    mlabconfig.py --format=manifest --manifest=targets.json
+      (writes every output listed in targets.json, e.g.
+       [{"format": "prom-targets-nodes",
+         "output": "blackbox-targets/ssh806.json",
+         "template_target": ["{{hostname}}:806"],
+         "labels": {"service": "ssh806", "module": "ssh_v4_online"},
+         "select": ".*lga0t.*",
+         "decoration": ""}])
 """
 
 
@@ -191,6 +153,29 @@ def parse_flags():
                       dest='zoneheader',
                       default=ZONE_HEADER_TEMPLATE,
                       help='The full path to zone header file.')
+    parser.add_option('',
+                      '--zonefile',
+                      dest='zonefile',
+                      help='Write the zone to this file instead of stdout.')
+    parser.add_option('',
+                      '--zone_state',
+                      dest='zone_state',
+                      default=ZONE_STATE,
+                      help=('The full path to a file that saves the serial, '
+                            'hash and records of the last zone.'))
+    parser.add_option('',
+                      '--skip_unchanged',
+                      dest='skip_unchanged',
+                      action='store_true',
+                      default=False,
+                      help=('Do not rewrite --zonefile when the zone content '
+                            'is unchanged since the last run.'))
+    parser.add_option('',
+                      '--zone_diff',
+                      dest='zone_diff',
+                      default=None,
+                      help=('Write the records removed and added since the '
+                            'last zone to this file, in IXFR order.'))
     parser.add_option(
         '',
         '--template_input',
@@ -247,6 +232,22 @@ def parse_flags():
         default=None,
         help=('A regular expression used to select a subset of hostnames. If '
               'not specified, all machine names are selected.'))
+    parser.add_option(
+        '',
+        '--select_file',
+        dest='select_file',
+        action='append',
+        default=[],
+        help=('A file with one hostname, site name or regular expression per '
+              'line. Selects hostnames that match any line, and --select if '
+              'given. May be repeated.'))
+    parser.add_option(
+        '',
+        '--manifest',
+        dest='manifest',
+        default=None,
+        help=('A JSON (or YAML) list of output specs used by the "manifest" '
+              'format. Every output is written in one run.'))
 
     (options, args) = parser.parse_args()
 
@@ -254,6 +255,12 @@ def parse_flags():
     if options.format == 'zone' and not os.path.exists(options.zoneheader):
         logging.error('Zone header file %s not found!', options.zoneheader)
         sys.exit(1)
+    if options.format == 'manifest' and not options.manifest:
+        logging.error('--format=manifest requires --manifest')
+        sys.exit(1)
+    if options.skip_unchanged and not options.zonefile:
+        logging.error('--skip_unchanged requires --zonefile')
+        sys.exit(1)
 
     # If labels are given, parse them and check for malformed values.
     if options.labels:
@@ -280,24 +287,10 @@ def parse_flags():
     return (options, args)
 
 
-def comment(output, note):
-    output.write('\n; %s\n' % note)
-
-
-def write_a_record(output, hostname, ipv4):
-    output.write(format_a_record(hostname, ipv4))
-    output.write('\n')
-
-
 def format_a_record(hostname, ipv4):
     return '%-32s  IN  A   \t%s' % (hostname, ipv4)
 
 
-def write_aaaa_record(output, hostname, ipv6):
-    output.write(format_aaaa_record(hostname, ipv6))
-    output.write('\n')
-
-
 def format_aaaa_record(hostname, ipv6):
     return '%-32s  IN  AAAA\t%s' % (hostname, ipv6)
 
@@ -316,120 +309,179 @@ def flatten_hostname(hostname):
     return hostname.replace('.', '-')
 
 
-def export_router_and_switch_records(output, sites):
-    comment(output, 'router and switch v4 records.')
-    for site in sites:
-        write_a_record(output, 'r1.' + site['name'], site.ipv4(index=1))
-        write_a_record(output, 's1.' + site['name'], site.ipv4(index=2))
+class ZoneSection(object):
+    """ZoneSection collects the records of one commented section of a zone.
 
+    Args:
+      note: str, the comment written before the section records.
+      site_records: callable, returns a list of records for a site.
+      node_records: callable, returns a list of records for a node.
+    """
 
-def export_pcu_records(output, sites):
-    comment(output, 'pcus v4')
-    for site in sites:
-        # TODO: change site['nodes'] to a pre-sorted list type.
-        for node in sorted(site['nodes'].values(), key=lambda n: n.hostname()):
-            write_a_record(output, node['pcu'].recordname(), node['pcu'].ipv4())
+    def __init__(self, note, site_records=None, node_records=None):
+        self.note = note
+        self.site_records = site_records
+        self.node_records = node_records
+        self.records = []
 
 
-def export_server_records(output, sites):
-    export_server_records_v4(output, sites)
-    export_server_records_v4(output, sites, decoration='v4')
-    export_server_records_v6(output, sites)
-    export_server_records_v6(output, sites, decoration='v6')
+def write_zone_sections(output, sites, sections):
+    """Writes all sections to output, in order.
 
+    Records for every section are collected in a single traversal of sites and
+    nodes. Duplicate records within a section are written once. The complete
+    result is written to output with a single call.
 
-def export_server_records_v4(output, sites, decoration=''):
-    comment(output, 'hosts v4%s' % (' decorated' if decoration else ''))
+    Args:
+      output: file, a file object open for writing.
+      sites: list of model.Site, the sites used to generate records.
+      sections: list of ZoneSection, the sections to write.
+    """
+    site_sections = [s for s in sections if s.site_records]
+    node_sections = [s for s in sections if s.node_records]
     for site in sites:
-        # TODO: change site['nodes'] to a pre-sorted list type.
-        for node in sorted(site['nodes'].values(), key=lambda n: n.hostname()):
-            write_a_record(output, node.recordname(decoration), node.ipv4())
+        for section in site_sections:
+            section.records.extend(section.site_records(site))
+        for node in site.sorted_nodes():
+            for section in node_sections:
+                section.records.extend(section.node_records(node))
 
+    chunks = []
+    for section in sections:
+        chunks.append('\n; %s\n' % section.note)
+        seen = set()
+        for record in section.records:
+            if record not in seen:
+                seen.add(record)
+                chunks.append(record)
+                chunks.append('\n')
+    output.write(''.join(chunks))
 
-def export_server_records_v6(output, sites, decoration=''):
-    comment(output, 'hosts v6%s' % (' decorated' if decoration else ''))
-    for site in sites:
-        # TODO: change site['nodes'] to a pre-sorted list type.
-        for node in sorted(site['nodes'].values(), key=lambda n: n.hostname()):
-            if node.ipv6_is_enabled():
-                write_aaaa_record(output, node.recordname(decoration),
-                                  node.ipv6())
 
+def router_and_switch_section():
+    return ZoneSection(
+        'router and switch v4 records.',
+        site_records=lambda site: [
+            format_a_record('r1.' + site['name'], site.ipv4(index=1)),
+            format_a_record('s1.' + site['name'], site.ipv4(index=2))])
 
-def export_experiment_records(output, sites, experiments):
+
+def pcu_section():
+    return ZoneSection(
+        'pcus v4',
+        node_records=lambda node: [
+            format_a_record(node['pcu'].recordname(), node['pcu'].ipv4())])
+
+
+def server_section_v4(decoration=''):
+    return ZoneSection(
+        'hosts v4%s' % (' decorated' if decoration else ''),
+        node_records=lambda node: [
+            format_a_record(node.recordname(decoration), node.ipv4())])
+
+
+def server_section_v6(decoration=''):
+
+    def node_records(node):
+        if not node.ipv6_is_enabled():
+            return []
+        return [format_aaaa_record(node.recordname(decoration), node.ipv6())]
+
+    return ZoneSection('hosts v6%s' % (' decorated' if decoration else ''),
+                       node_records=node_records)
+
+
+def server_sections():
+    return [server_section_v4(), server_section_v4(decoration='v4'),
+            server_section_v6(), server_section_v6(decoration='v6')]
+
+
+def experiment_section_note(experiment, version, decoration, flatnames):
+    return '%s %s%s%s' % (experiment.dnsname(), version, (
+        ' decorated' if decoration else ''), (' flattened'
+                                              if flatnames else ''))
+
+
+def experiment_section_v4(experiment, decoration='', flatnames=False):
+
+    def node_records(node):
+        # TODO: remove sitenames (or exclude mlab4's).
+        recordname = experiment.recordname(node, decoration)
+        ipv4 = experiment.ipv4(node)
+        if flatnames:
+            return [format_a_record(flatten_hostname(recordname), ipv4)]
+        return [format_a_record(experiment.sitename(node, decoration), ipv4),
+                format_a_record(recordname, ipv4)]
+
+    return ZoneSection(
+        experiment_section_note(experiment, 'v4', decoration, flatnames),
+        node_records=node_records)
+
+
+def experiment_section_v6(experiment, decoration='', flatnames=False):
+
+    def node_records(node):
+        # TODO: remove sitenames (or exclude mlab4's).
+        if not (node.ipv6_is_enabled() and experiment.ipv6(node)):
+            return []
+        recordname = experiment.recordname(node, decoration)
+        ipv6 = experiment.ipv6(node)
+        if flatnames:
+            return [format_aaaa_record(flatten_hostname(recordname), ipv6)]
+        return [format_aaaa_record(experiment.sitename(node, decoration), ipv6),
+                format_aaaa_record(recordname, ipv6)]
+
+    return ZoneSection(
+        experiment_section_note(experiment, 'v6', decoration, flatnames),
+        node_records=node_records)
+
+
+def experiment_sections(experiments):
+    sections = []
     for experiment in experiments:
         if experiment['index'] is None:
             # Ignore experiments without an IP address.
             continue
-        export_experiment_records_v4(output, sites, experiment)
-        export_experiment_records_v4(output, sites, experiment, decoration='v4')
-
-        export_experiment_records_v6(output, sites, experiment)
-        export_experiment_records_v6(output, sites, experiment, decoration='v6')
+        sections.extend([
+            experiment_section_v4(experiment),
+            experiment_section_v4(experiment, decoration='v4'),
+            experiment_section_v6(experiment),
+            experiment_section_v6(experiment, decoration='v6')])
 
         # Create "flattened" domain names for SSL enabled experiments so that
         # certificate wildcard matching works. See flatten_hostname().
         if experiment['name'] in SSL_EXPERIMENTS:
-            export_experiment_records_v4(
-                output, sites, experiment, decoration='', flatnames=True)
-            export_experiment_records_v4(
-                output, sites, experiment, decoration='v4', flatnames=True)
-            export_experiment_records_v6(
-                output, sites, experiment, decoration='', flatnames=True)
-            export_experiment_records_v6(
-                output, sites, experiment, decoration='v6', flatnames=True)
-
-
-def export_experiment_records_v4(output,
-                                 sites,
-                                 experiment,
-                                 decoration='',
-                                 flatnames=False):
-    comment(output, '%s v4%s%s' % (experiment.dnsname(), (
-        ' decorated' if decoration else ''), (' flattened'
-                                              if flatnames else '')))
-    for site in sites:
-        # TODO: change site['nodes'] to a pre-sorted list type.
-        for node in sorted(site['nodes'].values(), key=lambda n: n.hostname()):
-            # TODO: remove sitenames (or exclude mlab4's).
-            sitename = experiment.sitename(node, decoration)
-            recordname = experiment.recordname(node, decoration)
-            if flatnames:
-                write_a_record(output, flatten_hostname(recordname),
-                               experiment.ipv4(node))
-            else:
-                write_a_record(output, sitename, experiment.ipv4(node))
-                write_a_record(output, recordname, experiment.ipv4(node))
-
-
-def export_experiment_records_v6(output,
-                                 sites,
-                                 experiment,
-                                 decoration='',
-                                 flatnames=False):
-    comment(output, '%s v6%s%s' % (experiment.dnsname(), (
-        ' decorated' if decoration else ''), (' flattened'
-                                              if flatnames else '')))
-    for site in sites:
-        # TODO: change site['nodes'] to a pre-sorted list type.
-        for node in sorted(site['nodes'].values(), key=lambda n: n.hostname()):
-            # TODO: remove sitenames (or exclude mlab4's).
-            if (node.ipv6_is_enabled() and experiment.ipv6(node)):
-                sitename = experiment.sitename(node, decoration)
-                recordname = experiment.recordname(node, decoration)
-                if flatnames:
-                    write_aaaa_record(output, flatten_hostname(recordname),
-                                      experiment.ipv6(node))
-                else:
-                    write_aaaa_record(output, sitename, experiment.ipv6(node))
-                    write_aaaa_record(output, recordname, experiment.ipv6(node))
+            sections.extend([
+                experiment_section_v4(experiment, flatnames=True),
+                experiment_section_v4(
+                    experiment, decoration='v4', flatnames=True),
+                experiment_section_v6(experiment, flatnames=True),
+                experiment_section_v6(
+                    experiment, decoration='v6', flatnames=True)])
+    return sections
+
+
+def export_router_and_switch_records(output, sites):
+    write_zone_sections(output, sites, [router_and_switch_section()])
+
+
+def export_pcu_records(output, sites):
+    write_zone_sections(output, sites, [pcu_section()])
+
+
+def export_server_records(output, sites):
+    write_zone_sections(output, sites, server_sections())
+
+
+def export_experiment_records(output, sites, experiments):
+    write_zone_sections(output, sites, experiment_sections(experiments))
 
 
 def export_mlab_zone_records(output, sites, experiments):
-    export_router_and_switch_records(output, sites)
-    export_pcu_records(output, sites)
-    export_server_records(output, sites)
-    export_experiment_records(output, sites, experiments)
+    sections = [router_and_switch_section(), pcu_section()]
+    sections.extend(server_sections())
+    sections.extend(experiment_sections(experiments))
+    write_zone_sections(output, sites, sections)
 
 
 def get_revision(prefix, revision_path):
@@ -482,6 +534,90 @@ def serial_rfc1912(ts):
     return serial_prefix + get_revision(serial_prefix, ZONE_SERIAL_COUNTER)
 
 
+def zone_hash(headerdata, body, options):
+    """Returns a hash of the zone content, excluding the serial.
+
+    Args:
+        headerdata: str, the zone header template.
+        body: str, the zone records.
+        options: optparse.Values, all command line options.
+
+    Returns:
+        str, the hex digest of the zone content.
+    """
+    values = dict(options.__dict__, serial='')
+    return hashlib.sha1((headerdata % values) + body).hexdigest()
+
+
+def read_zone_state(state_path):
+    """Returns the state saved by write_zone_state, or None if unavailable."""
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path) as f:
+        try:
+            return json.loads(f.read())
+        except ValueError:
+            logging.error('Content of %s is corrupted', state_path)
+            return None
+
+
+def write_zone_state(state_path, serial, digest, records):
+    """Saves the serial, content hash and records of the latest zone."""
+    with open(state_path, 'w') as f:
+        f.write(json.dumps(
+            {'serial': serial, 'hash': digest, 'records': records}))
+
+
+def select_zone_serial(state, digest, ts):
+    """Returns the zone serial and whether the zone content is unchanged.
+
+    The serial from state is reused when digest matches the saved hash, so
+    that secondaries do not reload or transfer an unchanged zone.
+
+    Args:
+        state: dict, the state saved by the last run, or None.
+        digest: str, the zone_hash() of the current zone.
+        ts: time.struct_time, the time used for a new serial.
+
+    Returns:
+        (str, bool), the serial and True if the content is unchanged.
+    """
+    if state is not None and state.get('hash') == digest:
+        return (state['serial'], True)
+    return (serial_rfc1912(ts), False)
+
+
+def zone_records(body):
+    """Returns the records in body, without comments or blank lines."""
+    return [line for line in body.split('\n')
+            if line and not line.startswith(';')]
+
+
+def format_zone_diff(state, serial, records):
+    """Returns the records removed and added since the previous zone.
+
+    Like an IXFR response, removed records follow the previous serial and added
+    records follow the new serial.
+
+    Args:
+        state: dict, the state saved by the last run, or None.
+        serial: str, the serial of the new zone.
+        records: list of str, the records of the new zone.
+
+    Returns:
+        str, the zone difference.
+    """
+    old_serial = state['serial'] if state else ''
+    old_records = state['records'] if state else []
+    old = set(old_records)
+    new = set(records)
+    lines = ['; serial %s' % old_serial]
+    lines.extend(r for r in old_records if r not in new)
+    lines.append('; serial %s' % serial)
+    lines.extend(r for r in records if r not in old)
+    return '\n'.join(lines) + '\n'
+
+
 def export_mlab_zone_header(output, header, options):
     """Writes the zone header file to output.
 
@@ -534,8 +670,7 @@ def export_mlab_host_ips(sites, experiments):
     output = []
     # Export server names and addresses.
     for site in sites:
-        # TODO(soltesz): change 'nodes' to be a sorted list of node objects.
-        for _, node in site['nodes'].iteritems():
+        for node in site.sorted_nodes():
             output.append(
                 {'hostname': node.hostname(),
                  'ipv4': node.ipv4(),
@@ -594,12 +729,15 @@ def export_mlab_server_network_config(output, sites, name_tmpl, input_tmpl,
     Raises:
         IOError, could not create or write to a file.
     """
-    template = BracketTemplate(input_tmpl.read())
-    output_name = BracketTemplate(name_tmpl)
+    template = configutil.CompiledTemplate(input_tmpl.read())
+    output_name = configutil.CompiledTemplate(name_tmpl)
+    select = configutil.compile_select(select_regex)
+    files = []
     for site in sites:
-        for hostname, node in site['nodes'].iteritems():
+        for node in site.sorted_nodes():
+            hostname = node.hostname()
             # TODO(soltesz): support multiple (or all) object types.
-            if select_regex and not re.search(select_regex, hostname):
+            if select and not select.search(hostname):
                 continue
             # Get IPv4 settings.
             i = node.interface()
@@ -609,24 +747,26 @@ def export_mlab_server_network_config(output, sites, name_tmpl, input_tmpl,
             i.update(node.interface_ipv6())
             # Add extra provided labels.
             i.update(labels)
-            filename = output_name.safe_substitute(i)
-            with open(filename, 'w') as f:
-                output.write("%s\n" % filename)
-                f.write(template.safe_substitute(i))
+            filename = output_name.render(i)
+            output.write("%s\n" % filename)
+            files.append((filename, template.render(i)))
+    configutil.write_files(files)
 
 
 def export_scraper_kubernetes_config(filename_template, experiments,
                                      contents_template, select):
     """Generates kubernetes deployment configs based on an input template."""
-    filename_tmpl = BracketTemplate(filename_template)
-    contents_tmpl = BracketTemplate(contents_template)
+    filename_tmpl = configutil.CompiledTemplate(filename_template)
+    contents_tmpl = configutil.CompiledTemplate(contents_template)
+    select = configutil.compile_select(select)
+    files = []
     for experiment in experiments:
         for name, node in experiment['network_list']:
             node_name, site_name, _ = name.split('.', 2)
             if experiment['index'] is None:
                 continue
             rsync_host = experiment.hostname(node)
-            if select and not re.search(select, rsync_host):
+            if select and not select.search(rsync_host):
                 continue
             for rsync_module in experiment['rsync_modules']:
                 config = {'machine': node.hostname(),
@@ -641,9 +781,9 @@ def export_scraper_kubernetes_config(filename_template, experiments,
                     # or number with a single dash to make the strings safe.
                     config[key + '_safe'] = re.sub(r'[^a-zA-Z0-9]+', '-',
                                                    value)
-                filename = filename_tmpl.safe_substitute(config)
-                with open(filename, 'w') as config_file:
-                    config_file.write(contents_tmpl.safe_substitute(config))
+                filename = filename_tmpl.render(config)
+                files.append((filename, contents_tmpl.render(config)))
+    configutil.write_files(files)
 
 
 def select_prometheus_experiment_targets(experiments, select_regex,
@@ -669,6 +809,10 @@ def select_prometheus_experiment_targets(experiments, select_regex,
       list of dict, each element is a dict with 'labels' (a dict of key/values)
           and 'targets' (a list of targets).
     """
+    templates = [configutil.CompiledTemplate(tmpl)
+                 for tmpl in target_templates]
+    select = configutil.compile_select(select_regex)
+    common_labels = tuple(common_labels.items())
     records = []
     for experiment in experiments:
         for _, node in experiment['network_list']:
@@ -676,13 +820,12 @@ def select_prometheus_experiment_targets(experiments, select_regex,
             if experiment['index'] is None:
                 continue
 
-            labels = common_labels.copy()
-            labels['experiment'] = experiment.dnsname()
-            labels['machine'] = node.hostname()
+            labels = dict(common_labels, experiment=experiment.dnsname(),
+                          machine=node.hostname())
 
             # Consider all experiments or only those with rsync modules.
             if not rsync_only or experiment['rsync_modules']:
-                if select_regex and not re.search(select_regex, experiment.hostname(node)):
+                if select and not select.search(experiment.hostname(node)):
                     continue
                 targets = []
 
@@ -694,9 +837,8 @@ def select_prometheus_experiment_targets(experiments, select_regex,
                 if use_flatnames:
                     host = host.replace('.', '-', 3)
 
-                for tmpl in target_templates:
-                    target_tmpl = BracketTemplate(tmpl)
-                    target = target_tmpl.safe_substitute({'hostname': host})
+                for tmpl in templates:
+                    target = tmpl.render({'hostname': host})
                     targets.append(target)
                 records.append({
                     'labels': labels,
@@ -723,20 +865,22 @@ def select_prometheus_node_targets(sites, select_regex, target_templates,
       list of dict, each element is a dict with 'labels' (a dict of key/values)
           and 'targets' (a list of targets).
     """
+    templates = [configutil.CompiledTemplate(tmpl)
+                 for tmpl in target_templates]
+    select = configutil.compile_select(select_regex)
+    common_labels = tuple(common_labels.items())
     records = []
     for site in sites:
-        for _, node in sorted(site['nodes'].iteritems(), key=lambda x: x[1].hostname()):
-            if select_regex and not re.search(select_regex, node.hostname()):
+        for node in site.sorted_nodes():
+            if select and not select.search(node.hostname()):
                 continue
-            labels = common_labels.copy()
-            labels['machine'] = node.hostname()
+            labels = dict(common_labels, machine=node.hostname())
             targets = []
 
             host = node.hostname(decoration)
 
-            for tmpl in target_templates:
-                target_tmpl = BracketTemplate(tmpl)
-                target = target_tmpl.safe_substitute({'hostname': host})
+            for tmpl in templates:
+                target = tmpl.render({'hostname': host})
                 targets.append(target)
             records.append({
                 'labels': labels,
@@ -761,16 +905,18 @@ def select_prometheus_site_targets(sites, select_regex, target_templates,
       list of dict, each element is a dict with 'labels' (a dict of key/values)
           and 'targets' (a list of targets).
     """
+    templates = [configutil.CompiledTemplate(tmpl)
+                 for tmpl in target_templates]
+    select = configutil.compile_select(select_regex)
+    common_labels = tuple(common_labels.items())
     records = []
     for site in sites:
-        if select_regex and not re.search(select_regex, site['name']):
+        if select and not select.search(site['name']):
             continue
-        labels = common_labels.copy()
-        labels['site'] = site['name']
+        labels = dict(common_labels, site=site['name'])
         targets = []
-        for tmpl in target_templates:
-            target_tmpl = BracketTemplate(tmpl)
-            target = target_tmpl.safe_substitute({'sitename': site['name']})
+        for tmpl in templates:
+            target = tmpl.render({'sitename': site['name']})
             targets.append(target)
         records.append({
             'labels': labels,
@@ -835,8 +981,98 @@ def export_prometheus_metric_relabel_configs(site_remap, experiments):
     return output
 
 
+def load_manifest(manifest):
+    """Reads and checks the output specs of the "manifest" format.
+
+    A manifest is a list of output specs. Every spec names a 'format' from
+    MANIFEST_FORMATS and an 'output' filename. The optional keys
+    'template_target', 'labels', 'select', 'select_file', 'rsync',
+    'use_flatnames' and 'decoration' have the same meaning as the equivalent
+    flags.
+
+    Args:
+      manifest: file object, the JSON manifest, or YAML if the filename ends in
+          .yaml or .yml.
+
+    Returns:
+      list of dict, the output specs with defaults for all optional keys.
+    """
+    if os.path.splitext(manifest.name)[1] in ('.yaml', '.yml'):
+        if yaml is None:
+            logging.error('Reading %s requires the yaml module', manifest.name)
+            sys.exit(1)
+        raw_specs = yaml.safe_load(manifest)
+    else:
+        raw_specs = json.load(manifest)
+
+    specs = []
+    for i, raw_spec in enumerate(raw_specs):
+        spec = {
+            'template_target': [],
+            'labels': {},
+            'select': None,
+            'select_file': [],
+            'rsync': False,
+            'use_flatnames': False,
+            'decoration': '',
+        }
+        spec.update(raw_spec)
+        for key in ('template_target', 'select_file'):
+            if isinstance(spec[key], basestring):
+                spec[key] = [spec[key]]
+        if spec.get('format') not in MANIFEST_FORMATS:
+            logging.error('Manifest output %d: unsupported format: %s', i,
+                          spec.get('format'))
+            sys.exit(1)
+        if not spec.get('output'):
+            logging.error('Manifest output %d: missing "output"', i)
+            sys.exit(1)
+        if spec['format'] != 'prom-targets-sites' and not spec['labels']:
+            logging.error('Manifest output %d: provide at least one label for '
+                          '"%s" format', i, spec['format'])
+            sys.exit(1)
+        if spec['decoration'] not in ('', 'v4', 'v6'):
+            logging.error('Manifest output %d: invalid decoration: %s', i,
+                          spec['decoration'])
+            sys.exit(1)
+        specs.append(spec)
+    return specs
+
+
+def select_manifest_targets(spec, sites, experiments):
+    """Selects and formats the targets of one manifest output spec."""
+    select = configutil.compile_select(spec['select'], spec['select_file'])
+    if spec['format'] == 'prom-targets':
+        return select_prometheus_experiment_targets(
+            experiments, select, spec['template_target'], spec['labels'],
+            spec['rsync'], spec['use_flatnames'], spec['decoration'])
+    elif spec['format'] == 'prom-targets-nodes':
+        return select_prometheus_node_targets(
+            sites, select, spec['template_target'], spec['labels'],
+            spec['decoration'])
+    return select_prometheus_site_targets(
+        sites, select, spec['template_target'], spec['labels'])
+
+
+def export_manifest_outputs(specs, sites, experiments):
+    """Writes every output of a manifest from one fleet model.
+
+    Args:
+      specs: list of dict, output specs returned by load_manifest().
+      sites: list of planetlab.Site objects.
+      experiments: list of planetlab.Slice objects, already assigned to nodes.
+    """
+    files = []
+    for spec in specs:
+        records = select_manifest_targets(spec, sites, experiments)
+        files.append((spec['output'], json.dumps(records, indent=4)))
+    configutil.write_files(files)
+
+
 def main():
     (options, _) = parse_flags()
+    options.select = configutil.compile_select(options.select,
+                                               options.select_file)
 
     # TODO: consider alternate formats for configuration information, e.g. yaml.
     sites = getattr(__import__(options.sites_config), options.sites)
@@ -848,7 +1084,7 @@ def main():
     # Assign every slice to every node.
     for experiment in experiments:
         for site in sites:
-            for node in sorted(site['nodes'].values(), key=lambda x: x.hostname()):
+            for node in site.sorted_nodes():
                 experiment.add_node_address(node)
 
     if options.format in ['hostips', 'hostips-json']:
@@ -970,12 +1206,38 @@ def main():
                 options.labels)
 
     elif options.format == 'zone':
+        body = StringIO.StringIO()
+        export_mlab_zone_records(body, sites, experiments)
+        body = body.getvalue()
         with open(options.zoneheader, 'r') as header:
-            if options.serial == 'auto':
-                options.serial = serial_rfc1912(time.gmtime())
-            export_mlab_zone_header(sys.stdout, header, options)
-            sys.stdout.write("\n\n")
-            export_mlab_zone_records(sys.stdout, sites, experiments)
+            headerdata = header.read()
+
+        state = read_zone_state(options.zone_state)
+        digest = zone_hash(headerdata, body, options)
+        if options.serial == 'auto':
+            options.serial, unchanged = select_zone_serial(
+                state, digest, time.gmtime())
+        else:
+            unchanged = state is not None and state.get('hash') == digest
+        records = zone_records(body)
+
+        if options.zone_diff:
+            with open(options.zone_diff, 'w') as diff:
+                diff.write(format_zone_diff(state, options.serial, records))
+
+        if unchanged and options.skip_unchanged:
+            logging.info('Zone is unchanged, skipping %s', options.zonefile)
+        else:
+            output = sys.stdout
+            if options.zonefile:
+                output = open(options.zonefile, 'w')
+            export_mlab_zone_header(
+                output, StringIO.StringIO(headerdata), options)
+            output.write("\n\n")
+            output.write(body)
+            if options.zonefile:
+                output.close()
+        write_zone_state(options.zone_state, options.serial, digest, records)
 
     elif options.format == 'scraper_kubernetes':
         with open(options.template_input, 'r') as template:
@@ -1000,6 +1262,11 @@ def main():
             sites, options.select, options.template_target, options.labels)
         json.dump(records, sys.stdout, indent=4)
 
+    elif options.format == 'manifest':
+        with open(options.manifest, 'r') as manifest:
+            specs = load_manifest(manifest)
+        export_manifest_outputs(specs, sites, experiments)
+
     elif options.format == 'prom-metric-relabel':
         output = export_prometheus_metric_relabel_configs(
             legacy_network_remap, experiments)
@@ -1,5 +1,6 @@
 """Tests for legacyconfig."""
 
+import configutil
 import contextlib
 import logging
 import legacyconfig
@@ -39,43 +40,6 @@ def OpenStringIO(sio):
         pass
 
 
-class BracketTemplateTest(unittest.TestCase):
-
-    def setUp(self):
-        self.vars = {'var1': 'Spot', 'var2': 'Dog'}
-
-    def test_substitute_when_template_is_correct(self):
-        tmpl = legacyconfig.BracketTemplate('{{var1}} is a {{var2}}')
-
-        actual = tmpl.safe_substitute(self.vars)
-
-        self.assertEqual(actual, 'Spot is a Dog')
-
-    def test_substitute_when_template_is_broken(self):
-        tmpl = legacyconfig.BracketTemplate('var1}} is a {{var2')
-
-        actual = tmpl.safe_substitute(self.vars)
-
-        self.assertEqual(actual, 'var1}} is a {{var2')
-
-    def test_substitute_when_template_is_shell(self):
-        tmpl1 = legacyconfig.BracketTemplate('$var1 == {{var1}}')
-        tmpl2 = legacyconfig.BracketTemplate('${var2} == {{var2}}')
-
-        actual1 = tmpl1.safe_substitute(self.vars)
-        actual2 = tmpl2.safe_substitute(self.vars)
-
-        self.assertEqual(actual1, '$var1 == Spot')
-        self.assertEqual(actual2, '${var2} == Dog')
-
-    def test_substitute_without_value_returns_unchanged_template(self):
-        tmpl = legacyconfig.BracketTemplate('{{evaluated}} {{unevaluated}}')
-
-        actual = tmpl.safe_substitute({'evaluated': 'okay'})
-
-        self.assertEqual(actual, 'okay {{unevaluated}}')
-
-
 class MlabconfigTest(unittest.TestCase):
 
     def setUp(self):
@@ -180,6 +144,19 @@ class MlabconfigTest(unittest.TestCase):
         results = output.getvalue().split('\n')
         self.assertContainsItems(results, expected_results)
 
+    def test_write_zone_sections_writes_duplicate_records_once(self):
+        output = StringIO.StringIO()
+        record = legacyconfig.format_a_record('mlab.abc01', '192.168.1.9')
+        sections = [
+            legacyconfig.ZoneSection('site', site_records=lambda s: [record]),
+            legacyconfig.ZoneSection('node', node_records=lambda n: [record]),
+        ]
+
+        legacyconfig.write_zone_sections(output, self.sites, sections)
+
+        self.assertEqual(output.getvalue(),
+                         '\n; site\n%s\n\n; node\n%s\n' % (record, record))
+
     def test_export_experiment_records(self):
         output = StringIO.StringIO()
         experiments = [model.Slice(name='abc_bar',
@@ -261,6 +238,38 @@ class MlabconfigTest(unittest.TestCase):
 
         self.assertEqual('2015103103', serial)
 
+    @mock.patch.object(legacyconfig, 'get_revision')
+    def test_select_zone_serial_when_content_is_unchanged(
+            self, mock_get_revision):
+        state = {'serial': '2015103005', 'hash': 'abc', 'records': []}
+
+        serial, unchanged = legacyconfig.select_zone_serial(
+            state, 'abc', time.gmtime(1446252300))
+
+        self.assertEqual(('2015103005', True), (serial, unchanged))
+        self.assertFalse(mock_get_revision.called)
+
+    @mock.patch.object(legacyconfig, 'get_revision')
+    def test_select_zone_serial_when_content_is_changed(
+            self, mock_get_revision):
+        state = {'serial': '2015103005', 'hash': 'abc', 'records': []}
+        mock_get_revision.return_value = '00'
+
+        serial, unchanged = legacyconfig.select_zone_serial(
+            state, 'def', time.gmtime(1446252300))
+
+        self.assertEqual(('2015103100', False), (serial, unchanged))
+
+    def test_format_zone_diff(self):
+        state = {'serial': '2015103005', 'hash': 'abc',
+                 'records': ['a', 'b', 'c']}
+
+        diff = legacyconfig.format_zone_diff(state, '2015103100',
+                                             ['a', 'c', 'd'])
+
+        self.assertEqual(
+            '; serial 2015103005\nb\n; serial 2015103100\nd\n', diff)
+
     @mock.patch.object(os.path, 'exists')
     @mock.patch('__builtin__.open')
     def test_get_revision_when_saved_prefix_is_old_and_revision_is_reset(
@@ -340,28 +349,26 @@ class MlabconfigTest(unittest.TestCase):
 
         self.assertEqual(output.getvalue(), 'before; middle; after')
 
-    @mock.patch('__builtin__.open')
-    def test_export_mlab_server_network_config(self, mock_open):
+    @mock.patch.object(configutil, 'write_file')
+    def test_export_mlab_server_network_config(self, mock_write_file):
         stdout = StringIO.StringIO()
         name_tmpl = '{{hostname}}-foo.ipxe'
         input_tmpl = StringIO.StringIO('ip={{ip}} ; echo ${ip} {{extra}}')
-        file_output = StringIO.StringIO()
-        mock_open.return_value = OpenStringIO(file_output)
-
         legacyconfig.export_mlab_server_network_config(
             stdout, self.sites, name_tmpl, input_tmpl, 'mlab1.abc01',
             {'extra': 'value'})
 
-        self.assertEqual(
-            file_output.getvalue(), 'ip=192.168.1.9 ; echo ${ip} value')
+        mock_write_file.assert_called_once_with(
+            'mlab1.abc01.measurement-lab.org-foo.ipxe',
+            'ip=192.168.1.9 ; echo ${ip} value', mock.ANY)
 
-    @mock.patch('__builtin__.open')
-    def test_export_scraper_kubernetes_config(self, mock_open):
+    @mock.patch.object(configutil, 'write_file')
+    def test_export_scraper_kubernetes_config(self, mock_write_file):
         virtual_output_files = {}
-        def create_new_fake_file(*args):
-            virtual_output_files[args[0]] = StringIO.StringIO()
-            return OpenStringIO(virtual_output_files[args[0]])
-        mock_open.side_effect = create_new_fake_file
+        def create_new_fake_file(filename, content, mode):
+            virtual_output_files[filename] = StringIO.StringIO(content)
+            return True
+        mock_write_file.side_effect = create_new_fake_file
         experiments = [model.Slice(name='abc_foo',
                                    index=1,
                                    attrs=self.attrs,
@@ -429,13 +436,13 @@ class MlabconfigTest(unittest.TestCase):
             self.assertEqual(contents.strip(),
                              virtual_output_files[fname].getvalue().strip())
 
-    @mock.patch('__builtin__.open')
-    def test_export_scraper_kubernetes_config_subset(self, mock_open):
+    @mock.patch.object(configutil, 'write_file')
+    def test_export_scraper_kubernetes_config_subset(self, mock_write_file):
         virtual_output_files = {}
-        def create_new_fake_file(*args):
-            virtual_output_files[args[0]] = StringIO.StringIO()
-            return OpenStringIO(virtual_output_files[args[0]])
-        mock_open.side_effect = create_new_fake_file
+        def create_new_fake_file(filename, content, mode):
+            virtual_output_files[filename] = StringIO.StringIO(content)
+            return True
+        mock_write_file.side_effect = create_new_fake_file
         experiments = [model.Slice(name='abc_foo',
                                    index=1,
                                    attrs=self.attrs,
@@ -694,6 +701,61 @@ class MlabconfigTest(unittest.TestCase):
         self.assertEqual(len(actual_targets), 1)
         self.assertItemsEqual(actual_targets, expected_targets)
 
+    def test_load_manifest_sets_defaults(self):
+        manifest = StringIO.StringIO(
+            '[{"format": "prom-targets-sites", "output": "snmp.json",'
+            '  "template_target": "s1.{{sitename}}.measurement-lab.org"}]')
+        manifest.name = 'targets.json'
+
+        specs = legacyconfig.load_manifest(manifest)
+
+        self.assertEqual(specs, [{
+            'format': 'prom-targets-sites',
+            'output': 'snmp.json',
+            'template_target': ['s1.{{sitename}}.measurement-lab.org'],
+            'labels': {},
+            'select': None,
+            'select_file': [],
+            'rsync': False,
+            'use_flatnames': False,
+            'decoration': '',
+        }])
+
+    def test_load_manifest_when_format_is_unsupported_exits(self):
+        manifest = StringIO.StringIO(
+            '[{"format": "zone", "output": "measurement-lab.org.zone"}]')
+        manifest.name = 'targets.json'
+
+        with self.assertRaises(SystemExit):
+            legacyconfig.load_manifest(manifest)
+
+    @mock.patch.object(configutil, 'write_file')
+    def test_export_manifest_outputs(self, mock_write_file):
+        virtual_output_files = {}
+        def create_new_fake_file(filename, content, mode):
+            virtual_output_files[filename] = StringIO.StringIO(content)
+            return True
+        mock_write_file.side_effect = create_new_fake_file
+        specs = [
+            {'format': 'prom-targets-nodes', 'output': 'ssh806.json',
+             'template_target': ['{{hostname}}:806'],
+             'labels': {'service': 'ssh806'}, 'select': 'mlab2.*',
+             'select_file': [],
+             'decoration': 'v6'},
+            {'format': 'prom-targets-sites', 'output': 'snmp.json',
+             'template_target': ['s1.{{sitename}}.measurement-lab.org'],
+             'labels': {}, 'select': None, 'select_file': []},
+        ]
+
+        legacyconfig.export_manifest_outputs(specs, self.sites, [])
+
+        self.assertItemsEqual(
+            virtual_output_files.keys(), ['ssh806.json', 'snmp.json'])
+        self.assertIn('mlab2v6.abc01.measurement-lab.org:806',
+                      virtual_output_files['ssh806.json'].getvalue())
+        self.assertIn('s1.abc01.measurement-lab.org',
+                      virtual_output_files['snmp.json'].getvalue())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 
+import collections
+import configutil
+import hashlib
 import json
 import logging
 import optparse
+import os
 import re
-import string
+import socket
 import sys
+import tempfile
+import time
 import urllib2
+import zlib
 
 ZONE_TTL = 60 * 5
 ZONE_MIN_TTL = 60 * 5
@@ -16,73 +23,237 @@ ZONE_EXPIRE = 7 * 60 * 60 * 24
 ZONE_HEADER_TEMPLATE = 'mlabzone.header.in'
 ZONE_SERIAL_COUNTER = '/tmp/mlabconfig.serial'
 SSL_EXPERIMENTS = ['iupui_ndt']
+SITES_CACHE_DIR = os.path.expanduser('~/.cache/mlabconfig')
+FETCH_TIMEOUT = 30
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 1
+FETCH_CHUNK_SIZE = 64 * 1024
+JSON_SEPARATORS = re.compile(r'[\s,]*')
 
 
-class BracketTemplate(string.Template):
-    """Process templates using variable delimiters like: {{var}}.
+def cached_url_names(cache_dir, url):
+    """Returns the names of the cached data and metadata files of url."""
+    name = os.path.join(cache_dir, hashlib.sha1(url).hexdigest())
+    return name + '.data', name + '.meta'
 
-    The default string.Template delimiter is "$". This makes it difficult to
-    make templates from shell scripts or ipxe scripts (which contain many
-    natural "$" characters).
 
-    BracketTemplate uses a beginning ("{{") and ending delimiter ("}}"), that
-    does not conflict with the syntax of these languages.
+def read_cached_metadata(cache_dir, url):
+    """Returns the metadata of the cached copy of url, or None."""
+    data_name, meta_name = cached_url_names(cache_dir, url)
+    try:
+        with open(meta_name) as meta:
+            metadata = json.load(meta)
+    except (IOError, ValueError):
+        return None
+    return metadata if os.path.exists(data_name) else None
+
+
+def write_cached_metadata(cache_dir, url, metadata):
+    """Saves the metadata of the cached copy of url."""
+    _, meta_name = cached_url_names(cache_dir, url)
+    configutil.write_files([(meta_name, json.dumps(metadata))])
+
+
+class GunzipStream(object):
+    """GunzipStream decompresses a gzip stream as it is read.
+
+    Unlike gzip.GzipFile, the underlying stream does not have to be seekable,
+    e.g. an HTTP response.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        # Add 16 to expect a gzip header and trailer.
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = self.stream.read(FETCH_CHUNK_SIZE)
+            if not chunk:
+                self.buffer += self.decompressor.flush()
+                break
+            self.buffer += self.decompressor.decompress(chunk)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.stream.close()
+
+
+class CachingStream(object):
+    """CachingStream saves a copy of everything read from a stream.
+
+    Data is written to a temporary file in the cache directory. Once the
+    stream is read to the end, the file is renamed to the cached copy and the
+    metadata is saved. If the stream is closed early, the copy is discarded.
+    """
+
+    def __init__(self, stream, cache_dir, url, metadata):
+        self.stream = stream
+        self.cache_dir = cache_dir
+        self.url = url
+        self.metadata = metadata
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, self.tmpname = tempfile.mkstemp(prefix='.fetch.', dir=cache_dir)
+        self.tmp = os.fdopen(fd, 'wb')
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if self.tmp is not None:
+            if data:
+                self.tmp.write(data)
+            if not data or size < 0:
+                self._save()
+        return data
+
+    def _save(self):
+        """Saves the completely read copy in the cache."""
+        self.tmp.close()
+        self.tmp = None
+        data_name, _ = cached_url_names(self.cache_dir, self.url)
+        os.rename(self.tmpname, data_name)
+        write_cached_metadata(self.cache_dir, self.url, self.metadata)
+
+    def close(self):
+        if self.tmp is not None:
+            self.tmp.close()
+            self.tmp = None
+            os.remove(self.tmpname)
+        self.stream.close()
+
+
+def open_url(url, cache_dir=None, max_age=0, timeout=FETCH_TIMEOUT,
+             retries=FETCH_RETRIES, backoff=FETCH_BACKOFF):
+    """Opens url, reusing a cached copy while it is current.
+
+    file:// URLs are read directly. For other URLs, a copy cached in cache_dir
+    younger than max_age seconds is returned without contacting the server.
+    Otherwise, the request includes the saved ETag and Last-Modified values,
+    so an unchanged document is not downloaded again. Failed requests are
+    retried, waiting backoff, 2*backoff, ... seconds. A new document is
+    returned as it downloads, and is cached once it is read to the end.
+
+    Args:
+        url: str, the URL of the document.
+        cache_dir: str, directory of cached documents. When empty, nothing is
+            cached.
+        max_age: int, seconds a cached copy is used without revalidation.
+        timeout: int, seconds to wait for the server.
+        retries: int, the number of times a failed request is retried.
+        backoff: int, seconds to wait before the first retry.
+
+    Returns:
+        file-like object, the document content, with read() and close().
+
+    Raises:
+        urllib2.URLError, the document could not be fetched.
     """
+    if url.startswith('file://'):
+        return open(urllib2.url2pathname(url[len('file://'):]), 'rb')
+
+    metadata = None
+    if cache_dir:
+        metadata = read_cached_metadata(cache_dir, url)
+    if metadata is not None and time.time() - metadata['fetched'] < max_age:
+        return open(cached_url_names(cache_dir, url)[0], 'rb')
+
+    request = urllib2.Request(url, headers={'Accept-Encoding': 'gzip'})
+    if metadata is not None:
+        if metadata.get('etag'):
+            request.add_header('If-None-Match', metadata['etag'])
+        if metadata.get('last_modified'):
+            request.add_header('If-Modified-Since', metadata['last_modified'])
+
+    for attempt in range(retries + 1):
+        try:
+            response = urllib2.urlopen(request, timeout=timeout)
+            break
+        except urllib2.HTTPError as err:
+            if err.code == 304 and metadata is not None:
+                metadata['fetched'] = time.time()
+                write_cached_metadata(cache_dir, url, metadata)
+                return open(cached_url_names(cache_dir, url)[0], 'rb')
+            if err.code < 500 or attempt == retries:
+                raise
+        except (urllib2.URLError, socket.error) as err:
+            if attempt == retries:
+                raise
+        logging.warning('Fetching %s failed, retrying: %s', url, err)
+        time.sleep(backoff * 2 ** attempt)
+
+    stream = response
+    if response.info().get('Content-Encoding') == 'gzip':
+        stream = GunzipStream(response)
+    if cache_dir:
+        stream = CachingStream(stream, cache_dir, url, {
+            'etag': response.info().get('ETag'),
+            'last_modified': response.info().get('Last-Modified'),
+            'fetched': time.time(),
+        })
+    return stream
+
 
-    delimiter = '{{'
-    pattern = r'''
-        \{\{(?:
-        (?P<escaped>\{\{)|
-        (?P<named>[_a-z][_a-z0-9]*)\}\}|
-        (?P<braced>[_a-z][_a-z0-9]*)\}\}|
-        (?P<invalid>)
-        )'''
-
-    # TODO(#116): Delete this class and local definition of safe_substitute once
-    # the resolution for http://bugs.python.org/issue17078 is in all
-    # contemporary python packages.
-    class _multimap:
-        """Helper class for combining multiple mappings.
-
-        Used by .{safe_,}substitute() to combine the mapping and keyword
-        arguments.
-        """
-        def __init__(self, primary, secondary):
-            self._primary = primary
-            self._secondary = secondary
-
-        def __getitem__(self, key):
+def fetch_url(url, *args, **kwargs):
+    """Returns the content of url. Arguments are the same as open_url."""
+    stream = open_url(url, *args, **kwargs)
+    try:
+        return stream.read()
+    finally:
+        stream.close()
+
+
+def iter_json_array(stream):
+    """Parses a JSON array from stream, yielding each element once complete.
+
+    Only one element, and the unparsed text after it, is kept in memory. So,
+    large documents are processed in constant memory and the first element is
+    available before the whole stream is read.
+
+    Args:
+        stream: file-like object, contains a JSON array.
+
+    Yields:
+        the decoded elements of the array.
+
+    Raises:
+        ValueError, the stream does not contain a JSON array.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    started = False
+    eof = False
+    while True:
+        pos = JSON_SEPARATORS.match(buf, pos).end()
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('Expected a JSON array')
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
             try:
-                return self._primary[key]
-            except KeyError:
-                return self._secondary[key]
-
-    def safe_substitute(self, *args, **kws):
-        if len(args) > 1:
-            raise TypeError('Too many positional arguments')
-        if not args:
-            mapping = kws
-        elif kws:
-            mapping = BracketTemplate._multimap(kws, args[0])
-        else:
-            mapping = args[0]
-        # Helper function for .sub()
-        def convert(mo):
-            named = mo.group('named') or mo.group('braced')
-            if named is not None:
-                try:
-                    # We use this idiom instead of str() because the latter
-                    # will fail if val is a Unicode containing non-ASCII
-                    return '%s' % (mapping[named],)
-                except KeyError:
-                    return mo.group()
-            if mo.group('escaped') is not None:
-                return self.delimiter
-            if mo.group('invalid') is not None:
-                return mo.group()
-            raise ValueError('Unrecognized named group in pattern',
-                             self.pattern)
-        return self.pattern.sub(convert, self.template)
+                element, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # The element is incomplete. Read more, unless at the end.
+                if eof:
+                    raise
+            else:
+                yield element
+                pos = end
+                continue
+        elif eof:
+            raise ValueError('Unexpected end of JSON array')
+        chunk = stream.read(FETCH_CHUNK_SIZE)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
 
 
 def usage():
@@ -109,10 +280,25 @@ EXAMPLES:
         --label service=machine_online \
         --select=".*lga0t.*"
 
+    mlabconfig.py --format=prom-targets-nodes \
+        --template_target={{hostname}}:806 \
+        --label module=ssh_v4_online \
+        --label service=machine_online \
+        --select_file=production_patterns.txt
+      (select hostnames matching any line of production_patterns.txt)
+
     mlabconfig.py --format=prom-targets-sites \
         --template_target=s1.{{sitename}}.measurement-lab.org \
         --label service=snmp \
         --label __exporter_project=sandbox
+
+    mlabconfig.py --format=prom-targets-nodes --sites_max_age=600 ...
+      (reuse the cached sites configuration for ten minutes, e.g. across all
+       formats generated by one pipeline run)
+
+    mlabconfig.py --format=prom-targets-nodes \
+        --sites=file:///path/to/sites.json ...
+      (read a local copy of the sites configuration)
 """
 
 
@@ -126,7 +312,38 @@ def parse_flags():
         metavar='sites',
         dest='sites',
         default='https://siteinfo.mlab-oti.measurementlab.net/v1/sites/sites.json',
-        help='The URL of sites configuration.')
+        help=('The URL of sites configuration. Use a file:// URL to read a '
+              'local copy.'))
+    parser.add_option(
+        '',
+        '--sites_cache',
+        dest='sites_cache',
+        default=SITES_CACHE_DIR,
+        help=('Directory where the sites configuration is cached between '
+              'runs. Set to "" to disable the cache.'))
+    parser.add_option(
+        '',
+        '--sites_max_age',
+        dest='sites_max_age',
+        type='int',
+        default=0,
+        help=('Seconds that a cached sites configuration is used without '
+              'asking the server whether it changed. Use this to share one '
+              'copy across all formats generated in one pipeline run.'))
+    parser.add_option(
+        '',
+        '--sites_timeout',
+        dest='sites_timeout',
+        type='int',
+        default=FETCH_TIMEOUT,
+        help='Seconds to wait for the sites configuration server.')
+    parser.add_option(
+        '',
+        '--sites_retries',
+        dest='sites_retries',
+        type='int',
+        default=FETCH_RETRIES,
+        help='Number of times a failed sites configuration fetch is retried.')
     parser.add_option('',
                       '--format',
                       metavar='format',
@@ -189,6 +406,15 @@ def parse_flags():
         default=None,
         help=('A regular expression used to select a subset of hostnames. If '
               'not specified, all machine names are selected.'))
+    parser.add_option(
+        '',
+        '--select_file',
+        dest='select_file',
+        action='append',
+        default=[],
+        help=('A file with one hostname, site name or regular expression per '
+              'line. Selects hostnames that match any line, and --select if '
+              'given. May be repeated.'))
     parser.add_option(
         '',
         '--physical',
@@ -224,6 +450,51 @@ def parse_flags():
     return (options, args)
 
 
+# Compact records with only the siteinfo fields used by this module. The v4
+# and v6 dicts are kept whole, because all their fields are available to
+# server-network-config templates.
+SiteRecord = collections.namedtuple('SiteRecord', ['name', 'type', 'nodes'])
+NodeRecord = collections.namedtuple(
+    'NodeRecord', ['hostname', 'v4', 'v6', 'experiments'])
+ExperimentRecord = collections.namedtuple(
+    'ExperimentRecord', ['name', 'hostname', 'rsync_modules'])
+
+
+def compact_site(site):
+    """Returns a SiteRecord with the fields used from a siteinfo site."""
+    nodes = []
+    for node in site['nodes']:
+        experiments = tuple(
+            ExperimentRecord(e['name'], e['hostname'],
+                             tuple(e.get('rsync_modules') or ()))
+            for e in node['experiments'])
+        nodes.append(NodeRecord(node['hostname'], node['v4'], node['v6'],
+                                experiments))
+    return SiteRecord(site['name'], site['annotations']['type'], tuple(nodes))
+
+
+def iter_sites(stream):
+    """Yields a SiteRecord for every site in a siteinfo sites.json stream."""
+    for site in iter_json_array(stream):
+        yield compact_site(site)
+    # Read to the end, so a CachingStream saves the complete document.
+    stream.read()
+
+
+def dump_records(records, output):
+    """Writes records as a JSON list, as each record becomes available.
+
+    The output is identical to json.dump(list(records), output, indent=4).
+    """
+    encoder = json.JSONEncoder(indent=4)
+    separator = '[\n    '
+    for record in records:
+        output.write(separator)
+        output.write(encoder.encode(record).replace('\n', '\n    '))
+        separator = encoder.item_separator + '\n    '
+    output.write('[]' if separator.startswith('[') else '\n]')
+
+
 # TODO(soltesz): this function is too specific to node network configuration.
 # Replace this function with a more general interface for accessing
 # configuration information for a site, node, slice, or otherwise.
@@ -254,7 +525,7 @@ def export_mlab_server_network_config(output, sites, name_tmpl, input_tmpl,
 
     Args:
         output: open file for writing, progress messages are written here.
-        sites: list of siteinfo site objects, used to enumerate nodes.
+        sites: iterable of SiteRecord, used to enumerate nodes.
         name_tmpl: str, the name of an output file as a template.
         input_tmpl: open file for reading, contains the template content.
         select_regex: str, a regular expression used to select node hostnames.
@@ -264,41 +535,48 @@ def export_mlab_server_network_config(output, sites, name_tmpl, input_tmpl,
     Raises:
         IOError, could not create or write to a file.
     """
-    template = BracketTemplate(input_tmpl.read())
-    output_name = BracketTemplate(name_tmpl)
+    template = configutil.CompiledTemplate(input_tmpl.read())
+    output_name = configutil.CompiledTemplate(name_tmpl)
+    select = configutil.compile_select(select_regex)
+    files = []
     for site in sites:
-        if only_physical and site['annotations']['type'] != 'physical':
+        if only_physical and site.type != 'physical':
             continue
-        for node in site['nodes']:
+        for node in site.nodes:
             # TODO(soltesz): support multiple (or all) object types.
-            if select_regex and not re.search(select_regex, node['hostname']):
+            if select and not select.search(node.hostname):
                 continue
             # Add 'hostname' so that it is available to templates.
-            i = {'hostname': node['hostname']}
+            i = {'hostname': node.hostname}
             # Get IPv4 settings.
-            i.update({'ipv4_' + k: node['v4'][k] for k in node['v4']})
-            i['ipv4_enabled'] = 'true' if node['v4']['ip'] else 'false'
+            i.update({'ipv4_' + k: v for k, v in node.v4.iteritems()})
+            i['ipv4_enabled'] = 'true' if node.v4['ip'] else 'false'
             i['ipv4_address'] = i['ipv4_ip']
             # Add IPv6 settings.
-            i.update({'ipv6_' + k: node['v6'][k] for k in node['v6']})
-            i['ipv6_enabled'] = 'true' if node['v6']['ip'] else 'false'
+            i.update({'ipv6_' + k: v for k, v in node.v6.iteritems()})
+            i['ipv6_enabled'] = 'true' if node.v6['ip'] else 'false'
             i['ipv6_address'] = i['ipv6_ip']
             # Add extra provided labels.
             i.update(labels)
-            filename = output_name.safe_substitute(i)
-            with open(filename, 'w') as f:
-                output.write("%s\n" % filename)
-                f.write(template.safe_substitute(i))
+            filename = output_name.render(i)
+            output.write("%s\n" % filename)
+            files.append((filename, template.render(i)))
+    configutil.write_files(files)
+
+
+def select_prometheus_experiment_targets(*args):
+    """Returns a list of iter_prometheus_experiment_targets(*args)."""
+    return list(iter_prometheus_experiment_targets(*args))
 
 
-def select_prometheus_experiment_targets(sites, select_regex,
-                                         target_templates, common_labels,
-                                         rsync_only, use_flatnames,
-                                         decoration, only_physical):
+def iter_prometheus_experiment_targets(sites, select_regex, target_templates,
+                                       common_labels, rsync_only,
+                                       use_flatnames, decoration,
+                                       only_physical):
     """Selects and formats targets from experiments.
 
     Args:
-      sites: list of siteinfo site objects, used to enumerate experiments.
+      sites: iterable of SiteRecord, used to enumerate experiments.
       select_regex: str, a regex used to choose a subset of hostnames. Ignored
           if empty.
       target_templates: list of templates for formatting the target(s) from the
@@ -311,55 +589,59 @@ def select_prometheus_experiment_targets(sites, select_regex,
           (e.g., mlab1v6.abc01).
       only_physical: bool, whether to restrict targets to physical sites.
 
-    Returns:
-      list of dict, each element is a dict with 'labels' (a dict of key/values)
-          and 'targets' (a list of targets).
+    Yields:
+      dict, with 'labels' (a dict of key/values) and 'targets' (a list of
+          targets).
     """
-    records = []
+    templates = [configutil.CompiledTemplate(tmpl)
+                 for tmpl in target_templates]
+    select = configutil.compile_select(select_regex)
+    common_labels = tuple(common_labels.items())
     for site in sites:
-        if only_physical and site['annotations']['type'] != 'physical':
+        if only_physical and site.type != 'physical':
             continue
-        for node in site['nodes']:
-            for experiment in node['experiments']:
-                labels = common_labels.copy()
-                labels['experiment'] = experiment['name']
-                labels['machine'] = node['hostname']
+        for node in site.nodes:
+            for experiment in node.experiments:
+                labels = dict(common_labels, experiment=experiment.name,
+                              machine=node.hostname)
 
                 # Skip if rsync_only is true but the experiment has no modules.
-                if rsync_only and not experiment['rsync_modules']:
+                if rsync_only and not experiment.rsync_modules:
                     continue
 
                 # Skip if the given regex doesn't match the experiment hostname.
-                if select_regex and \
-                    not re.search(select_regex, experiment['hostname']):
+                if select and not select.search(experiment.hostname):
                     continue
 
                 # Add decoration, if needed.
-                prefix = experiment['hostname'][:len(experiment['name'])+6]
-                suffix = experiment['hostname'][len(experiment['name'])+6:]
+                prefix = experiment.hostname[:len(experiment.name)+6]
+                suffix = experiment.hostname[len(experiment.name)+6:]
                 hostname = prefix + decoration + suffix
 
                 if use_flatnames:
                     hostname = hostname.replace('.', '-', 3)
 
                 targets = []
-                for tmpl in target_templates:
-                    target_tmpl = BracketTemplate(tmpl)
-                    target = target_tmpl.safe_substitute({'hostname': hostname})
+                for tmpl in templates:
+                    target = tmpl.render({'hostname': hostname})
                     targets.append(target)
-                records.append({
+                yield {
                     'labels': labels,
                     'targets': targets,
-                })
-    return records
+                }
+
 
+def select_prometheus_node_targets(*args):
+    """Returns a list of iter_prometheus_node_targets(*args)."""
+    return list(iter_prometheus_node_targets(*args))
 
-def select_prometheus_node_targets(sites, select_regex, target_templates,
-                                   common_labels, decoration, only_physical):
+
+def iter_prometheus_node_targets(sites, select_regex, target_templates,
+                                 common_labels, decoration, only_physical):
     """Selects and formats targets from site nodes.
 
     Args:
-      sites: list of siteinfo site objects, used to enumerate nodes.
+      sites: iterable of SiteRecord, used to enumerate nodes.
       select_regex: str, a regex used to choose a subset of hostnames. Ignored
           if empty.
       target_templates: list of templates for formatting the target(s) from the
@@ -369,42 +651,47 @@ def select_prometheus_node_targets(sites, select_regex, target_templates,
           (e.g., mlab1v6.abc01).
       only_physical: bool, whether to restrict targets to physical sites.
 
-    Returns:
-      list of dict, each element is a dict with 'labels' (a dict of key/values)
-          and 'targets' (a list of targets).
+    Yields:
+      dict, with 'labels' (a dict of key/values) and 'targets' (a list of
+          targets).
     """
-    records = []
+    templates = [configutil.CompiledTemplate(tmpl)
+                 for tmpl in target_templates]
+    select = configutil.compile_select(select_regex)
+    common_labels = tuple(common_labels.items())
     for site in sites:
-        if only_physical and site['annotations']['type'] != 'physical':
+        if only_physical and site.type != 'physical':
             continue
-        for node in site['nodes']:
-            if select_regex and not re.search(select_regex, node['hostname']):
+        for node in site.nodes:
+            if select and not select.search(node.hostname):
                 continue
-            labels = common_labels.copy()
-            labels['machine'] = node['hostname']
+            labels = dict(common_labels, machine=node.hostname)
             targets = []
 
-            prefix = node['hostname'][:5]
-            suffix = node['hostname'][5:]
+            prefix = node.hostname[:5]
+            suffix = node.hostname[5:]
             hostname = prefix + decoration + suffix
 
-            for tmpl in target_templates:
-                target_tmpl = BracketTemplate(tmpl)
-                target = target_tmpl.safe_substitute({'hostname': hostname})
+            for tmpl in templates:
+                target = tmpl.render({'hostname': hostname})
                 targets.append(target)
-            records.append({
+            yield {
                 'labels': labels,
                 'targets': targets,
-            })
-    return records
+            }
 
 
-def select_prometheus_site_targets(sites, select_regex, target_templates,
-                                   common_labels, only_physical):
+def select_prometheus_site_targets(*args):
+    """Returns a list of iter_prometheus_site_targets(*args)."""
+    return list(iter_prometheus_site_targets(*args))
+
+
+def iter_prometheus_site_targets(sites, select_regex, target_templates,
+                                 common_labels, only_physical):
     """Selects and formats site targets.
 
     Args:
-      sites: list of siteinfo site objects, used to enumerate nodes.
+      sites: iterable of SiteRecord, used to enumerate sites.
       select_regex: str, a regex used to choose a subset of hostnames. Ignored
           if empty.
       target_templates: list of templates for formatting the target(s) from the
@@ -412,34 +699,41 @@ def select_prometheus_site_targets(sites, select_regex, target_templates,
       common_labels: dict of str, a set of labels to apply to all targets.
       only_physical: bool, whether to restrict targets to physical sites.
 
-    Returns:
-      list of dict, each element is a dict with 'labels' (a dict of key/values)
-          and 'targets' (a list of targets).
+    Yields:
+      dict, with 'labels' (a dict of key/values) and 'targets' (a list of
+          targets).
     """
-    records = []
+    templates = [configutil.CompiledTemplate(tmpl)
+                 for tmpl in target_templates]
+    select = configutil.compile_select(select_regex)
+    common_labels = tuple(common_labels.items())
     for site in sites:
-        if select_regex and not re.search(select_regex, site['name']):
+        if select and not select.search(site.name):
             continue
-        if only_physical and site['annotations']['type'] != 'physical':
+        if only_physical and site.type != 'physical':
             continue
-        labels = common_labels.copy()
-        labels['site'] = site['name']
+        labels = dict(common_labels, site=site.name)
         targets = []
-        for tmpl in target_templates:
-            target_tmpl = BracketTemplate(tmpl)
-            target = target_tmpl.safe_substitute({'sitename': site['name']})
+        for tmpl in templates:
+            target = tmpl.render({'sitename': site.name})
             targets.append(target)
-        records.append({
+        yield {
             'labels': labels,
             'targets': targets,
-        })
-    return records
+        }
 
 
 def main():
     (options, _) = parse_flags()
+    options.select = configutil.compile_select(options.select,
+                                               options.select_file)
 
-    sites = json.loads(urllib2.urlopen(options.sites).read())
+    # Sites are parsed as they are downloaded, so that targets are written
+    # before the whole sites configuration is read.
+    stream = open_url(options.sites, options.sites_cache,
+                      options.sites_max_age, options.sites_timeout,
+                      options.sites_retries)
+    sites = iter_sites(stream)
 
     if options.format == 'server-network-config':
         with open(options.template_input) as template:
@@ -448,23 +742,23 @@ def main():
                 options.labels, options.physical)
 
     elif options.format == 'prom-targets':
-        records = select_prometheus_experiment_targets(
+        records = iter_prometheus_experiment_targets(
             sites, options.select, options.template_target,
             options.labels, options.rsync, options.use_flatnames,
             options.decoration, options.physical)
-        json.dump(records, sys.stdout, indent=4)
+        dump_records(records, sys.stdout)
 
     elif options.format == 'prom-targets-nodes':
-        records = select_prometheus_node_targets(
+        records = iter_prometheus_node_targets(
             sites, options.select, options.template_target, options.labels,
             options.decoration, options.physical)
-        json.dump(records, sys.stdout, indent=4)
+        dump_records(records, sys.stdout)
 
     elif options.format == 'prom-targets-sites':
-        records = select_prometheus_site_targets(
+        records = iter_prometheus_site_targets(
             sites, options.select, options.template_target, options.labels,
             options.physical)
-        json.dump(records, sys.stdout, indent=4)
+        dump_records(records, sys.stdout)
     elif options.format == 'hostips':
         # TODO: Added temporarily to work-around-dependency in script-exporter-support.
         # TODO: Remove after script-exporter-support no longer depends on this.
@@ -1,12 +1,21 @@
 """Tests for mlabconfig."""
 
+import BaseHTTPServer
+import configutil
 import contextlib
+import gzip
+import json
 import logging
 import mlabconfig
 import mock
+import os
 from planetlab import model
+import shutil
 import StringIO
+import tempfile
+import threading
 import unittest
+import urllib2
 
 
 @contextlib.contextmanager
@@ -35,41 +44,169 @@ def OpenStringIO(sio):
         pass
 
 
-class BracketTemplateTest(unittest.TestCase):
+class FakeSiteinfoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the server's document with an ETag after the failures."""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if server.failures:
+            server.failures -= 1
+            self.send_error(503)
+            return
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = server.document
+        self.send_response(200)
+        self.send_header('ETag', server.etag)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressed = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+                f.write(body)
+            body = compressed.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchUrlTest(unittest.TestCase):
 
     def setUp(self):
-        self.vars = {'var1': 'Spot', 'var2': 'Dog'}
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                FakeSiteinfoHandler)
+        self.server.requests = []
+        self.server.failures = 0
+        self.server.etag = '"v1"'
+        self.server.document = '[{"name": "abc01"}]'
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d/sites.json' % self.server.server_port
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        logging.disable(logging.ERROR)
+
+    def test_fetch_url_decompresses_document(self):
+        content = mlabconfig.fetch_url(self.url, self.cache_dir)
+
+        self.assertEqual(content, self.server.document)
+        self.assertIn('gzip', self.server.requests[0]['accept-encoding'])
+
+    def test_fetch_url_when_unchanged_uses_cached_copy(self):
+        mlabconfig.fetch_url(self.url, self.cache_dir)
+        self.server.document = 'changed, but with the same ETag'
+
+        content = mlabconfig.fetch_url(self.url, self.cache_dir)
 
-    def test_substitute_when_template_is_correct(self):
-        tmpl = mlabconfig.BracketTemplate('{{var1}} is a {{var2}}')
+        self.assertEqual(content, '[{"name": "abc01"}]')
+        self.assertEqual(self.server.requests[1]['if-none-match'], '"v1"')
 
-        actual = tmpl.safe_substitute(self.vars)
+    def test_fetch_url_when_cache_is_fresh_skips_request(self):
+        mlabconfig.fetch_url(self.url, self.cache_dir)
 
-        self.assertEqual(actual, 'Spot is a Dog')
+        content = mlabconfig.fetch_url(self.url, self.cache_dir, max_age=60)
 
-    def test_substitute_when_template_is_broken(self):
-        tmpl = mlabconfig.BracketTemplate('var1}} is a {{var2')
+        self.assertEqual(content, self.server.document)
+        self.assertEqual(len(self.server.requests), 1)
 
-        actual = tmpl.safe_substitute(self.vars)
+    @mock.patch.object(mlabconfig.time, 'sleep')
+    def test_fetch_url_retries_server_errors(self, mock_sleep):
+        self.server.failures = 2
+
+        content = mlabconfig.fetch_url(self.url, self.cache_dir, retries=2)
+
+        self.assertEqual(content, self.server.document)
+        self.assertEqual(len(self.server.requests), 3)
+        # NOTE: threading also calls the patched sleep, so only check the first.
+        self.assertEqual(mock_sleep.call_args_list[:2], [mock.call(1),
+                                                         mock.call(2)])
+
+    @mock.patch.object(mlabconfig.time, 'sleep')
+    def test_fetch_url_when_retries_are_exhausted_raises(self, mock_sleep):
+        self.server.failures = 2
+
+        with self.assertRaises(urllib2.HTTPError):
+            mlabconfig.fetch_url(self.url, self.cache_dir, retries=1)
+
+    def test_open_url_caches_document_once_read(self):
+        stream = mlabconfig.open_url(self.url, self.cache_dir)
+        self.assertEqual(os.listdir(self.cache_dir)[0][:7], '.fetch.')
+
+        content = stream.read()
+        stream.close()
+
+        self.assertEqual(content, self.server.document)
+        self.assertEqual(
+            mlabconfig.fetch_url(self.url, self.cache_dir, max_age=60),
+            self.server.document)
+        self.assertEqual(len(self.server.requests), 1)
 
-        self.assertEqual(actual, 'var1}} is a {{var2')
+    def test_fetch_url_reads_file_url(self):
+        filename = os.path.join(self.cache_dir, 'sites.json')
+        with open(filename, 'w') as f:
+            f.write('[]')
 
-    def test_substitute_when_template_is_shell(self):
-        tmpl1 = mlabconfig.BracketTemplate('$var1 == {{var1}}')
-        tmpl2 = mlabconfig.BracketTemplate('${var2} == {{var2}}')
+        content = mlabconfig.fetch_url('file://' + filename, self.cache_dir)
 
-        actual1 = tmpl1.safe_substitute(self.vars)
-        actual2 = tmpl2.safe_substitute(self.vars)
+        self.assertEqual(content, '[]')
+        self.assertEqual(self.server.requests, [])
 
-        self.assertEqual(actual1, '$var1 == Spot')
-        self.assertEqual(actual2, '${var2} == Dog')
 
-    def test_substitute_without_value_returns_unchanged_template(self):
-        tmpl = mlabconfig.BracketTemplate('{{evaluated}} {{unevaluated}}')
+class StreamingTest(unittest.TestCase):
 
-        actual = tmpl.safe_substitute({'evaluated': 'okay'})
+    @mock.patch.object(mlabconfig, 'FETCH_CHUNK_SIZE', 5)
+    def test_iter_json_array_yields_elements_across_chunks(self):
+        stream = StringIO.StringIO(' [{"name": "abc01"},\n {"name": "xyz02"}] ')
+
+        elements = list(mlabconfig.iter_json_array(stream))
+
+        self.assertEqual(elements, [{'name': 'abc01'}, {'name': 'xyz02'}])
+
+    def test_iter_json_array_yields_before_reading_everything(self):
+        stream = StringIO.StringIO('[{"name": "abc01"}, ' + ' ' * 200000)
+
+        elements = mlabconfig.iter_json_array(stream)
+
+        self.assertEqual(next(elements), {'name': 'abc01'})
+        self.assertLess(stream.tell(), 200000)
+
+    def test_iter_json_array_when_truncated_raises(self):
+        stream = StringIO.StringIO('[{"name": "abc01"}, {"name"')
+
+        with self.assertRaises(ValueError):
+            list(mlabconfig.iter_json_array(stream))
+
+    def test_dump_records_matches_json_dump(self):
+        records = [{'labels': {'machine': 'mlab1'}, 'targets': ['a', 'b']},
+                   {'labels': {}, 'targets': []}]
+        for count in range(len(records) + 1):
+            output = StringIO.StringIO()
+
+            mlabconfig.dump_records(iter(records[:count]), output)
+
+            self.assertEqual(output.getvalue(),
+                             json.dumps(records[:count], indent=4))
+
+    def test_compact_site(self):
+        site = mlabconfig.compact_site(sites[0])
+
+        self.assertEqual(site.name, 'abc01')
+        self.assertEqual(site.type, 'physical')
+        self.assertEqual(site.nodes[0].hostname,
+                         'mlab1.abc01.measurement-lab.org')
+        self.assertEqual(site.nodes[0].experiments, (
+            mlabconfig.ExperimentRecord(
+                'bar.abc', 'bar.abc.mlab1.abc01.measurement-lab.org', ()),))
 
-        self.assertEqual(actual, 'okay {{unevaluated}}')
 
 sites = [
    {
@@ -151,7 +288,7 @@ class MlabconfigTest(unittest.TestCase):
 
     def setUp(self):
         self.users = [('User', 'Name', 'username@gmail.com')]
-        self.sites = sites
+        self.sites = [mlabconfig.compact_site(site) for site in sites]
         self.attrs = [model.Attr('MeasurementLabCentos', disk_max='60000000')]
         # Turn off logging output during testing (unless CRITICAL).
         logging.disable(logging.ERROR)
@@ -166,20 +303,18 @@ class MlabconfigTest(unittest.TestCase):
         for unexpected in unexpected_items:
             self.assertNotIn(unexpected, results)
 
-    @mock.patch('__builtin__.open')
-    def test_export_mlab_server_network_config(self, mock_open):
+    @mock.patch.object(configutil, 'write_file')
+    def test_export_mlab_server_network_config(self, mock_write_file):
         stdout = StringIO.StringIO()
         name_tmpl = '{{hostname}}-foo.ipxe'
         input_tmpl = StringIO.StringIO('ip={{ipv4_address}} ; echo ${ip} {{extra}}')
-        file_output = StringIO.StringIO()
-        mock_open.return_value = OpenStringIO(file_output)
-
         mlabconfig.export_mlab_server_network_config(
             stdout, self.sites, name_tmpl, input_tmpl, 'mlab1.abc01',
             {'extra': 'value'}, False)
 
-        self.assertEqual(
-            file_output.getvalue(), 'ip=192.168.1.9 ; echo ${ip} value')
+        mock_write_file.assert_called_once_with(
+            'mlab1.abc01.measurement-lab.org-foo.ipxe',
+            'ip=192.168.1.9 ; echo ${ip} value', mock.ANY)
 
     def test_select_prometheus_experiment_targets_includes_all_experiments(
         self):
@@ -1,9 +1,17 @@
 #!/usr/bin/python
 
+import collections
 import pprint
 
 MLAB_ORG_DOMAIN = 'measurement-lab.org'
 
+# AddressPlanIPv4 holds every IPv4 address assigned to one node at a site.
+AddressPlanIPv4 = collections.namedtuple(
+    'AddressPlanIPv4', ['interface', 'ip', 'iplist', 'drac', 'gateway'])
+# AddressPlanIPv6 holds every IPv6 address assigned to one node at a site.
+AddressPlanIPv6 = collections.namedtuple(
+    'AddressPlanIPv6', ['ip', 'iplist', 'gateway'])
+
 
 def breakdown(host_index, v4prefix):
     octet_list = v4prefix.split('.')
@@ -64,6 +72,39 @@ def pl_dracip(host_index, v4prefix):
 def pl_v6gw(v6prefix, v6gw=None):
     return v6prefix + "1" if v6gw is None else v6gw
 
+def legacy_order(name, index, ip_list):
+    """Returns ip_list re-ordered by Network.legacy_network_remap, if present."""
+    if (Network.legacy_network_remap is not None and
+        name in Network.legacy_network_remap and
+        index in Network.legacy_network_remap[name]):
+        index_list = Network.legacy_network_remap[name][index].split(",")
+        return [ ip_list[int(i)] for i in index_list ]
+    return ip_list
+
+def check_collisions(plans, index, plan):
+    """Raises an Exception if plan reuses an address from itself or plans.
+
+    Args:
+        plans: dict of int to AddressPlanIPv4 or AddressPlanIPv6, the plans of
+            other nodes on the same network.
+        index: int, the host index of the node using plan.
+        plan: AddressPlanIPv4 or AddressPlanIPv6, the new plan.
+    """
+    addresses = [plan.ip] + list(plan.iplist)
+    if hasattr(plan, 'drac'):
+        addresses.append(plan.drac)
+    if len(set(addresses)) != len(addresses):
+        raise Exception("duplicate address in plan for host %s: %s" %
+                        (index, addresses))
+    for other_index, other in plans.iteritems():
+        used = set([other.ip] + list(other.iplist))
+        if hasattr(other, 'drac'):
+            used.add(other.drac)
+        collisions = used.intersection(addresses)
+        if collisions:
+            raise Exception("hosts %s and %s both use addresses: %s" %
+                            (other_index, index, sorted(collisions)))
+
 class Location(dict):
     def __init__(self, city, country, lat, lon, **kwargs):
         self['city'] = city
@@ -133,6 +174,25 @@ class NetworkIPv6(dict):
             raise Exception("'v6gw' is a mandatory argument. Can be None.")
 
         super(NetworkIPv6, self).__init__(**kwargs)
+        self._plans = {}
+
+    def plan(self, index):
+        """Returns the AddressPlanIPv6 for the host index.
+
+        The plan is computed once, with the legacy_network_remap applied.
+        """
+        if index not in self._plans:
+            last_octet = int(self['last_octet'])
+            iplist = legacy_order(
+                self['name'], index,
+                pl_v6_iplist(index, self['prefix'], last_octet))
+            plan = AddressPlanIPv6(
+                ip=pl_v6_primary(index, self['prefix'], last_octet),
+                iplist=tuple(iplist),
+                gateway=pl_v6gw(self['prefix'], self['v6gw']))
+            check_collisions(self._plans, index, plan)
+            self._plans[index] = plan
+        return self._plans[index]
 
     def interface(self, index):
         """Returns a dict of typical interface values for IPv6."""
@@ -152,24 +212,13 @@ class NetworkIPv6(dict):
     def ipv6addr(self, host_index):
         """ Returns the host IPv6 address for the host_index node; host_index
         should be less than 4, the maximum number of nodes at a site."""
-        return pl_v6_primary(host_index, self['prefix'], 
-                             int(self['last_octet']))
+        return self.plan(host_index).ip
 
     def ipv6addr_secondaries(self, index):
-        """ Returns a list of 12 IPv6 addresses assigned to given host_index """
+        """ Returns a tuple of 12 IPv6 addresses assigned to given host_index """
         # NOTE: the natural, sorted order is re-ordered according to 
         #       legacy_network_remap if present.
-        ipv6_list = pl_v6_iplist(index, self['prefix'], int(self['last_octet']))
-        if ( Network.legacy_network_remap is not None and 
-             self['name'] in Network.legacy_network_remap and
-             index in Network.legacy_network_remap[self['name']] ):
-
-            site = self['name']
-            index_list = Network.legacy_network_remap[site][index].split(",")
-            re_order = [ ipv6_list[int(i)] for i in index_list ]
-            return re_order
-            
-        return ipv6_list
+        return self.plan(index).iplist
 
 class NetworkIPv4(dict):
     """The NetworkIPv4() object encapsulates the IP and network settings for an
@@ -186,27 +235,39 @@ class NetworkIPv4(dict):
             msg="'prefix' is a mandatory argument. i.e.  192.168.10.0"
             raise Exception(msg)
         super(NetworkIPv4, self).__init__(**kwargs)
+        self._plans = {}
+
+    def plan(self, index):
+        """Returns the AddressPlanIPv4 for the host index.
+
+        The plan is computed once, with the legacy_network_remap applied.
+        """
+        if index not in self._plans:
+            interface = pl_interface(index, self['prefix'])
+            iplist = legacy_order(self['name'], index,
+                                  pl_iplist(index, self['prefix']))
+            plan = AddressPlanIPv4(
+                interface=interface,
+                ip=interface['ip'],
+                iplist=tuple(iplist),
+                drac=pl_dracip(index, self['prefix']),
+                gateway=interface['gateway'])
+            check_collisions(self._plans, index, plan)
+            self._plans[index] = plan
+        return self._plans[index]
 
     def interface(self, index):
         """ Returns the myPLC interface definition for the given host index"""
-        return pl_interface(index, self['prefix'])
+        # NOTE: return a copy, since callers add their own values.
+        return dict(self.plan(index).interface)
 
     def iplist(self, index):
-        """ Returns a list of 12 IPv4 addresses for the given host index """
-        ip_list = pl_iplist(index, self['prefix'])
-        if (Network.legacy_network_remap is not None and 
-            self['name'] in Network.legacy_network_remap and
-            index in Network.legacy_network_remap[self['name']] ):
-            site = self['name']
-            index_list = Network.legacy_network_remap[site][index].split(",")
-
-            re_order = [ ip_list[int(i)] for i in index_list ]
-            return re_order
-        return ip_list 
+        """ Returns a tuple of 12 IPv4 addresses for the given host index """
+        return self.plan(index).iplist
 
     def drac(self, index):
         """ Returns the IPv4 address reserved for the DRAC interface"""
-        return pl_dracip(index, self['prefix'])
+        return self.plan(index).drac
 
     def last(self):
         """ Returns the last octet of 'prefix' """
@@ -230,6 +291,8 @@ class Site(dict):
             login_base_prefix - a constant prefix for to prepend to 'name' 
                                 (default: mlab).
 
+    The site nodes are sorted once, when the Site() is created. Use
+    sorted_nodes() to iterate over nodes in hostname order.
     """
     def __str__(self):
         return pprint.pformat(self)
@@ -284,10 +347,16 @@ class Site(dict):
                 kwargs['nodes'][n.hostname()] = n
 
         super(Site, self).__init__(**kwargs)
+        self._sorted_nodes = tuple(
+            self['nodes'][hostname] for hostname in sorted(self['nodes']))
 
     def ipv4(self, index=0):
       return ml_site_ipv4(self['net']['v4']['prefix'], index)
 
+    def sorted_nodes(self):
+        """Returns a tuple of the site Node()s, sorted by hostname."""
+        return self._sorted_nodes
+
 
 def makesite(name, v4prefix, v6prefix, city, country, 
              latitude, longitude, user_list, **kwargs):
@@ -403,9 +472,9 @@ class Node(dict):
     def iplistv6(self):
         return self['net']['v6'].ipv6addr_secondaries(self['index'])
     def v4gw(self):
-        return self['net']['v4'].interface(self['index'])['gateway']
+        return self['net']['v4'].plan(self['index']).gateway
     def v6gw(self):
-        return self['net']['v6'].ipv6_defaultgw()
+        return self['net']['v6'].plan(self['index']).gateway
 
     def hostname(self, decoration=''):
         """Returns the Node FQDN."""
@@ -417,7 +486,7 @@ class Node(dict):
 
     def ipv4(self):
         """Returns the Node primary IPv4 address."""
-        return self['net']['v4'].interface(self['index'])['ip']
+        return self['net']['v4'].plan(self['index']).ip
 
     def ipv6(self):
         """Returns the Node primary IPv6 address, if enabled."""
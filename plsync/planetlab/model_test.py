@@ -1,5 +1,6 @@
 """Tests for model."""
 
+import mock
 import model
 import unittest
 
@@ -32,6 +33,45 @@ class ModelTest(unittest.TestCase):
 
         self.assertEqual(expected_ip, ip)
 
+    def test_site_sorted_nodes(self):
+        expected_hostnames = [
+            'mlab1.abc01.measurement-lab.org',
+            'mlab2.abc01.measurement-lab.org',
+            'mlab3.abc01.measurement-lab.org'
+        ]
+        site = self.sites[0]
+
+        hostnames = [node.hostname() for node in site.sorted_nodes()]
+
+        self.assertEqual(expected_hostnames, hostnames)
+
+    def test_network_ipv4_plan(self):
+        net = self.sites[0]['net']['v4']
+
+        plan = net.plan(2)
+
+        self.assertEqual(plan.ip, '192.168.1.22')
+        self.assertEqual(plan.iplist[0], '192.168.1.23')
+        self.assertEqual(len(plan.iplist), 12)
+        self.assertEqual(plan.drac, '192.168.1.5')
+        self.assertEqual(plan.gateway, '192.168.1.1')
+        self.assertIs(plan, net.plan(2))
+
+    def test_network_ipv4_plan_when_remap_reuses_address(self):
+        net = model.NetworkIPv4(prefix='192.168.1.0', name='abc01')
+        remap = {'abc01': {1: '0,0,1,2,3,4,5,6,7,8,9,10'}}
+
+        with mock.patch.object(model.Network, 'legacy_network_remap', remap):
+            with self.assertRaises(Exception):
+                net.plan(1)
+
+    def test_network_ipv4_interface_returns_copy(self):
+        node = self.sites[0]['nodes']['mlab1.abc01.measurement-lab.org']
+
+        node.interface()['hostname'] = 'changed'
+
+        self.assertNotIn('hostname', node.interface())
+
     def test_pcu_hostname(self):
         expected_hostnames = [
             'mlab1d.abc01.measurement-lab.org',
@@ -0,0 +1,116 @@
+"""Bounded fan-out of independent per-node work across threads.
+
+PLC API calls are dominated by network latency, so syncing many nodes at once
+over a pool of connections (see session.API) is much faster than syncing them
+one after another.
+"""
+
+import Queue
+import StringIO
+import sys
+import threading
+
+
+class _ThreadOutput(object):
+    """_ThreadOutput sends writes from worker threads to per-thread buffers.
+
+    Writes from threads without a buffer go directly to the wrapped stream.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, data):
+        buf = getattr(self.local, 'buffer', None)
+        if buf is None:
+            self.stream.write(data)
+        else:
+            buf.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run(func, items, workers):
+    """Calls func(item) for every item using at most workers threads.
+
+    Everything printed by func(item) is buffered and written to stdout in the
+    order of items, so the messages for one node are never interleaved with the
+    messages for another.
+
+    When func raises an exception (including SystemExit), no new items are
+    started. After all running items finish and their output is written, the
+    first exception in item order is re-raised.
+
+    Args:
+        func: callable, called once with each item.
+        items: iterable, the independent work items, e.g. model.Node objects.
+        workers: int, the maximum number of concurrent calls to func. When
+            less than 2, or when called from within func of an outer run(), all
+            items are processed in the calling thread.
+
+    Returns:
+        list, the results of func in the order of items.
+    """
+    items = list(items)
+    if workers < 2 or len(items) < 2 or isinstance(sys.stdout, _ThreadOutput):
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    buffers = [StringIO.StringIO() for _ in items]
+    done = [threading.Event() for _ in items]
+    stop = threading.Event()
+    pending = Queue.Queue()
+    for i in range(len(items)):
+        pending.put(i)
+    output = _ThreadOutput(sys.stdout)
+
+    def worker():
+        while not stop.is_set():
+            try:
+                i = pending.get_nowait()
+            except Queue.Empty:
+                return
+            output.local.buffer = buffers[i]
+            try:
+                results[i] = func(items[i])
+            except BaseException:
+                errors[i] = sys.exc_info()
+                stop.set()
+            finally:
+                output.local.buffer = None
+                done[i].set()
+
+    def flush(i):
+        output.stream.write(buffers[i].getvalue())
+        output.stream.flush()
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(workers, len(items)))]
+    written = 0
+    sys.stdout = output
+    try:
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        while written < len(items) and not stop.is_set():
+            # NOTE: wait with a timeout so that KeyboardInterrupt is delivered.
+            if done[written].wait(0.5):
+                flush(written)
+                written += 1
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        sys.stdout = output.stream
+
+    # After an error, write the output of the items that ran, and skip the
+    # items that were never started.
+    for i in range(written, len(items)):
+        if done[i].is_set():
+            flush(i)
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
@@ -0,0 +1,90 @@
+"""Tests for parallel."""
+
+import parallel
+import StringIO
+import sys
+import threading
+import time
+import unittest
+
+
+class ParallelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def test_run_returns_results_in_order(self):
+        def square(n):
+            # Finish later items first.
+            time.sleep(0.01 * (5 - n))
+            return n * n
+
+        results = parallel.run(square, range(5), 3)
+
+        self.assertEqual(results, [0, 1, 4, 9, 16])
+
+    def test_run_writes_output_in_item_order(self):
+        def report(n):
+            time.sleep(0.01 * (5 - n))
+            print "start", n
+            print "end", n
+
+        parallel.run(report, range(5), 5)
+
+        expected = ''.join('start %d\nend %d\n' % (n, n) for n in range(5))
+        self.assertEqual(sys.stdout.getvalue(), expected)
+
+    def test_run_limits_concurrency_to_workers(self):
+        lock = threading.Lock()
+        active = [0]
+        peak = [0]
+        def work(_):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+
+        parallel.run(work, range(10), 2)
+
+        self.assertEqual(peak[0], 2)
+
+    def test_run_reraises_first_error_after_output(self):
+        def fail(n):
+            print "item", n
+            if n == 1:
+                sys.exit(1)
+
+        self.assertRaises(SystemExit, parallel.run, fail, range(3), 2)
+        self.assertTrue(sys.stdout.getvalue().startswith('item 0\nitem 1\n'))
+
+    def test_run_after_error_skips_unstarted_items_without_waiting(self):
+        def fail(n):
+            if n == 0:
+                raise ValueError('item 0')
+            time.sleep(0.01)
+            print "item", n
+
+        start = time.time()
+        self.assertRaises(ValueError, parallel.run, fail, range(1000), 4)
+        elapsed = time.time() - start
+
+        self.assertLess(elapsed, 1.0)
+        self.assertNotIn('item 999', sys.stdout.getvalue())
+
+    def test_run_nested_runs_inline(self):
+        def outer(n):
+            return parallel.run(lambda m: (n, m), range(2), 4)
+
+        results = parallel.run(outer, range(2), 2)
+
+        self.assertEqual(results, [[(0, 0), (0, 1)], [(1, 0), (1, 1)]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,780 @@
+#!/usr/bin/env python
+"""plcserver is an in-memory stand-in for the PLC XML-RPC API.
+
+plcserver implements the subset of PLCAPI used by sync.py, reconcile.py,
+tools/plcquery.py and tools/get-mlab-sshconfig.py, so that the sync path can
+be run and measured without contacting boot.planet-lab.org.
+
+Objects are kept in a Store. Every request may be delayed by a fixed latency,
+to model the round trip to PLC, and Stats counts the calls, requests and bytes
+of every method.
+
+Example:
+    api = plcserver.PLCAPI()
+    server = plcserver.Server(('localhost', 0), api, latency=0.05)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    plc = xmlrpclib.ServerProxy(server.url(), allow_none=True)
+"""
+
+import base64
+import fnmatch
+import operator
+import os
+import re
+import SimpleXMLRPCServer
+import SocketServer
+import threading
+import time
+import xmlrpclib
+
+# NOTE: PLCAPI fault codes are defined in PLC/Faults.py.
+PLCInvalidMethodCode = 100
+PLCInvalidArgumentCode = 102
+PLCAuthenticationFailureCode = 103
+
+# For each object type: the id field, and the name field that may be used in
+# place of the id. Tags have no name field.
+OBJECT_TYPES = {
+    'interface': ('interface_id', 'ip'),
+    'interface_tag': ('interface_tag_id', None),
+    'node': ('node_id', 'hostname'),
+    'node_tag': ('node_tag_id', None),
+    'nodegroup': ('nodegroup_id', 'groupname'),
+    'pcu': ('pcu_id', 'hostname'),
+    'person': ('person_id', 'email'),
+    'site': ('site_id', 'login_base'),
+    'site_tag': ('site_tag_id', None),
+    'slice': ('slice_id', 'name'),
+    'slice_tag': ('slice_tag_id', None),
+    'tag_type': ('tag_type_id', 'tagname'),
+}
+
+# Fields, other than the name field, that are indexed to find objects without
+# a scan. These are the fields that sync.py filters on most often.
+INDEXED_FIELDS = {
+    'interface': ['node_id'],
+    'interface_tag': ['interface_id'],
+    'node_tag': ['node_id'],
+    'site_tag': ['site_id'],
+    'slice_tag': ['name', 'node_id'],
+}
+
+# For each tag type: the object type that is tagged, its id field, and the
+# field of the tagged object that lists its tags.
+TAG_TYPES = {
+    'interface_tag': ('interface', 'interface_id', 'interface_tag_ids'),
+    'node_tag': ('node', 'node_id', 'node_tag_ids'),
+    'site_tag': ('site', 'site_id', 'site_tag_ids'),
+    'slice_tag': ('slice', 'slice_id', 'slice_tag_ids'),
+}
+
+# Filter keys may start with an operator, e.g. {'>date_created': 0}.
+# NOTE: ']' means >=, '[' means <=.
+FILTER_OPERATORS = {
+    '>': operator.gt,
+    '<': operator.lt,
+    ']': operator.ge,
+    '[': operator.le,
+}
+
+# Tag types that PLC defines, and sync.py expects to exist.
+DEFAULT_TAG_TYPES = [
+    ('city', 'site/location'),
+    ('country', 'site/location'),
+    ('extra', 'site/extra'),
+    ('arch', 'node/config'),
+    ('deployment', 'node/deployment'),
+    ('fcdistro', 'node/config'),
+    ('alias', 'interface/config'),
+    ('ifname', 'interface/config'),
+    ('ipv6_defaultgw', 'interface/ipv6'),
+    ('ipv6addr', 'interface/ipv6'),
+    ('ipv6addr_secondaries', 'interface/ipv6'),
+    ('ovs_bridge', 'interface/ovs'),
+    ('initscript', 'slice/config'),
+    ('interface', 'slice/network'),
+    ('ip_addresses', 'slice/network'),
+    ('vsys', 'slice/vsys'),
+]
+
+# Slices expire after four weeks, unless they are renewed.
+SLICE_LIFETIME = 4*7*24*60*60
+
+METHOD_NAME = re.compile(r'<methodName>([^<]+)</methodName>')
+
+
+# NOTE: match_value(), match_field() and match_object() are also defined in
+# tools/plccache.py. The tools do not import plsync, so keep the two copies
+# the same.
+def match_value(value, pattern):
+    """Returns True if value matches pattern, like PLC filters do.
+
+    Args:
+        value: the value of an object field.
+        pattern: str, int or list, strings may use '*' wildcards. A list
+            matches when any item matches.
+    Returns:
+        bool
+    """
+    if type(pattern) in [type([]), type(())]:
+        return any(match_value(value, p) for p in pattern)
+    if type(value) in [type([]), type(())]:
+        return pattern in value
+    if type(pattern) in (str, unicode) and type(value) in (str, unicode):
+        return fnmatch.fnmatchcase(value.lower(), pattern.lower())
+    return value == pattern
+
+
+def match_field(obj, key, pattern):
+    """Returns True if the field named by the filter key matches pattern.
+
+    Args:
+        obj: dict, a PLC object.
+        key: str, a field name, optionally prefixed by '~' to negate the match
+            or by one of FILTER_OPERATORS to compare the field with pattern.
+        pattern: the filter value for key.
+    Returns:
+        bool
+    """
+    if key.startswith('~'):
+        return not match_field(obj, key[1:], pattern)
+    if key[:1] in FILTER_OPERATORS:
+        value = obj.get(key[1:])
+        # NOTE: like SQL, comparisons with NULL never match.
+        return value is not None and FILTER_OPERATORS[key[:1]](value, pattern)
+    return match_value(obj.get(key), pattern)
+
+
+def match_object(obj, obj_filter, id_field, name_field):
+    """Returns True if obj matches obj_filter, like PLC Get* calls do.
+
+    Args:
+        obj: dict, a PLC object.
+        obj_filter: None, int, str, list or dict. None matches all objects.
+            An int matches the id_field, and a str matches the name_field. A
+            list matches when any item matches. A dict matches when all named
+            fields match; keys starting with '-', e.g. '-SORT', are ignored.
+        id_field: str, name of the object id field, e.g. 'node_id'.
+        name_field: str, name of the object name field, e.g. 'hostname'.
+    Returns:
+        bool
+    """
+    if obj_filter is None:
+        return True
+    if type(obj_filter) in [type([]), type(())]:
+        return any(match_object(obj, f, id_field, name_field)
+                   for f in obj_filter)
+    if type(obj_filter) == dict:
+        return all(match_field(obj, k, v) for k, v in obj_filter.items()
+                   if not k.startswith('-'))
+    if type(obj_filter) in (int, long):
+        return obj[id_field] == obj_filter
+    return name_field is not None and match_value(obj[name_field], obj_filter)
+
+
+def index_key(value):
+    """Returns the key of value in an index; names are not case sensitive."""
+    if type(value) in (str, unicode):
+        return value.lower()
+    return value
+
+
+def is_exact(pattern):
+    """Returns True if pattern only matches values equal to itself."""
+    if type(pattern) in (str, unicode):
+        return '*' not in pattern
+    return type(pattern) in (int, long, bool)
+
+
+def copy_object(obj, fields=None):
+    """Returns a copy of obj, with only the given fields if not None."""
+    if fields is None:
+        fields = obj.keys()
+    result = {}
+    for field in fields:
+        if field in obj:
+            value = obj[field]
+            result[field] = list(value) if type(value) == list else value
+    return result
+
+
+class Store:
+    """Store keeps PLC objects in memory, and finds them like PLC does.
+
+    Objects of every type are kept by id. The name field and INDEXED_FIELDS
+    are indexed, so that filters on those fields do not scan every object.
+    Store is not thread safe; PLCAPI serializes all calls to it.
+    """
+    def __init__(self):
+        self.objects = dict((t, {}) for t in OBJECT_TYPES)
+        self.next_id = dict((t, 1) for t in OBJECT_TYPES)
+        self.indexes = {}
+        for obj_type, (_, name_field) in OBJECT_TYPES.items():
+            fields = INDEXED_FIELDS.get(obj_type, [])
+            if name_field is not None:
+                fields = [name_field] + fields
+            self.indexes[obj_type] = dict((f, {}) for f in fields)
+
+    def _index(self, obj_type, obj, add):
+        id_field = OBJECT_TYPES[obj_type][0]
+        for field, index in self.indexes[obj_type].items():
+            key = index_key(obj.get(field))
+            if add:
+                index.setdefault(key, set()).add(obj[id_field])
+            else:
+                index.get(key, set()).discard(obj[id_field])
+
+    def add(self, obj_type, fields):
+        """Adds a new object of obj_type and returns it."""
+        id_field = OBJECT_TYPES[obj_type][0]
+        obj = dict(fields)
+        obj[id_field] = self.next_id[obj_type]
+        self.next_id[obj_type] += 1
+        self.objects[obj_type][obj[id_field]] = obj
+        self._index(obj_type, obj, True)
+        return obj
+
+    def update(self, obj_type, obj, fields):
+        """Updates the fields of obj, an object returned by lookup()."""
+        self._index(obj_type, obj, False)
+        obj.update(fields)
+        self._index(obj_type, obj, True)
+
+    def delete(self, obj_type, obj):
+        """Deletes obj, an object returned by lookup()."""
+        self._index(obj_type, obj, False)
+        del self.objects[obj_type][obj[OBJECT_TYPES[obj_type][0]]]
+
+    def lookup(self, obj_type, ref):
+        """Returns the object of obj_type with the given id or name.
+
+        Args:
+            obj_type: str, one of OBJECT_TYPES.
+            ref: int or str, the id or name of the object.
+        Returns:
+            dict, the stored object; changes must be made with update().
+        Raises:
+            xmlrpclib.Fault, if the object does not exist.
+        """
+        objects = self._candidates(obj_type, ref)
+        if len(objects) != 1:
+            raise xmlrpclib.Fault(PLCInvalidArgumentCode,
+                                  'No such %s: %s' % (obj_type, ref))
+        return objects[0]
+
+    def _candidates(self, obj_type, obj_filter):
+        """Returns the objects that may match obj_filter, sorted by id."""
+        (id_field, name_field) = OBJECT_TYPES[obj_type]
+        objects = self.objects[obj_type]
+        ids = None
+        if type(obj_filter) in (int, long):
+            ids = [obj_filter]
+        elif type(obj_filter) in (str, unicode) and is_exact(obj_filter):
+            index = self.indexes[obj_type].get(name_field, {})
+            ids = index.get(index_key(obj_filter), ())
+        elif type(obj_filter) == dict:
+            for field, index in self.indexes[obj_type].items():
+                pattern = obj_filter.get(field)
+                if is_exact(pattern):
+                    ids = index.get(index_key(pattern), ())
+                    break
+                if (type(pattern) in [type([]), type(())] and
+                    all(is_exact(p) for p in pattern)):
+                    ids = set()
+                    for p in pattern:
+                        ids.update(index.get(index_key(p), ()))
+                    break
+        if ids is None:
+            ids = objects.keys()
+        return [objects[i] for i in sorted(ids) if i in objects and
+                match_object(objects[i], obj_filter, id_field, name_field)]
+
+    def find(self, obj_type, obj_filter=None, fields=None):
+        """Returns copies of the objects of obj_type that match obj_filter.
+
+        Args:
+            obj_type: str, one of OBJECT_TYPES.
+            obj_filter: a filter accepted by match_object().
+            fields: list of str, fields to return for each object. When None,
+                all fields are returned.
+        Returns:
+            list of dict, the matching objects sorted by id.
+        """
+        if type(obj_filter) in [type([]), type(())]:
+            found = {}
+            for f in obj_filter:
+                for obj in self._candidates(obj_type, f):
+                    found[obj[OBJECT_TYPES[obj_type][0]]] = obj
+            objects = [found[i] for i in sorted(found)]
+        else:
+            objects = self._candidates(obj_type, obj_filter)
+        return [copy_object(obj, fields) for obj in objects]
+
+
+class Stats:
+    """Stats counts the calls, requests and bytes of every API method.
+
+    A call to system.multicall is one request, and every call it contains is
+    counted as a call of its own method. Bytes are the sizes of the XML-RPC
+    request and response bodies, before compression. Stats is safe to use
+    from multiple threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+
+    def count(self, method, calls=0, requests=0, bytes_in=0, bytes_out=0):
+        """Adds the given counts to method."""
+        with self.lock:
+            counts = self.methods.setdefault(
+                method, {'calls': 0, 'requests': 0, 'bytes_in': 0,
+                         'bytes_out': 0})
+            counts['calls'] += calls
+            counts['requests'] += requests
+            counts['bytes_in'] += bytes_in
+            counts['bytes_out'] += bytes_out
+
+    def snapshot(self, reset=False):
+        """Returns the counts by method, and resets them if reset is True."""
+        with self.lock:
+            methods = dict((m, dict(c)) for m, c in self.methods.items())
+            if reset:
+                self.methods = {}
+        return methods
+
+
+class PLCAPI:
+    """PLCAPI implements the PLC API methods used by plsync on a Store.
+
+    Every method takes the auth struct as its first parameter. Calls with a
+    'password' auth, or with a 'session' auth returned by GetSession(), are
+    accepted. Calls are serialized, so PLCAPI is safe to use from the threads
+    of a Server.
+    """
+    def __init__(self, store=None):
+        self.store = store if store is not None else Store()
+        self.stats = Stats()
+        self.lock = threading.Lock()
+        self.sessions = set()
+        for tagname, category in DEFAULT_TAG_TYPES:
+            self.AddTagType({'tagname': tagname, 'category': category})
+
+    def _dispatch(self, method, params):
+        """Checks the auth in params[0], then calls method with the rest."""
+        if not method[:1].isupper() or not hasattr(self, method):
+            raise xmlrpclib.Fault(PLCInvalidMethodCode,
+                                  'Invalid method %s' % method)
+        if not params:
+            raise xmlrpclib.Fault(PLCInvalidArgumentCode, 'Missing auth')
+        self.check_auth(params[0])
+        self.stats.count(method, calls=1)
+        with self.lock:
+            return getattr(self, method)(*params[1:])
+
+    def check_auth(self, auth):
+        """Raises xmlrpclib.Fault if auth is not accepted."""
+        if type(auth) == dict:
+            if auth.get('AuthMethod') == 'password':
+                return
+            if (auth.get('AuthMethod') == 'session' and
+                auth.get('session') in self.sessions):
+                return
+        raise xmlrpclib.Fault(PLCAuthenticationFailureCode,
+                              'Failed to authenticate call')
+
+    def new_session(self):
+        """Returns a new session accepted by check_auth()."""
+        session = base64.b32encode(os.urandom(20)).lower()
+        self.sessions.add(session)
+        return session
+
+    def _add(self, obj_type, fields, defaults):
+        obj = dict(defaults)
+        obj.update(fields)
+        now = int(time.time())
+        obj.setdefault('date_created', now)
+        obj['last_updated'] = now
+        return self.store.add(obj_type, obj)
+
+    def _update(self, obj_type, ref, fields):
+        obj = self.store.lookup(obj_type, ref)
+        id_field = OBJECT_TYPES[obj_type][0]
+        fields = dict((k, v) for k, v in fields.items() if k != id_field)
+        fields['last_updated'] = int(time.time())
+        self.store.update(obj_type, obj, fields)
+        return 1
+
+    def _link(self, obj, field, value):
+        if value not in obj[field]:
+            obj[field].append(value)
+
+    def _unlink(self, obj, field, value):
+        if value in obj[field]:
+            obj[field].remove(value)
+
+    def _add_tag(self, tag_type, ref, tag_type_ref, value, extra=None):
+        (obj_type, id_field, tags_field) = TAG_TYPES[tag_type]
+        obj = self.store.lookup(obj_type, ref)
+        tag_type_obj = self.store.lookup('tag_type', tag_type_ref)
+        fields = {
+            id_field: obj[id_field],
+            'tag_type_id': tag_type_obj['tag_type_id'],
+            'tagname': tag_type_obj['tagname'],
+            'category': tag_type_obj['category'],
+            'value': value,
+        }
+        fields.update(extra or {})
+        tag = self.store.add(tag_type, fields)
+        id_value = tag[OBJECT_TYPES[tag_type][0]]
+        obj[tags_field].append(id_value)
+        return (obj, id_value)
+
+    def _update_tag(self, tag_type, tag_id, value):
+        tag = self.store.lookup(tag_type, tag_id)
+        self.store.update(tag_type, tag, {'value': value})
+        return tag
+
+    def _delete_tag(self, tag_type, tag_id):
+        (obj_type, id_field, tags_field) = TAG_TYPES[tag_type]
+        tag = self.store.lookup(tag_type, tag_id)
+        self.store.delete(tag_type, tag)
+        obj = self.store.objects[obj_type].get(tag[id_field])
+        if obj is not None:
+            self._unlink(obj, tags_field, tag_id)
+        return tag
+
+    def _update_nodegroups(self, node):
+        """Updates the nodegroups of node, from the values of its node tags."""
+        tags = dict((t['tagname'], t['value'])
+                    for t in self.store.find('node_tag',
+                                             {'node_id': node['node_id']}))
+        node['nodegroup_ids'] = []
+        for nodegroup in self.store.objects['nodegroup'].values():
+            if tags.get(nodegroup['tagname']) == nodegroup['value']:
+                self._link(node, 'nodegroup_ids', nodegroup['nodegroup_id'])
+                self._link(nodegroup, 'node_ids', node['node_id'])
+            else:
+                self._unlink(nodegroup, 'node_ids', node['node_id'])
+
+    def _nodes(self, node_refs):
+        return [self.store.lookup('node', ref) for ref in node_refs]
+
+    # Sessions.
+
+    def AuthCheck(self):
+        return 1
+
+    def GetSession(self, expires=None):
+        return self.new_session()
+
+    # Sites.
+
+    def GetSites(self, site_filter=None, fields=None):
+        return self.store.find('site', site_filter, fields)
+
+    def AddSite(self, fields):
+        if self.store.find('site', {'login_base': fields['login_base']}):
+            raise xmlrpclib.Fault(PLCInvalidArgumentCode,
+                                  'login_base already in use')
+        site = self._add('site', fields, {
+            'enabled': True, 'max_slices': 0, 'latitude': None,
+            'longitude': None, 'node_ids': [], 'pcu_ids': [],
+            'person_ids': [], 'slice_ids': [], 'site_tag_ids': []})
+        return site['site_id']
+
+    def UpdateSite(self, site_ref, fields):
+        return self._update('site', site_ref, fields)
+
+    def GetSiteTags(self, tag_filter=None, fields=None):
+        return self.store.find('site_tag', tag_filter, fields)
+
+    def AddSiteTag(self, site_ref, tag_type_ref, value):
+        return self._add_tag('site_tag', site_ref, tag_type_ref, value)[1]
+
+    def UpdateSiteTag(self, tag_id, value):
+        self._update_tag('site_tag', tag_id, value)
+        return 1
+
+    # Nodes.
+
+    def GetNodes(self, node_filter=None, fields=None):
+        return self.store.find('node', node_filter, fields)
+
+    def AddNode(self, site_ref, fields):
+        site = self.store.lookup('site', site_ref)
+        node = self._add('node', fields, {
+            'site_id': site['site_id'], 'boot_state': 'reinstall',
+            'run_level': None, 'interface_ids': [], 'node_tag_ids': [],
+            'nodegroup_ids': [], 'pcu_ids': [], 'ports': [], 'slice_ids': [],
+            'slice_ids_whitelist': []})
+        site['node_ids'].append(node['node_id'])
+        return node['node_id']
+
+    def UpdateNode(self, node_ref, fields):
+        return self._update('node', node_ref, fields)
+
+    def GetNodeTags(self, tag_filter=None, fields=None):
+        return self.store.find('node_tag', tag_filter, fields)
+
+    def AddNodeTag(self, node_ref, tag_type_ref, value):
+        (node, tag_id) = self._add_tag('node_tag', node_ref, tag_type_ref,
+                                       value)
+        self._update_nodegroups(node)
+        return tag_id
+
+    def UpdateNodeTag(self, tag_id, value):
+        tag = self._update_tag('node_tag', tag_id, value)
+        self._update_nodegroups(self.store.lookup('node', tag['node_id']))
+        return 1
+
+    def GetNodeGroups(self, nodegroup_filter=None, fields=None):
+        return self.store.find('nodegroup', nodegroup_filter, fields)
+
+    def AddNodeGroup(self, groupname, tag_type_ref, value):
+        tag_type = self.store.lookup('tag_type', tag_type_ref)
+        nodegroup = self.store.add('nodegroup', {
+            'groupname': groupname, 'tag_type_id': tag_type['tag_type_id'],
+            'tagname': tag_type['tagname'], 'value': value, 'node_ids': []})
+        for node in self.store.objects['node'].values():
+            self._update_nodegroups(node)
+        return nodegroup['nodegroup_id']
+
+    # Interfaces.
+
+    def GetInterfaces(self, interface_filter=None, fields=None):
+        return self.store.find('interface', interface_filter, fields)
+
+    def AddInterface(self, node_ref, fields):
+        node = self.store.lookup('node', node_ref)
+        interface = self._add(
+            'interface', dict(fields, node_id=node['node_id']),
+            {'is_primary': False, 'interface_tag_ids': []})
+        node['interface_ids'].append(interface['interface_id'])
+        return interface['interface_id']
+
+    def UpdateInterface(self, interface_id, fields):
+        return self._update('interface', interface_id, fields)
+
+    def DeleteInterface(self, interface_id):
+        interface = self.store.lookup('interface', interface_id)
+        for tag_id in list(interface['interface_tag_ids']):
+            self._delete_tag('interface_tag', tag_id)
+        self.store.delete('interface', interface)
+        node = self.store.objects['node'].get(interface['node_id'])
+        if node is not None:
+            self._unlink(node, 'interface_ids', interface_id)
+        return 1
+
+    def GetInterfaceTags(self, tag_filter=None, fields=None):
+        return self.store.find('interface_tag', tag_filter, fields)
+
+    def AddInterfaceTag(self, interface_id, tag_type_ref, value):
+        return self._add_tag('interface_tag', interface_id, tag_type_ref,
+                             value)[1]
+
+    def UpdateInterfaceTag(self, tag_id, value):
+        self._update_tag('interface_tag', tag_id, value)
+        return 1
+
+    # PCUs.
+
+    def GetPCUs(self, pcu_filter=None, fields=None):
+        return self.store.find('pcu', pcu_filter, fields)
+
+    def AddPCU(self, site_ref, fields):
+        site = self.store.lookup('site', site_ref)
+        pcu = self._add('pcu', fields, {
+            'site_id': site['site_id'], 'node_ids': [], 'ports': []})
+        site['pcu_ids'].append(pcu['pcu_id'])
+        return pcu['pcu_id']
+
+    def UpdatePCU(self, pcu_id, fields):
+        return self._update('pcu', pcu_id, fields)
+
+    def AddNodeToPCU(self, node_ref, pcu_id, port):
+        node = self.store.lookup('node', node_ref)
+        pcu = self.store.lookup('pcu', pcu_id)
+        if node['node_id'] not in pcu['node_ids']:
+            pcu['node_ids'].append(node['node_id'])
+            pcu['ports'].append(port)
+            node['pcu_ids'].append(pcu['pcu_id'])
+            node['ports'].append(port)
+        return 1
+
+    # Persons.
+
+    def GetPersons(self, person_filter=None, fields=None):
+        return self.store.find('person', person_filter, fields)
+
+    def AddPerson(self, fields):
+        person = self._add('person', fields, {
+            'enabled': False, 'roles': ['user'], 'site_ids': [],
+            'slice_ids': []})
+        return person['person_id']
+
+    def UpdatePerson(self, person_ref, fields):
+        return self._update('person', person_ref, fields)
+
+    def AddPersonToSite(self, person_ref, site_ref):
+        person = self.store.lookup('person', person_ref)
+        site = self.store.lookup('site', site_ref)
+        self._link(person, 'site_ids', site['site_id'])
+        self._link(site, 'person_ids', person['person_id'])
+        return 1
+
+    def DeletePersonFromSite(self, person_ref, site_ref):
+        person = self.store.lookup('person', person_ref)
+        site = self.store.lookup('site', site_ref)
+        self._unlink(person, 'site_ids', site['site_id'])
+        self._unlink(site, 'person_ids', person['person_id'])
+        return 1
+
+    def AddPersonToSlice(self, person_ref, slice_ref):
+        person = self.store.lookup('person', person_ref)
+        sslice = self.store.lookup('slice', slice_ref)
+        self._link(person, 'slice_ids', sslice['slice_id'])
+        self._link(sslice, 'person_ids', person['person_id'])
+        return 1
+
+    # Slices.
+
+    def GetSlices(self, slice_filter=None, fields=None):
+        return self.store.find('slice', slice_filter, fields)
+
+    def AddSlice(self, fields):
+        if self.store.find('slice', {'name': fields['name']}):
+            raise xmlrpclib.Fault(PLCInvalidArgumentCode,
+                                  'Slice name already in use')
+        # NOTE: slice names start with the login_base of their site.
+        sites = self.store.find('site',
+                                {'login_base': fields['name'].split('_')[0]})
+        site_id = sites[0]['site_id'] if sites else None
+        sslice = self._add('slice', fields, {
+            'site_id': site_id, 'instantiation': 'plc-instantiated',
+            'max_nodes': 100, 'expires': int(time.time()) + SLICE_LIFETIME,
+            'node_ids': [], 'person_ids': [], 'slice_tag_ids': []})
+        if site_id is not None:
+            self.store.lookup('site', site_id)['slice_ids'].append(
+                sslice['slice_id'])
+        return sslice['slice_id']
+
+    def UpdateSlice(self, slice_ref, fields):
+        return self._update('slice', slice_ref, fields)
+
+    def AddSliceToNodes(self, slice_ref, node_refs):
+        sslice = self.store.lookup('slice', slice_ref)
+        for node in self._nodes(node_refs):
+            self._link(node, 'slice_ids', sslice['slice_id'])
+            self._link(sslice, 'node_ids', node['node_id'])
+        return 1
+
+    def DeleteSliceFromNodes(self, slice_ref, node_refs):
+        sslice = self.store.lookup('slice', slice_ref)
+        for node in self._nodes(node_refs):
+            self._unlink(node, 'slice_ids', sslice['slice_id'])
+            self._unlink(sslice, 'node_ids', node['node_id'])
+        return 1
+
+    def AddSliceToNodesWhitelist(self, slice_ref, node_refs):
+        sslice = self.store.lookup('slice', slice_ref)
+        for node in self._nodes(node_refs):
+            self._link(node, 'slice_ids_whitelist', sslice['slice_id'])
+        return 1
+
+    def DeleteSliceFromNodesWhitelist(self, slice_ref, node_refs):
+        sslice = self.store.lookup('slice', slice_ref)
+        for node in self._nodes(node_refs):
+            self._unlink(node, 'slice_ids_whitelist', sslice['slice_id'])
+        return 1
+
+    def GetSliceTags(self, tag_filter=None, fields=None):
+        return self.store.find('slice_tag', tag_filter, fields)
+
+    def AddSliceTag(self, slice_ref, tag_type_ref, value, node_ref=None,
+                    nodegroup_ref=None):
+        sslice = self.store.lookup('slice', slice_ref)
+        extra = {'name': sslice['name'], 'node_id': None,
+                 'nodegroup_id': None}
+        if node_ref is not None:
+            extra['node_id'] = self.store.lookup('node', node_ref)['node_id']
+        if nodegroup_ref is not None:
+            extra['nodegroup_id'] = self.store.lookup(
+                'nodegroup', nodegroup_ref)['nodegroup_id']
+        return self._add_tag('slice_tag', sslice['slice_id'], tag_type_ref,
+                             value, extra)[1]
+
+    def UpdateSliceTag(self, tag_id, value):
+        self._update_tag('slice_tag', tag_id, value)
+        return 1
+
+    def DeleteSliceTag(self, tag_id):
+        self._delete_tag('slice_tag', tag_id)
+        return 1
+
+    # Tag types.
+
+    def GetTagTypes(self, tag_type_filter=None, fields=None):
+        return self.store.find('tag_type', tag_type_filter, fields)
+
+    def AddTagType(self, fields):
+        if self.store.find('tag_type', {'tagname': fields['tagname']}):
+            raise xmlrpclib.Fault(PLCInvalidArgumentCode,
+                                  'Tag type name already in use')
+        tag_type = self.store.add('tag_type', dict(
+            {'category': 'general', 'description': ''}, **fields))
+        return tag_type['tag_type_id']
+
+    # Boot images.
+
+    def GetBootMedium(self, node_ref, action, filename, options=None):
+        node = self.store.lookup('node', node_ref)
+        if 'node-key-keep' not in (options or []) or 'key' not in node:
+            self.store.update('node', node, {
+                'key': base64.b32encode(os.urandom(20))})
+        image = '%s %s %s\n' % (action, node['hostname'], node['key'])
+        return base64.b64encode(image)
+
+
+class RequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+    """RequestHandler serves XML-RPC on the PLCAPI path.
+
+    Like PLC, connections are kept open between requests.
+    """
+    rpc_paths = ('/', '/RPC2', '/PLCAPI/')
+    protocol_version = 'HTTP/1.1'
+
+
+class Server(SocketServer.ThreadingMixIn,
+             SimpleXMLRPCServer.SimpleXMLRPCServer):
+    """Server serves a PLCAPI over XML-RPC, with one thread per connection.
+
+    Every request is delayed by 'latency' seconds before it is handled, and
+    counted in the Stats of the PLCAPI.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, api, latency=0):
+        SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(
+            self, address, requestHandler=RequestHandler, logRequests=False,
+            allow_none=True)
+        self.register_instance(api)
+        self.register_multicall_functions()
+        self.api = api
+        self.latency = latency
+
+    def url(self):
+        """Returns the PLCAPI url of the server."""
+        return 'http://%s:%d/PLCAPI/' % self.server_address
+
+    def _marshaled_dispatch(self, data, dispatch_method=None, path=None):
+        if self.latency:
+            time.sleep(self.latency)
+        response = SimpleXMLRPCServer.SimpleXMLRPCServer._marshaled_dispatch(
+            self, data, dispatch_method, path)
+        match = METHOD_NAME.search(data)
+        method = match.group(1) if match else 'unknown'
+        self.api.stats.count(method, requests=1, bytes_in=len(data),
+                             bytes_out=len(response))
+        return response
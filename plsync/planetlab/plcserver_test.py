@@ -0,0 +1,241 @@
+"""Tests for plcserver."""
+
+import mock
+import model
+import os
+import plcserver
+import reconcile
+import session
+import shutil
+import StringIO
+import sync
+import tempfile
+import threading
+import unittest
+import xmlrpclib
+
+
+class PLCAPITest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = plcserver.PLCAPI()
+        self.site_id = self.api.AddSite({'login_base': 'abc01',
+                                         'name': 'Some Site'})
+        self.node_id = self.api.AddNode('abc01', {
+            'hostname': 'mlab1.abc01.measurement-lab.org'})
+
+    def test_match_object_with_operators(self):
+        tag = {'slice_tag_id': 1, 'nodegroup_id': 2, 'node_id': None}
+        tag_filter = {']nodegroup_id': 2, '[nodegroup_id': 2}
+
+        self.assertTrue(plcserver.match_object(tag, tag_filter,
+                                               'slice_tag_id', None))
+        self.assertFalse(plcserver.match_object(tag, {'>node_id': 0},
+                                                'slice_tag_id', None))
+        self.assertTrue(plcserver.match_object(tag, {'~nodegroup_id': 3},
+                                               'slice_tag_id', None))
+
+    def test_store_find_by_indexed_field(self):
+        self.api.AddInterface(self.node_id, {'ip': '192.168.1.9',
+                                             'is_primary': True})
+        self.api.AddInterface(self.node_id, {'ip': '192.168.1.10'})
+
+        found = self.api.GetInterfaces({'node_id': self.node_id,
+                                        'is_primary': False}, ['ip'])
+
+        self.assertEqual(found, [{'ip': '192.168.1.10'}])
+        self.assertEqual(len(self.api.GetNodes(None)[0]['interface_ids']), 2)
+
+    def test_get_nodes_by_name_pattern_and_id(self):
+        self.api.AddNode('abc01', {
+            'hostname': 'mlab2.abc01.measurement-lab.org'})
+
+        by_pattern = self.api.GetNodes('MLAB*.abc01.*', ['node_id'])
+        by_list = self.api.GetNodes([self.node_id,
+                                     'mlab2.abc01.measurement-lab.org'],
+                                    ['hostname'])
+
+        self.assertEqual(len(by_pattern), 2)
+        self.assertEqual(by_list, [
+            {'hostname': 'mlab1.abc01.measurement-lab.org'},
+            {'hostname': 'mlab2.abc01.measurement-lab.org'}])
+        self.assertEqual(self.api.GetSites('abc01')[0]['node_ids'],
+                         [self.node_id, self.node_id + 1])
+
+    def test_node_tags_update_nodegroups(self):
+        ng_id = self.api.AddNodeGroup('MeasurementLabCentos', 'deployment',
+                                      'MeasurementLabCentos')
+
+        tag_id = self.api.AddNodeTag(self.node_id, 'deployment',
+                                     'MeasurementLabCentos')
+        in_group = self.api.GetNodes(self.node_id)[0]['nodegroup_ids']
+        self.api.UpdateNodeTag(tag_id, 'MeasurementLabLXC')
+        not_in_group = self.api.GetNodes(self.node_id)[0]['nodegroup_ids']
+
+        self.assertEqual(in_group, [ng_id])
+        self.assertEqual(not_in_group, [])
+
+    def test_add_tag_when_tag_type_is_missing_raises_fault(self):
+        with self.assertRaises(xmlrpclib.Fault) as context:
+            self.api.AddNodeTag(self.node_id, 'unknown', 'value')
+
+        self.assertEqual(context.exception.faultCode,
+                         plcserver.PLCInvalidArgumentCode)
+
+    def test_dispatch_checks_auth_and_method(self):
+        session_auth = {'AuthMethod': 'session',
+                        'session': self.api.new_session()}
+
+        self.assertEqual(self.api._dispatch('AuthCheck', [session_auth]), 1)
+        with self.assertRaises(xmlrpclib.Fault) as auth_error:
+            self.api._dispatch('AuthCheck', [{'AuthMethod': 'session',
+                                              'session': 'unknown'}])
+        with self.assertRaises(xmlrpclib.Fault) as method_error:
+            self.api._dispatch('check_auth', [session_auth])
+
+        self.assertEqual(auth_error.exception.faultCode,
+                         plcserver.PLCAuthenticationFailureCode)
+        self.assertEqual(method_error.exception.faultCode,
+                         plcserver.PLCInvalidMethodCode)
+
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plc = plcserver.PLCAPI()
+        self.server = plcserver.Server(('localhost', 0), self.plc)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.api = session.API({'AuthMethod': 'password'}, self.server.url(),
+                               connections=2)
+        self.addCleanup(self.close_connections)
+        # Person ids are saved for a run; every test uses a new stand-in.
+        patcher = mock.patch.dict(sync._persons, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def close_connections(self):
+        while not self.api.pool.empty():
+            (server, _) = self.api.pool.get()
+            server('close')()
+
+    def test_multicall_counts_requests_and_calls(self):
+        batch = self.api.multicall()
+        batch.GetTagTypes('city')
+        batch.GetTagTypes('country')
+
+        (city, country) = batch.run()
+
+        methods = self.plc.stats.snapshot()
+        self.assertEqual(city[0]['tagname'], 'city')
+        self.assertEqual(country[0]['tagname'], 'country')
+        self.assertEqual(methods['system.multicall']['requests'], 1)
+        self.assertGreater(methods['system.multicall']['bytes_out'], 0)
+        self.assertEqual(methods['GetTagTypes']['calls'], 2)
+        self.assertEqual(methods['GetTagTypes']['requests'], 0)
+
+    def test_metrics_measure_requests_sent_to_server(self):
+        self.api.GetTagTypes('city')
+        self.api.GetSites(None)
+
+        records = self.api.metrics.records()
+        methods = self.plc.stats.snapshot()
+        self.assertEqual([r['method'] for r in records],
+                         ['GetSites', 'GetTagTypes'])
+        for record in records:
+            counts = methods[record['method']]
+            self.assertEqual(record['bytes_sent'], counts['bytes_in'])
+            self.assertEqual(record['bytes_received'], counts['bytes_out'])
+            self.assertEqual(record['retries'], 0)
+
+    @mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+    def test_sync_site_creates_site_then_confirms_it(self, mock_stdout):
+        users = [('User', 'Name', 'username@gmail.com')]
+        site = model.makesite(
+            'abc01', '192.168.1.0', '2400:1002:4008::', 'Some City', 'US',
+            36.850000, 74.783000, users, nodegroup='MeasurementLabCentos')
+        self.plc.AddPerson({'email': 'username@gmail.com', 'enabled': True})
+        self.plc.AddNodeGroup('MeasurementLabCentos', 'deployment',
+                              'MeasurementLabCentos')
+
+        with mock.patch.object(session, 'api', self.api):
+            sync.SyncSite(site, None, True, True, True, False, False, False)
+            created = self.plc.stats.snapshot(reset=True)
+            sync.SyncSite(site, None, True, True, True, False, False, False)
+            confirmed = self.plc.stats.snapshot(reset=True)
+
+        nodes = self.plc.GetNodes(None, ['hostname', 'interface_ids',
+                                         'nodegroup_ids'])
+        self.assertEqual(len(nodes), 3)
+        self.assertEqual(len(nodes[0]['interface_ids']), 13)
+        self.assertEqual(len(nodes[0]['nodegroup_ids']), 1)
+        sites = self.plc.GetSites(site['login_base'], ['person_ids'])
+        self.assertEqual(sites, [{'person_ids': [1]}])
+        self.assertIn('AddInterface', created)
+        self.assertEqual([m for m in confirmed if not m.startswith('Get') and
+                          m != 'system.multicall'], [])
+
+
+    @mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+    def test_apply_plan_then_plan_again_finds_no_changes(self, mock_stdout):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        fname = os.path.join(tempdir, 'sites.plan')
+        users = [('User', 'Name', 'username@gmail.com')]
+        site = model.makesite(
+            'abc01', '192.168.1.0', '2400:1002:4008::', 'Some City', 'US',
+            36.850000, 74.783000, users, nodegroup='MeasurementLabCentos')
+        self.plc.AddNodeGroup('MeasurementLabCentos', 'deployment',
+                              'MeasurementLabCentos')
+
+        with mock.patch.object(session, 'api', self.api):
+            reconcile.WritePlan(fname, reconcile.PlanSites([site], None, True,
+                                                           True))
+            self.plc.stats.snapshot(reset=True)
+            reconcile.ApplyStages(reconcile.ReadPlan(fname), workers=2)
+            applied = self.plc.stats.snapshot(reset=True)
+            stages = reconcile.PlanSites([site], None, True, True)
+
+        self.assertEqual([m for m in applied if m.startswith('Get')], [])
+        self.assertEqual(len(self.plc.GetNodes(None)), 3)
+        self.assertEqual(stages, [[], []])
+
+    @mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+    def test_plan_slices_skips_missing_slices_and_nodes(self, mock_stdout):
+        site = model.makesite(
+            'abc01', '192.168.1.0', '2400:1002:4008::', 'Some City', 'US',
+            36.850000, 74.783000, [], nodegroup='MeasurementLabCentos')
+        slices = [model.Slice(name='abc01_bar', index=1, users=[],
+                              attrs=[model.Attr(None, vsys='slice_restart')]),
+                  model.Slice(name='abc01_baz', index=2, users=[])]
+        for sslice in slices:
+            for node in site.sorted_nodes():
+                sslice.add_node_address(node)
+        self.plc.AddNodeGroup('MeasurementLabCentos', 'deployment',
+                              'MeasurementLabCentos')
+        self.plc.AddSlice({'name': 'abc01_bar'})
+
+        with mock.patch.object(session, 'api', self.api):
+            stages = reconcile.PlanSites([site], None, True, True)
+            stages += reconcile.PlanSlices(slices, None, True)
+            reconcile.ApplyStages(stages, workers=2)
+            planned = reconcile.PlanSlices(slices, None, True)
+
+        self.assertEqual(stages[-1], [[reconcile.Change(
+            'AddSliceTag', ['abc01_bar', 'vsys', 'slice_restart'], mock.ANY)]])
+        self.assertIn('WARNING: slice abc01_baz not found in plc db',
+                      mock_stdout.getvalue())
+        self.assertIn('WARNING: node mlab1.abc01.measurement-lab.org not found',
+                      mock_stdout.getvalue())
+        self.assertEqual(
+            [change['args'] for [change] in planned[0]],
+            [['abc01_bar', 'ip_addresses', ip, node.hostname()]
+             for ip, node in zip(['192.168.1.11', '192.168.1.24',
+                                  '192.168.1.37'], site.sorted_nodes())])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,884 @@
+"""Snapshot-and-diff reconciliation of M-Lab sites and slices with the PLC DB.
+
+The Sync* functions in sync.py look up every object, tag and interface with
+its own Get* call right before deciding whether to change it. For a full
+'--syncsite all' this amounts to thousands of serial round-trips.
+
+Instead, the functions in this module fetch all PLC objects related to the
+selected sites with a handful of bulk Get* calls (a Snapshot), compare the
+declared model.Site and model.Node configuration to the snapshot in memory,
+and only then issue the mutating calls (Changes) that are actually needed.
+Slice attributes are reconciled the same way: all slice tags of a slice are
+fetched at once and compared to every declared model.Attr.
+
+Changes are organized in stages. A stage is a list of groups, and a group is
+a list of changes that must be applied in order, e.g. because of a Ref(). All
+groups of a stage are independent, so they may be applied concurrently, but
+a stage may depend on the changes of earlier stages, e.g. nodes are added to
+the sites created by the first stage. Stages can be saved to a plan file (see
+WritePlan()), reviewed, and applied later without reading the PLC DB again.
+"""
+
+import json
+import parallel
+import session as s
+import sync
+import sys
+import xmlrpclib
+
+
+# The version of the plan file format written by WritePlan().
+PLAN_VERSION = 1
+# The tag types of all interface tags set by DiffInterfaces().
+INTERFACE_TAGNAMES = ['alias', 'ifname', 'ovs_bridge', 'ipv6_defaultgw',
+                      'ipv6addr', 'ipv6addr_secondaries']
+
+
+class Ref(dict):
+    """Ref() is a placeholder for the result of an earlier Change().
+
+    Add* calls return the id of the new object, which later changes may need,
+    e.g. AddInterfaceTag() needs the interface_id returned by AddInterface().
+
+    Ref() constructor expects:
+        name - str, the 'ref' name of an earlier Change().
+      Optional:
+        text - bool, if True the result is converted to a string.
+    """
+    def __init__(self, name, text=False):
+        super(Ref, self).__init__(ref=name, text=text)
+
+
+class Change(dict):
+    """Change() is a single mutating PLC API call, computed by a Diff*() call.
+
+    Change() constructor expects:
+        method - str, the name of a PLC API method, e.g. 'AddNodeTag'
+        args - list, arguments passed to method. Any Ref() is replaced by the
+               result of the referenced change before the call is made.
+        message - str, a description printed when the change is applied.
+      Optional:
+        ref - str, a name by which later changes can Ref() this result.
+    """
+    def __init__(self, method, args, message, ref=None):
+        super(Change, self).__init__(method=method, args=args,
+                                     message=message, ref=ref)
+
+
+def _index(objects, *keys):
+    """Returns a dict of lists of objects, grouped by the values of keys."""
+    index = {}
+    for obj in objects:
+        key = tuple(obj[k] for k in keys)
+        if len(keys) == 1:
+            key = key[0]
+        index.setdefault(key, []).append(obj)
+    return index
+
+
+def _lookup(index, *key):
+    """Returns index[key], or [] when key refers to an object not yet in PLC."""
+    if any(isinstance(k, Ref) for k in key):
+        return []
+    if len(key) == 1:
+        key = key[0]
+    return index.get(key, [])
+
+
+def SelectedNodes(site, onhost):
+    """Returns the site nodes sorted by hostname, limited to onhost if given."""
+    return [node for node in site.sorted_nodes()
+            if onhost is None or node.hostname() == onhost]
+
+
+class Snapshot(object):
+    """Snapshot holds the PLC objects related to a set of sites.
+
+    All objects are fetched up front with a few bulk Get* calls (see load()),
+    and indexed so that the Diff*() functions can compare them to the declared
+    configuration without further API calls.
+
+    Attributes:
+        sites - dict, login_base -> site
+        site_tags - dict, (site_id, tagname) -> list of site tags
+        nodes - dict, hostname -> node
+        interfaces - dict, node_id -> list of interfaces
+        node_tags - dict, (node_id, tagname) -> list of node tags
+        interface_tags - dict, (interface_id, tagname) -> list of tags
+        pcus - dict, hostname -> pcu
+        nodegroups - dict, groupname -> nodegroup
+        tagtypes - dict, tagname -> tag type
+        slice_tags - dict, (tagname, node_id, nodegroup_id) -> list of slice
+                     tags, for the slice loaded by load_slice()
+    """
+    def __init__(self):
+        self.sites = {}
+        self.site_tags = {}
+        self.nodes = {}
+        self.interfaces = {}
+        self.node_tags = {}
+        self.interface_tags = {}
+        self.pcus = {}
+        self.nodegroups = {}
+        self.tagtypes = {}
+        self.slice_tags = {}
+
+    def load(self, api, sites, onhost=None, withnodes=True):
+        """Fetches all PLC objects related to sites with bulk Get* calls.
+
+        Args:
+            api: session.API, the PLC API used for all Get* calls.
+            sites: list of model.Site, the sites to fetch from PLC.
+            onhost: str, limit the fetched nodes to a single hostname.
+            withnodes: bool, if False only site objects are fetched.
+        """
+        # NOTE: independent lookups are batched with system.multicall, so the
+        # whole snapshot takes three round trips to PLC.
+        declared = []
+        if withnodes:
+            declared = [node for site in sites
+                        for node in SelectedNodes(site, onhost)]
+
+        batch = api.multicall()
+        batch.GetSites({'login_base': [site['login_base'] for site in sites]},
+                       ['site_id', 'login_base', 'latitude', 'longitude'])
+        if declared:
+            batch.GetNodes({'hostname': [node.hostname() for node in declared]},
+                           ['node_id', 'hostname', 'nodegroup_ids'])
+            batch.GetPCUs({'hostname': [node['pcu'].hostname()
+                                        for node in declared]})
+            batch.GetNodeGroups(
+                {'groupname': list(set(node['nodegroup'] for node in declared))},
+                ['nodegroup_id', 'groupname'])
+            batch.GetTagTypes({'tagname': INTERFACE_TAGNAMES},
+                              ['tag_type_id', 'tagname'])
+        results = batch.run()
+
+        self.sites = dict((site['login_base'], site) for site in results[0])
+        if declared:
+            (nodes, pcus, nodegroups, tagtypes) = results[1:]
+            self.nodes = dict((n['hostname'], n) for n in nodes)
+            self.pcus = dict((pcu['hostname'], pcu) for pcu in pcus)
+            self.nodegroups = dict((ng['groupname'], ng) for ng in nodegroups)
+            self.tagtypes = dict((tt['tagname'], tt) for tt in tagtypes)
+
+        site_ids = [site['site_id'] for site in self.sites.values()]
+        node_ids = [node['node_id'] for node in self.nodes.values()]
+        batch = api.multicall()
+        if site_ids:
+            batch.GetSiteTags({'site_id': site_ids})
+        if node_ids:
+            batch.GetInterfaces({'node_id': node_ids})
+            batch.GetNodeTags({'node_id': node_ids})
+        results = batch.run()
+
+        if site_ids:
+            self.site_tags = _index(results.pop(0), 'site_id', 'tagname')
+        if node_ids:
+            self.interfaces = _index(results[0], 'node_id')
+            self.node_tags = _index(results[1], 'node_id', 'tagname')
+
+        interface_ids = [i['interface_id'] for interfaces in
+                         self.interfaces.values() for i in interfaces]
+        if interface_ids:
+            self.interface_tags = _index(
+                api.GetInterfaceTags({'interface_id': interface_ids}),
+                'interface_id', 'tagname')
+
+    def load_interfaces(self, api, node_id, interface_ids):
+        """Fetches the interfaces and interface tags of a node.
+
+        In the common case, when interface_ids is current, everything is
+        fetched with one system.multicall.
+
+        Args:
+            api: session.API, the PLC API used for all Get* calls.
+            node_id: int, the id of the node.
+            interface_ids: list of int, the 'interface_ids' of the node.
+        """
+        batch = api.multicall()
+        batch.GetInterfaces({'node_id': node_id})
+        batch.GetTagTypes({'tagname': INTERFACE_TAGNAMES},
+                          ['tag_type_id', 'tagname'])
+        if interface_ids:
+            batch.GetInterfaceTags({'interface_id': interface_ids})
+        results = batch.run()
+
+        (interfaces, tagtypes) = results[:2]
+        tags = results[2] if interface_ids else []
+        missing = [i['interface_id'] for i in interfaces
+                   if i['interface_id'] not in interface_ids]
+        if missing:
+            tags = tags + api.GetInterfaceTags({'interface_id': missing})
+        self.interfaces = _index(interfaces, 'node_id')
+        self.interface_tags = _index(tags, 'interface_id', 'tagname')
+        self.tagtypes = dict((tt['tagname'], tt) for tt in tagtypes)
+
+    def load_slice(self, api, slicename, hostnames, groupnames):
+        """Fetches the slice tags of a slice with one system.multicall.
+
+        The nodes and nodegroups that the declared attributes refer to are
+        fetched in the same multicall.
+
+        Args:
+            api: session.API, the PLC API used for all Get* calls.
+            slicename: str, the name of the slice, e.g. 'iupui_ndt'.
+            hostnames: list of str, hostnames of the per-node attributes.
+            groupnames: list of str, names of the per-nodegroup attributes.
+        """
+        batch = api.multicall()
+        batch.GetSliceTags({'name': slicename})
+        if hostnames:
+            batch.GetNodes({'hostname': hostnames}, ['node_id', 'hostname'])
+        if groupnames:
+            batch.GetNodeGroups({'groupname': groupnames},
+                                ['nodegroup_id', 'groupname'])
+        results = batch.run()
+
+        self.slice_tags = _index(results.pop(0), 'tagname', 'node_id',
+                                 'nodegroup_id')
+        if hostnames:
+            self.nodes = dict((n['hostname'], n) for n in results.pop(0))
+        if groupnames:
+            self.nodegroups = dict((ng['groupname'], ng)
+                                   for ng in results.pop(0))
+
+
+def DiffTag(kind, objname, ref, found, tagname, value, update, exclude=()):
+    """Returns the changes needed to set tagname->value on a PLC object.
+
+    Args:
+        kind: str, the object kind used in API names, e.g. 'Node', 'Site'.
+        objname: str, name of the tagged object, used for messages only.
+        ref: int or Ref, the id of the tagged object.
+        found: list of dict, the current tags with tagname on the object.
+        tagname: str, the name of the tag.
+        value: str, the declared value of the tag.
+        update: str, the id field of found tags, e.g. 'node_tag_id'.
+        exclude: list of str, tagnames that are added but never updated.
+
+    Returns:
+        list of Change
+    """
+    if len(found) > 1:
+        print ("ERROR: found %s tags for %s on %s" %
+               (len(found), tagname, objname))
+        print "ERROR: expected only 1, plese correct this."
+        sys.exit(1)
+
+    lower = kind.lower()
+    if len(found) == 0:
+        msg = "ADDING: %stag %s->%s on %s" % (lower, tagname, value, objname)
+        return [Change('Add%sTag' % kind, [ref, tagname, value], msg)]
+
+    tag = found[0]
+    if tag['value'] != value and tagname not in exclude:
+        msg = ("UPDATE: %stag %s from %s->%s on %s" %
+               (lower, tagname, tag['value'], value, objname))
+        return [Change('Update%sTag' % kind, [tag[update], value], msg)]
+
+    print ("Confirmed: %stag %s->%s is set on %s" %
+           (lower, tagname, tag['value'], objname))
+    return []
+
+
+def DiffSite(snapshot, site):
+    """Returns the changes needed to create site and sync its location.
+
+    Args:
+        snapshot: Snapshot, the PLC objects loaded for site.
+        site: model.Site, the declared site.
+
+    Returns:
+        list of Change
+    """
+    changes = []
+    login_base = site['login_base']
+    found = snapshot.sites.get(login_base)
+    if found is None:
+        site_id = Ref('site:%s' % login_base)
+        found = {'site_id': site_id, 'latitude': None, 'longitude': None}
+        changes.append(Change(
+            'AddSite', [{'name': site['sitename'],
+                         'abbreviated_name': site['sitename'],
+                         'login_base': login_base,
+                         'url': 'http://www.measurementlab.net/',
+                         'max_slices': 10}],
+            'MakeSite(%s,%s,%s)' % (login_base, site['sitename'],
+                                    site['sitename']),
+            ref=site_id['ref']))
+    else:
+        print "Confirmed: %s is in DB" % login_base
+        site_id = found['site_id']
+
+    location = site['location']
+    if location is None:
+        return changes
+
+    tagnames = ['city', 'country'] + (['extra'] if 'extra' in location else [])
+    for tagname in tagnames:
+        tags = _lookup(snapshot.site_tags, site_id, tagname)
+        changes += DiffTag('Site', login_base, site_id, tags, tagname,
+                           location[tagname], 'site_tag_id')
+
+    update = {}
+    for key in ['latitude', 'longitude']:
+        if found[key] is None or location[key] != round(found[key], 4):
+            update[key] = round(location[key], 4)
+    if update:
+        msg = ("UPDATE: site lat/long from %s,%s to %s,%s with %s" %
+               (found['latitude'], found['longitude'],
+                location['latitude'], location['longitude'], update))
+        changes.append(Change('UpdateSite', [site_id, update], msg))
+
+    return changes
+
+
+def DiffInterfaceTags(snapshot, ip, interface_id, goal):
+    """Returns the changes needed to set the goal tags on an interface.
+
+    Existing 'alias' tags are never updated. Extra tags are ignored.
+
+    Args:
+        snapshot: Snapshot, the PLC objects loaded for the interface node.
+        ip: str, the interface IP address, used for messages only.
+        interface_id: int or Ref, the id of the interface.
+        goal: dict, tagname -> value for all declared interface tags.
+
+    Returns:
+        list of Change
+    """
+    changes = []
+    for tagname, value in sorted(goal.iteritems()):
+        if tagname not in snapshot.tagtypes:
+            print "BUG: %s TagType does not exist. Need to update MyPLC" % tagname
+            sys.exit(1)
+        found = _lookup(snapshot.interface_tags, interface_id, tagname)
+        if found:
+            changes += DiffTag('Interface', ip, interface_id, found, tagname,
+                               value, 'interface_tag_id', exclude=['alias'])
+        else:
+            # NOTE: AddInterfaceTag() requires the tag type id.
+            type_id = snapshot.tagtypes[tagname]['tag_type_id']
+            msg = "ADD: tag %s->%s for %s" % (tagname, value, ip)
+            changes.append(Change('AddInterfaceTag',
+                                  [interface_id, type_id, value], msg))
+    return changes
+
+
+def DiffInterfaces(snapshot, node, node_id, addinterfaces):
+    """Returns the changes needed to sync the interfaces of node.
+
+    The primary interface is added, or updated when its IP changed. When
+    addinterfaces is True and node is not an LXC node, the 12 secondary
+    interfaces are added with their 'alias' and 'ifname' tags. IPv6 settings
+    are always synced as tags on the primary interface.
+
+    Args:
+        snapshot: Snapshot, the PLC objects loaded for node.
+        node: model.Node, the declared node.
+        node_id: int or Ref, the id of node.
+        addinterfaces: bool, if True, add and update interfaces.
+
+    Returns:
+        list of Change
+    """
+    changes = []
+    hostname = node.hostname()
+    interfaces = _lookup(snapshot.interfaces, node_id)
+    by_ip = dict((i['ip'], i) for i in interfaces)
+    primaries = [i for i in interfaces if i['is_primary']]
+
+    declared = node.interface()
+    ip = declared['ip']
+    primary_id = None
+    if ip in by_ip:
+        print "Confirmed: node network setup for %s for %s" % (hostname, ip)
+        primary_id = by_ip[ip]['interface_id']
+    elif primaries and addinterfaces:
+        primary_id = primaries[0]['interface_id']
+        if sync.InterfacesAreDifferent(declared, primaries[0]):
+            msg = "Updating: node network for %s to %s" % (hostname, declared)
+            changes.append(Change('UpdateInterface', [primary_id, declared],
+                                  msg))
+    elif addinterfaces:
+        primary_id = Ref('interface:%s' % ip)
+        msg = "Adding: node network %s to %s" % (ip, hostname)
+        changes.append(Change('AddInterface', [node_id, declared], msg,
+                              ref=primary_id['ref']))
+    else:
+        print "WARNING: no primary interface for %s in DB" % hostname
+        return changes
+
+    if addinterfaces and node['nodegroup'] == 'MeasurementLabLXC':
+        # NOTE: these tags are needed on the primary interface
+        #       for the lxc build of PlanetLab
+        goal = {"ifname": "eth0", "ovs_bridge": "public0"}
+        changes += DiffInterfaceTags(snapshot, ip, primary_id, goal)
+
+    if not node['exclude_ipv6']:
+        changes += DiffInterfaceTags(snapshot, ip, primary_id,
+                                     node.v6interface_tags())
+
+    if not addinterfaces or node['nodegroup'] == 'MeasurementLabLXC':
+        return changes
+
+    for secondary_ip in node.iplist():
+        if secondary_ip in by_ip:
+            interface_id = by_ip[secondary_ip]['interface_id']
+            alias = str(interface_id)
+        else:
+            interface = dict(declared, ip=secondary_ip, is_primary=False)
+            interface_id = Ref('interface:%s' % secondary_ip)
+            alias = Ref(interface_id['ref'], text=True)
+            msg = "Adding: node network %s to %s" % (secondary_ip, hostname)
+            changes.append(Change('AddInterface', [node_id, interface], msg,
+                                  ref=interface_id['ref']))
+        goal = {"alias": alias, "ifname": "eth0"}
+        changes += DiffInterfaceTags(snapshot, secondary_ip, interface_id,
+                                     goal)
+    return changes
+
+
+def DiffNode(snapshot, node, addnodes, addinterfaces):
+    """Returns the changes needed to create and sync node and its children.
+
+    This is the in-memory equivalent of sync.SyncNode(), excluding boot images.
+
+    Args:
+        snapshot: Snapshot, the PLC objects loaded for node.
+        node: model.Node, the declared node.
+        addnodes: bool, if True, add/confirm the node nodegroup.
+        addinterfaces: bool, if True, add interface configuration to node.
+
+    Returns:
+        list of Change
+    """
+    changes = []
+    hostname = node.hostname()
+    found = snapshot.nodes.get(hostname)
+    if found is None:
+        node_id = Ref('node:%s' % hostname)
+        changes.append(Change(
+            'AddNode', [node['login_base'], {'boot_state': 'reinstall',
+                                             'model': 'unknown',
+                                             'hostname': hostname}],
+            "Adding Node %s to site %s" % (hostname, node['login_base']),
+            ref=node_id['ref']))
+        found = {'node_id': node_id, 'nodegroup_ids': []}
+    node_id = found['node_id']
+
+    fields = node['pcu'].fields()
+    pcu = snapshot.pcus.get(fields['hostname'])
+    if pcu is None:
+        pcu_id = Ref('pcu:%s' % fields['hostname'])
+        changes.append(Change('AddPCU', [node['login_base'], fields],
+                              "Adding PCU to %s: %s" % (hostname, fields),
+                              ref=pcu_id['ref']))
+        changes.append(Change('AddNodeToPCU', [node_id, pcu_id, 1],
+                              "Adding %s to PCU %s" % (hostname,
+                                                       fields['hostname'])))
+    elif node_id in pcu['node_ids']:
+        print ("Confirmed PCU %s is associated with node %s" %
+               (pcu['hostname'], hostname))
+    else:
+        print "ERROR: need to add pcu node_id %s" % node_id
+        sys.exit(1)
+
+    def diff_node_tag(tagname, value):
+        tags = _lookup(snapshot.node_tags, node_id, tagname)
+        return DiffTag('Node', hostname, node_id, tags, tagname, value,
+                       'node_tag_id')
+
+    if node['arch'] != '':
+        changes += diff_node_tag('arch', node['arch'])
+
+    if addnodes:
+        nodegroup_name = node['nodegroup']
+        nodegroup = snapshot.nodegroups.get(nodegroup_name)
+        if nodegroup is None:
+            print ("ERROR: found 0 nodegroups when looking for %s in plc db" %
+                   nodegroup_name)
+            print "ERROR: expected 1; please double check configuration"
+            sys.exit(1)
+        if nodegroup['nodegroup_id'] not in found['nodegroup_ids']:
+            changes += diff_node_tag('deployment', nodegroup_name)
+        else:
+            print ("Confirmed: %s is in nodegroup %s" %
+                   (hostname, nodegroup_name))
+        # TODO: find a better place for this.
+        if nodegroup_name in ['MeasurementLabCentos']:
+            changes += diff_node_tag('fcdistro', 'centos6')
+
+    changes += DiffInterfaces(snapshot, node, node_id, addinterfaces)
+    return changes
+
+
+def _attr_context(snapshot, attr):
+    """Returns the (hostname, nodegroup, node_id, nodegroup_id) of attr.
+
+    Args:
+        snapshot: Snapshot, the PLC objects loaded by load_slice().
+        attr: model.Attr, the declared slice attribute.
+
+    Returns:
+        tuple, hostname and nodegroup names, and their ids, or None for each
+        when attr applies to all nodes.
+
+    Raises:
+        Exception, if attr is malformed.
+    """
+    attrtype = attr['attrtype']
+    if attrtype == 'all':
+        return (None, None, None, None)
+    if attrtype == 'hostname':
+        found = snapshot.nodes.get(attr['hostname'])
+        if found is None:
+            print "ERROR: node %s not found in plc db" % attr['hostname']
+            sys.exit(1)
+        return (attr['hostname'], None, found['node_id'], None)
+    if attrtype == 'nodegroup':
+        found = snapshot.nodegroups.get(attr['nodegroup'])
+        if found is None:
+            print ("ERROR: found 0 nodegroups when looking for %s in plc db" %
+                   attr['nodegroup'])
+            sys.exit(1)
+        return (None, attr['nodegroup'], None, found['nodegroup_id'])
+    raise Exception("no attrtype in %s" % attr)
+
+
+def DiffSliceAttributes(snapshot, slicename, attrs):
+    """Returns the changes needed to set all declared attributes on a slice.
+
+    This is the in-memory equivalent of calling sync.SyncSliceAttribute() for
+    every attr. A slice tag matches an attribute when its tagname, node_id and
+    nodegroup_id are all equal. Only 'vsys' tags may have multiple values, so
+    they are added but never updated. Other tags are added or updated.
+
+    Args:
+        snapshot: Snapshot, the PLC objects loaded by load_slice().
+        slicename: str, the name of the slice.
+        attrs: list of model.Attr, every declared attribute of the slice.
+
+    Returns:
+        list of Change
+
+    Raises:
+        Exception, if an attr is malformed.
+    """
+    changes = []
+    planned = set()
+    for attr in attrs:
+        (nd, ng, nd_id, ng_id) = _attr_context(snapshot, attr)
+        keys = [k for k in attr.keys()
+                if k not in ['attrtype', attr['attrtype']]]
+        for k in sorted(keys):
+            value = attr[k]
+            if (k, nd_id, ng_id, value) in planned:
+                continue
+            found = _lookup(snapshot.slice_tags, k, nd_id, ng_id)
+            context = "%s -> (%s,%s,%s,%s)" % (slicename, k, value, nd, ng)
+            if k in ['vsys']:
+                # NOTE: these keys can have multiples with different values.
+                #       So, do not perform updates.
+                if any(tag['value'] == value for tag in found):
+                    print "Confirmed: %s" % context
+                    continue
+                # NOTE: like the GetSliceTags filter of SyncSliceAttribute(),
+                #       only look in the scope of attr: on its node, in its
+                #       nodegroup, or anywhere for 'all'.
+                elsewhere = [tag for key, tags in snapshot.slice_tags.items()
+                             if key[0] == k and
+                             (nd_id is None or key[1] == nd_id) and
+                             (ng_id is None or key[2] == ng_id)
+                             for tag in tags if tag['value'] == value]
+                if elsewhere:
+                    print "Found attr value but maybe in wrong NG/Node?"
+                    print ("?SHOULD I UPDATE THIS? %s with %s" %
+                           (elsewhere[-1], attr))
+                    continue
+            elif len(found) == 1:
+                # NOTE: these keys should only have a single value for the
+                #       given key, so do perform updates.
+                if found[0]['value'] == value:
+                    print "Confirmed: %s" % context
+                else:
+                    msg = ("UPDATING : %s -> (%s,%s,%s)\n"
+                           "         : from '%s' to '%s'" %
+                           (slicename, k, nd, ng, found[0]['value'], value))
+                    changes.append(Change(
+                        'UpdateSliceTag', [found[0]['slice_tag_id'], value],
+                        msg))
+                continue
+            elif len(found) > 1:
+                print ("ERROR: found %s slice tags for %s on %s" %
+                       (len(found), k, context))
+                print "ERROR: expected only 1, plese correct this."
+                sys.exit(1)
+
+            planned.add((k, nd_id, ng_id, value))
+            args = [slicename, k, value]
+            if nd is not None or ng is not None:
+                args.append(nd)
+            if ng is not None:
+                args.append(ng)
+            msg = "ADDING   : %s -> (%s->%s,%s,%s)" % (slicename, k, value,
+                                                     nd, ng)
+            changes.append(Change('AddSliceTag', args, msg))
+    return changes
+
+
+def DiffSites(snapshot, sites, onhost, withnodes, addnodes, addinterfaces):
+    """Returns the stages of changes needed to create and sync sites.
+
+    Args:
+        snapshot: Snapshot, the PLC objects loaded for sites.
+        sites: list of model.Site, the declared sites.
+        onhost: str, limit actions on sites to a single host.
+        withnodes: bool, if True, also sync the nodes of sites.
+        addnodes: bool, if True, add/confirm the node nodegroups.
+        addinterfaces: bool, if True, add interface configuration to nodes.
+
+    Returns:
+        list of stages: the changes of every site, then of every node, with
+        one group per site or node.
+    """
+    site_groups = []
+    node_groups = []
+    for site in sites:
+        print "Reconciling: site", site['name']
+        site_groups.append(DiffSite(snapshot, site))
+        if withnodes:
+            for node in SelectedNodes(site, onhost):
+                node_groups.append(DiffNode(snapshot, node, addnodes,
+                                            addinterfaces))
+    return [[group for group in site_groups if group],
+            [group for group in node_groups if group]]
+
+
+def _resolve(arg, results):
+    """Returns arg with every Ref() replaced by the referenced result."""
+    if isinstance(arg, dict):
+        if set(arg.keys()) == set(['ref', 'text']):
+            value = results[arg['ref']]
+            return str(value) if arg['text'] else value
+        return dict((k, _resolve(v, results)) for k, v in arg.iteritems())
+    if isinstance(arg, list):
+        return [_resolve(a, results) for a in arg]
+    return arg
+
+
+def ApplyChanges(changes):
+    """Applies every change, in order, using the global session API.
+
+    Args:
+        changes: list of Change, as returned by the Diff*() functions.
+
+    Returns:
+        dict, ref name -> result for all changes with a ref.
+    """
+    results = {}
+    for change in changes:
+        print change['message']
+        method = change['method']
+        args = _resolve(change['args'], results)
+        try:
+            result = getattr(s.api, method)(*args)
+        except xmlrpclib.Fault, e:
+            sync.handle_xmlrpclib_Fault("%s()" % method, e)
+        if change['ref'] is not None:
+            results[change['ref']] = result
+    return results
+
+
+def ApplyStages(stages, workers=1):
+    """Applies every stage, in order, using the global session API.
+
+    Args:
+        stages: list of stages, as returned by DiffSites() or ReadPlan().
+        workers: int, the maximum number of groups to apply concurrently.
+    """
+    print "Applying %d changes" % sum(len(group) for stage in stages
+                                      for group in stage)
+    for stage in stages:
+        parallel.run(ApplyChanges, stage, workers)
+
+
+def WritePlan(fname, stages):
+    """Saves stages to the plan file fname, as JSON.
+
+    Empty stages are not saved.
+
+    Args:
+        fname: str, the name of the plan file.
+        stages: list of stages, as returned by DiffSites().
+    """
+    with open(fname, 'w') as plan:
+        json.dump({'version': PLAN_VERSION,
+                   'stages': [stage for stage in stages if stage]},
+                  plan, indent=1, separators=(',', ': '), sort_keys=True)
+        plan.write('\n')
+
+
+def ReadPlan(fname):
+    """Returns the stages saved to the plan file fname by WritePlan().
+
+    Args:
+        fname: str, the name of the plan file.
+
+    Returns:
+        list of stages, with every Change() and Ref() as a plain dict.
+
+    Raises:
+        Exception, if the plan file has an unsupported version.
+    """
+    with open(fname) as plan:
+        saved = json.load(plan)
+    if saved.get('version') != PLAN_VERSION:
+        raise Exception("unsupported plan version %s in %s, expected %s" %
+                        (saved.get('version'), fname, PLAN_VERSION))
+    return saved['stages']
+
+
+def PlanSites(sites, onhost, addnodes, addinterfaces):
+    """Returns the stages of changes needed to create and sync sites.
+
+    Args:
+        sites: list of model.Site, the sites to create or update.
+        onhost: str, limit actions on sites to a single host.
+        addnodes: bool, if True, add/confirm nodes.
+        addinterfaces: bool, if True, add interface configuration to nodes.
+
+    Returns:
+        list of stages, see DiffSites().
+    """
+    snapshot = Snapshot()
+    snapshot.load(s.api, sites, onhost, addnodes)
+    return DiffSites(snapshot, sites, onhost, addnodes, addnodes,
+                     addinterfaces)
+
+
+def PlanSliceAttributes(slicename, attrs, skipmissing=False):
+    """Returns the stages of changes needed to set the attributes of a slice.
+
+    Args:
+        slicename: str, the name of the slice.
+        attrs: list of model.Attr, every declared attribute of the slice.
+        skipmissing: bool, if True, skip the attributes of nodes and
+            nodegroups not found in the PLC DB, instead of exiting.
+
+    Returns:
+        list of stages, with one group per change, since slice tag changes
+        never Ref() each other.
+    """
+    hostnames = sorted(set(attr['hostname'] for attr in attrs
+                           if attr['attrtype'] == 'hostname'))
+    groupnames = sorted(set(attr['nodegroup'] for attr in attrs
+                            if attr['attrtype'] == 'nodegroup'))
+    snapshot = Snapshot()
+    snapshot.load_slice(s.api, slicename, hostnames, groupnames)
+
+    if skipmissing:
+        for hostname in hostnames:
+            if hostname not in snapshot.nodes:
+                print ("WARNING: node %s not found in plc db, skipping its "
+                       "attributes of %s" % (hostname, slicename))
+        for groupname in groupnames:
+            if groupname not in snapshot.nodegroups:
+                print ("WARNING: nodegroup %s not found in plc db, skipping "
+                       "its attributes of %s" % (groupname, slicename))
+        attrs = [attr for attr in attrs
+                 if (attr['attrtype'] != 'hostname' or
+                     attr['hostname'] in snapshot.nodes) and
+                 (attr['attrtype'] != 'nodegroup' or
+                  attr['nodegroup'] in snapshot.nodegroups)]
+
+    changes = DiffSliceAttributes(snapshot, slicename, attrs)
+    return [[[change] for change in changes]]
+
+
+def PlanSlices(slices, onhost, addsliceips):
+    """Returns the stages of changes needed to set the attributes of slices.
+
+    Slices are not created by a plan, so slices not found in the PLC DB are
+    skipped. Attributes of nodes and nodegroups not found in the PLC DB, e.g.
+    nodes that a site stage of the same plan will create, are also skipped.
+    Planning again after the plan is applied includes them.
+
+    Args:
+        slices: list of model.Slice, the slices to sync.
+        onhost: str, limit per-node attributes to matching hosts.
+        addsliceips: bool, if True, include the slice IPs of every node.
+
+    Returns:
+        list of stages, with a single stage, since changes to different
+        slices are independent.
+    """
+    found = set()
+    if slices:
+        found = set(sslice['name'] for sslice in s.api.GetSlices(
+            [sslice['name'] for sslice in slices], ['name']))
+    groups = []
+    for sslice in slices:
+        if sslice['name'] not in found:
+            print ("WARNING: slice %s not found in plc db, skipping it" %
+                   sslice['name'])
+            continue
+        print "Planning: slice", sslice['name']
+        attrs = sync.SliceAttributes(sslice, onhost, addsliceips)
+        for stage in PlanSliceAttributes(sslice['name'], attrs,
+                                         skipmissing=True):
+            groups += stage
+    return [groups]
+
+
+def ReconcileSites(sites, onhost, addusers, addnodes, addinterfaces,
+                   getbootimages, createusers, nodekeykeep, workers=1):
+    """Creates and/or Updates sites (and all children) in the PLC DB.
+
+    ReconcileSites is equivalent to calling sync.SyncSite() for every site,
+    but reads the PLC DB once up front and only issues the necessary changes.
+
+    Args:
+        sites: list of model.Site, the sites to create or update.
+        onhost: str, limit actions on sites to a single host.
+        addusers: bool, if True, add/confirm users.
+        addnodes: bool, if True, add/confirm nodes.
+        addinterfaces: bool, if True, add interface configuration to nodes.
+        getbootimages: bool, if True, also download node bootimages to .iso.
+        createusers: bool, if True, also create declared users not found in db.
+        nodekeykeep: bool, if True, keep the same node key for boot images.
+        workers: int, the maximum number of nodes to change, or boot images
+            to fetch, concurrently.
+    """
+    withnodes = addnodes or getbootimages
+    snapshot = Snapshot()
+    snapshot.load(s.api, sites, onhost, withnodes)
+
+    stages = DiffSites(snapshot, sites, onhost, withnodes, addnodes,
+                       addinterfaces)
+    ApplyStages(stages, workers)
+
+    if addusers:
+        for site in sites:
+            sync.SyncPersonsOnSite(site['users'], site['login_base'],
+                                   createusers)
+    if getbootimages:
+        hostnames = [node.hostname() for site in sites
+                     for node in SelectedNodes(site, onhost)]
+        sync.GetBootimages(hostnames, imagetype="iso", nodekeykeep=nodekeykeep,
+                           workers=workers)
+
+
+def ReconcileSliceAttributes(slicename, attrs, workers=1):
+    """Adds and/or updates the declared attributes of a slice in the PLC DB.
+
+    ReconcileSliceAttributes is equivalent to calling sync.SyncSliceAttribute()
+    for every attr, but reads all slice tags of the slice with one request.
+
+    Args:
+        slicename: str, the name of the slice.
+        attrs: list of model.Attr, every declared attribute of the slice.
+        workers: int, the maximum number of changes to apply concurrently.
+    """
+    ApplyStages(PlanSliceAttributes(slicename, attrs), workers)
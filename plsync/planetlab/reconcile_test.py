@@ -0,0 +1,271 @@
+"""Tests for reconcile."""
+
+import mock
+import model
+import os
+import reconcile
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+
+class ReconcileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.users = [('User', 'Name', 'username@gmail.com')]
+        self.site = model.makesite(
+            'abc01', '192.168.1.0', '2400:1002:4008::', 'Some City', 'US',
+            36.850000, 74.783000, self.users, count=1, arch='x86_64',
+            nodegroup='MeasurementLabCentos')
+        self.node = self.site['nodes']['mlab1.abc01.measurement-lab.org']
+        self.snapshot = reconcile.Snapshot()
+        self.snapshot.nodegroups = {
+            'MeasurementLabCentos': {'nodegroup_id': 7,
+                                     'groupname': 'MeasurementLabCentos'}}
+        self.snapshot.tagtypes = dict(
+            (name, {'tag_type_id': i, 'tagname': name})
+            for i, name in enumerate(['alias', 'ifname', 'ovs_bridge',
+                                      'ipv6_defaultgw', 'ipv6addr',
+                                      'ipv6addr_secondaries']))
+        # Silence the progress messages printed by the Diff functions.
+        patcher = mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_node_to_snapshot(self):
+        """Adds node, PCU, tags, and all interfaces of self.node to snapshot."""
+        hostname = self.node.hostname()
+        self.snapshot.nodes[hostname] = {
+            'node_id': 10, 'hostname': hostname, 'nodegroup_ids': [7]}
+        self.snapshot.pcus[self.node['pcu'].hostname()] = {
+            'pcu_id': 20, 'hostname': self.node['pcu'].hostname(),
+            'node_ids': [10]}
+        self.snapshot.node_tags = {
+            (10, 'arch'): [{'node_tag_id': 1, 'value': 'x86_64'}],
+            (10, 'fcdistro'): [{'node_tag_id': 2, 'value': 'centos6'}]}
+        primary = dict(self.node.interface(), interface_id=100)
+        interfaces = [primary]
+        tags = {}
+        for tagname, value in self.node.v6interface_tags().iteritems():
+            tags[(100, tagname)] = [{'interface_tag_id': 1000 + len(tags),
+                                     'value': value}]
+        for i, ip in enumerate(self.node.iplist()):
+            interface_id = 101 + i
+            interfaces.append(dict(primary, ip=ip, is_primary=False,
+                                   interface_id=interface_id))
+            tags[(interface_id, 'alias')] = [
+                {'interface_tag_id': 2000 + i, 'value': str(interface_id)}]
+            tags[(interface_id, 'ifname')] = [
+                {'interface_tag_id': 3000 + i, 'value': 'eth0'}]
+        self.snapshot.interfaces = {10: interfaces}
+        self.snapshot.interface_tags = tags
+
+    def test_diff_node_when_node_is_in_sync(self):
+        self.add_node_to_snapshot()
+
+        changes = reconcile.DiffNode(self.snapshot, self.node, True, True)
+
+        self.assertEqual(changes, [])
+
+    def test_diff_node_when_node_tag_is_different(self):
+        self.add_node_to_snapshot()
+        self.snapshot.node_tags[(10, 'arch')][0]['value'] = 'i386'
+
+        changes = reconcile.DiffNode(self.snapshot, self.node, True, True)
+
+        self.assertEqual(changes, [reconcile.Change(
+            'UpdateNodeTag', [1, 'x86_64'], mock.ANY)])
+
+    def test_diff_node_when_node_is_missing(self):
+        changes = reconcile.DiffNode(self.snapshot, self.node, True, True)
+
+        methods = [c['method'] for c in changes]
+        self.assertEqual(methods[:5], ['AddNode', 'AddPCU', 'AddNodeToPCU',
+                                       'AddNodeTag', 'AddNodeTag'])
+        # One primary and 12 secondary interfaces.
+        self.assertEqual(methods.count('AddInterface'), 13)
+        # Three IPv6 tags, and an alias and ifname tag per secondary.
+        self.assertEqual(methods.count('AddInterfaceTag'), 3 + 2 * 12)
+        self.assertEqual(changes[0]['ref'], 'node:' + self.node.hostname())
+        self.assertEqual(changes[3]['args'][0],
+                         reconcile.Ref('node:' + self.node.hostname()))
+
+    def test_diff_node_adds_missing_secondary_interface_with_alias(self):
+        self.add_node_to_snapshot()
+        missing = self.node.iplist()[3]
+        self.snapshot.interfaces[10] = [
+            i for i in self.snapshot.interfaces[10] if i['ip'] != missing]
+
+        changes = reconcile.DiffNode(self.snapshot, self.node, True, True)
+
+        ref = 'interface:' + missing
+        self.assertEqual(len(changes), 3)
+        self.assertEqual(changes[0]['method'], 'AddInterface')
+        self.assertEqual(changes[0]['ref'], ref)
+        self.assertEqual(changes[1]['args'],
+                         [reconcile.Ref(ref), 0, reconcile.Ref(ref, text=True)])
+        self.assertEqual(changes[2]['args'], [reconcile.Ref(ref), 1, 'eth0'])
+
+    def test_diff_node_does_not_update_alias(self):
+        self.add_node_to_snapshot()
+        self.snapshot.interface_tags[(101, 'alias')][0]['value'] = '1'
+
+        changes = reconcile.DiffNode(self.snapshot, self.node, True, True)
+
+        self.assertEqual(changes, [])
+
+    def test_diff_site_when_site_is_missing(self):
+        changes = reconcile.DiffSite(self.snapshot, self.site)
+
+        self.assertEqual([c['method'] for c in changes],
+                         ['AddSite', 'AddSiteTag', 'AddSiteTag', 'UpdateSite'])
+        self.assertEqual(changes[3]['args'],
+                         [reconcile.Ref('site:mlababc01'),
+                          {'latitude': 36.85, 'longitude': 74.783}])
+
+    @mock.patch.object(reconcile.s, 'api')
+    def test_apply_changes_resolves_refs(self, mock_api):
+        mock_api.AddInterface.return_value = 55
+        changes = [
+            reconcile.Change('AddInterface', [10, {'ip': '192.168.1.10'}],
+                             'add', ref='iface'),
+            reconcile.Change('AddInterfaceTag',
+                             [reconcile.Ref('iface'), 0,
+                              reconcile.Ref('iface', text=True)], 'tag'),
+        ]
+
+        results = reconcile.ApplyChanges(changes)
+
+        self.assertEqual(results, {'iface': 55})
+        mock_api.AddInterfaceTag.assert_called_once_with(55, 0, '55')
+
+
+    def test_diff_slice_attributes_adds_updates_and_confirms(self):
+        hostname = self.node.hostname()
+        self.snapshot.nodes = {hostname: {'node_id': 10,
+                                          'hostname': hostname}}
+        self.snapshot.slice_tags = reconcile._index([
+            {'slice_tag_id': 1, 'tagname': 'vsys', 'value': 'slice_restart',
+             'node_id': None, 'nodegroup_id': None},
+            {'slice_tag_id': 2, 'tagname': 'disk_max', 'value': '100',
+             'node_id': None, 'nodegroup_id': 7},
+            {'slice_tag_id': 3, 'tagname': 'ip_addresses',
+             'value': '192.168.1.11', 'node_id': 10, 'nodegroup_id': None},
+        ], 'tagname', 'node_id', 'nodegroup_id')
+        attrs = [model.Attr(None, vsys='slice_restart'),
+                 model.Attr(None, vsys='slice_update'),
+                 model.Attr('MeasurementLabCentos', disk_max='200'),
+                 model.Attr(hostname, ip_addresses='192.168.1.11'),
+                 model.Attr(hostname, initscript='mlab_generic_initscript')]
+
+        changes = reconcile.DiffSliceAttributes(self.snapshot, 'abc_bar',
+                                                attrs)
+
+        self.assertEqual(changes, [
+            reconcile.Change('AddSliceTag',
+                             ['abc_bar', 'vsys', 'slice_update'], mock.ANY),
+            reconcile.Change('UpdateSliceTag', [2, '200'], mock.ANY),
+            reconcile.Change('AddSliceTag',
+                             ['abc_bar', 'initscript',
+                              'mlab_generic_initscript', hostname],
+                             mock.ANY)])
+
+    def test_diff_slice_attributes_keeps_vsys_in_other_context(self):
+        self.snapshot.slice_tags = reconcile._index([
+            {'slice_tag_id': 1, 'tagname': 'vsys', 'value': 'slice_restart',
+             'node_id': None, 'nodegroup_id': 7}],
+            'tagname', 'node_id', 'nodegroup_id')
+        attrs = [model.Attr(None, vsys='slice_restart'),
+                 model.Attr('MeasurementLabCentos', vsys='slice_restart')]
+
+        changes = reconcile.DiffSliceAttributes(self.snapshot, 'abc_bar',
+                                                attrs)
+
+        self.assertEqual(changes, [])
+
+    def test_diff_slice_attributes_adds_node_vsys_also_set_for_all(self):
+        hostname = self.node.hostname()
+        self.snapshot.nodes = {hostname: {'node_id': 10,
+                                          'hostname': hostname}}
+        self.snapshot.slice_tags = reconcile._index([
+            {'slice_tag_id': 1, 'tagname': 'vsys', 'value': 'slice_restart',
+             'node_id': None, 'nodegroup_id': None},
+            {'slice_tag_id': 2, 'tagname': 'vsys', 'value': 'slice_update',
+             'node_id': 11, 'nodegroup_id': None}],
+            'tagname', 'node_id', 'nodegroup_id')
+        attrs = [model.Attr(hostname, vsys='slice_restart'),
+                 model.Attr(hostname, vsys='slice_update')]
+
+        changes = reconcile.DiffSliceAttributes(self.snapshot, 'abc_bar',
+                                                attrs)
+
+        self.assertEqual(changes, [
+            reconcile.Change('AddSliceTag',
+                             ['abc_bar', 'vsys', 'slice_restart', hostname],
+                             mock.ANY),
+            reconcile.Change('AddSliceTag',
+                             ['abc_bar', 'vsys', 'slice_update', hostname],
+                             mock.ANY)])
+
+    @mock.patch.object(reconcile.s, 'api')
+    def test_reconcile_slice_attributes_reads_slice_tags_once(self, mock_api):
+        hostname = self.node.hostname()
+        batch = mock_api.multicall.return_value
+        batch.run.return_value = [
+            [], [{'node_id': 10, 'hostname': hostname}]]
+        attrs = [model.Attr(None, vsys='slice_restart'),
+                 model.Attr(hostname, ip_addresses='192.168.1.11')]
+
+        reconcile.ReconcileSliceAttributes('abc_bar', attrs)
+
+        batch.GetSliceTags.assert_called_once_with({'name': 'abc_bar'})
+        batch.GetNodes.assert_called_once_with({'hostname': [hostname]},
+                                               ['node_id', 'hostname'])
+        self.assertFalse(batch.GetNodeGroups.called)
+        self.assertEqual(mock_api.AddSliceTag.call_args_list, [
+            mock.call('abc_bar', 'vsys', 'slice_restart'),
+            mock.call('abc_bar', 'ip_addresses', '192.168.1.11', hostname)])
+
+
+    def test_diff_sites_adds_sites_before_nodes(self):
+        changes = reconcile.DiffSites(self.snapshot, [self.site], None, True,
+                                      True, True)
+
+        self.assertEqual(len(changes), 2)
+        self.assertEqual([c['method'] for c in changes[0][0]],
+                         ['AddSite', 'AddSiteTag', 'AddSiteTag', 'UpdateSite'])
+        self.assertEqual(len(changes[1]), 1)
+        self.assertEqual(changes[1][0][0]['method'], 'AddNode')
+
+    @mock.patch.object(reconcile.s, 'api')
+    def test_apply_stages_from_plan_file_resolves_refs(self, mock_api):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        fname = os.path.join(tempdir, 'test.plan')
+        mock_api.AddSite.return_value = 3
+        stages = [[[
+            reconcile.Change('AddSite', [{'login_base': 'abc01'}], 'add',
+                             ref='site:abc01'),
+            reconcile.Change('AddSiteTag',
+                             [reconcile.Ref('site:abc01'), 'city', 'x'],
+                             'tag')]]]
+
+        reconcile.WritePlan(fname, stages)
+        reconcile.ApplyStages(reconcile.ReadPlan(fname))
+
+        mock_api.AddSiteTag.assert_called_once_with(3, 'city', 'x')
+
+    def test_read_plan_with_unsupported_version_raises_exception(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        fname = os.path.join(tempdir, 'test.plan')
+        with open(fname, 'w') as plan:
+            plan.write('{"version": 0, "stages": []}')
+
+        with self.assertRaises(Exception):
+            reconcile.ReadPlan(fname)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,24 +1,80 @@
 #!/usr/bin/env python
 
 import ConfigParser
+import copy
 import getpass
+import json
 import os
+import Queue
 import sys
+import tempfile
+import threading
+import time
 import xmlrpclib
 import ssl
 
 API_URL = "https://boot.planet-lab.org/PLCAPI/"
+# NOTE: PLCAPI returns fault code 100 (invalid method); other XML-RPC servers
+# use the standard -32601 (method not found).
+MULTICALL_UNSUPPORTED_CODES = [100, -32601]
+# NOTE: results of these calls are cached for the rest of a run, until a call
+# listed in CACHE_INVALIDATES changes them. GetNodes, GetSites and GetSlices
+# change during a sync, so they are only correct while CACHE_INVALIDATES lists
+# every write made through API, with every cached method the write may change.
+# session_test checks that every write used by plsync, and every write of the
+# plcserver stand-in, is listed.
+CACHEABLE_METHODS = ['GetNodeGroups', 'GetNodes', 'GetSites', 'GetSlices',
+                     'GetTagTypes']
+# Mutating calls, and the cached methods whose results they may change. Other
+# mutating calls clear the whole cache.
+CACHE_INVALIDATES = {
+    'AddInterface': ['GetNodes'],
+    'AddInterfaceTag': [],
+    'AddNode': ['GetNodes', 'GetSites'],
+    'AddNodeGroup': ['GetNodeGroups', 'GetNodes'],
+    'AddNodeTag': ['GetNodes', 'GetNodeGroups'],
+    'AddNodeToPCU': ['GetNodes'],
+    'AddPCU': ['GetSites'],
+    'AddPerson': [],
+    'AddPersonToSite': ['GetSites'],
+    'AddPersonToSlice': ['GetSlices'],
+    'AddSite': ['GetSites'],
+    'AddSiteTag': ['GetSites'],
+    'AddSlice': ['GetSites', 'GetSlices'],
+    'AddSliceTag': ['GetSlices'],
+    'AddSliceToNodes': ['GetNodes', 'GetSlices'],
+    'AddSliceToNodesWhitelist': ['GetNodes', 'GetSlices'],
+    'AddTagType': ['GetTagTypes'],
+    'DeleteInterface': ['GetNodes'],
+    'DeletePersonFromSite': ['GetSites'],
+    'DeleteSliceFromNodes': ['GetNodes', 'GetSlices'],
+    'DeleteSliceFromNodesWhitelist': ['GetNodes', 'GetSlices'],
+    'DeleteSliceTag': ['GetSlices'],
+    'UpdateInterface': [],
+    'UpdateInterfaceTag': [],
+    'UpdateNode': ['GetNodes'],
+    'UpdateNodeTag': ['GetNodes', 'GetNodeGroups'],
+    'UpdatePCU': [],
+    'UpdatePerson': [],
+    'UpdateSite': ['GetSites'],
+    'UpdateSiteTag': ['GetSites'],
+    'UpdateSlice': ['GetSlices'],
+    'UpdateSliceTag': ['GetSlices'],
+}
+# Upper bounds, in seconds, of the request latency histogram buckets.
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+METRICS_PREFIX = 'plsync_api'
 PLC_CONFIG="/etc/planetlab.conf"
 SESSION_DIR=os.environ['HOME'] + "/.ssh"
 SESSION_FILE=SESSION_DIR + "/mlab_session"
 
 api = None
 
-def setup_global_session(url, debug, verbose, plcconfig=None):
+def setup_global_session(url, debug, verbose, plcconfig=None, connections=1):
     global api
     global API_URL
     API_URL=url
-    api = getapi(debug, verbose, plcconfig)
+    api = getapi(debug, verbose, plcconfig, connections)
     return api
 
 def read_plc_config(filename):
@@ -41,43 +97,446 @@ def read_plc_config(filename):
     pw = config.get("MyPLC", "password")
     return (un, pw)
 
+class Cache:
+    """Cache memoizes the results of CACHEABLE_METHODS for a single run.
+
+    Entries are keyed on the method name and its arguments. Every method has
+    a generation, which invalidate() increments, so that a result read before
+    a write is not saved after the write. Cache is safe to use from multiple
+    threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, name, params):
+        """Returns the cache key for name(*params), or None if not cacheable."""
+        if name not in CACHEABLE_METHODS:
+            return None
+        try:
+            return json.dumps(params, sort_keys=True)
+        except TypeError:
+            return None
+
+    def get(self, name, params):
+        """Returns (found, result, generation) for name(*params).
+
+        On a cache hit, found is True and result is the saved result. On a
+        miss, found is False, and generation must be passed to put() with the
+        result of the call.
+        """
+        key = self.key(name, params)
+        if key is None:
+            return (False, None, None)
+        with self.lock:
+            if key in self.entries.get(name, {}):
+                self.hits += 1
+                return (True, copy.deepcopy(self.entries[name][key]), None)
+            self.misses += 1
+            return (False, None, self.generations.get(name, 0))
+
+    def put(self, name, params, result, generation):
+        """Saves the result of name(*params), if name is cacheable.
+
+        The result is dropped if name was invalidated since get() returned
+        generation, since it may have been read before the write.
+        """
+        key = self.key(name, params)
+        if key is None:
+            return
+        with self.lock:
+            if self.generations.get(name, 0) != generation:
+                return
+            self.entries.setdefault(name, {})[key] = copy.deepcopy(result)
+
+    def invalidate(self, name):
+        """Drops the cached results that a call to name may have changed."""
+        if name.startswith('Get') or name == 'AuthCheck':
+            return
+        methods = CACHE_INVALIDATES.get(name, CACHEABLE_METHODS)
+        with self.lock:
+            for method in methods:
+                self.entries.pop(method, None)
+                self.generations[method] = self.generations.get(method, 0) + 1
+
+    def summary(self):
+        return "cache: %s hits, %s misses" % (self.hits, self.misses)
+
+def get_caller():
+    """Returns the name of the innermost caller outside of this module."""
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_globals.get('__name__') == __name__:
+        frame = frame.f_back
+    if frame is None:
+        return 'unknown'
+    return frame.f_code.co_name
+
+class Metrics:
+    """Metrics aggregates the latency, size and retries of every API request.
+
+    Requests are aggregated by sync phase, calling function, and method. Calls
+    sent together with system.multicall are one request, and every call in it
+    is also counted for its own method. Metrics is safe to use from multiple
+    threads.
+
+    Example:
+        api.metrics.set_phase('syncsite')
+        ...
+        print api.metrics.summary()
+        api.metrics.write_textfile('/var/lib/node_exporter/plsync.prom')
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phase = 'setup'
+        self.entries = {}
+
+    def set_phase(self, phase):
+        """Sets the phase of all following requests, e.g. 'syncsite'."""
+        self.phase = phase
+
+    def _entry(self, caller, method):
+        key = (self.phase, caller, method)
+        if key not in self.entries:
+            self.entries[key] = {
+                'calls': 0, 'requests': 0, 'errors': 0, 'retries': 0,
+                'seconds': 0.0, 'bytes_sent': 0, 'bytes_received': 0,
+                'buckets': [0] * len(LATENCY_BUCKETS)}
+        return self.entries[key]
+
+    def record(self, method, caller, seconds, transport, error=False,
+               calls=()):
+        """Saves the measurements of one request.
+
+        Args:
+            method: str, the method of the request, e.g. 'GetNodes'.
+            caller: str, the name of the function that made the request.
+            seconds: float, the latency of the request.
+            transport: TransportMeter, the transport that sent the request.
+            error: bool, True if the request failed.
+            calls: list of str, the method of every call in a system.multicall.
+        """
+        with self.lock:
+            entry = self._entry(caller, method)
+            entry['requests'] += 1
+            if not calls:
+                entry['calls'] += 1
+            entry['errors'] += int(error)
+            entry['retries'] += transport.retries()
+            entry['seconds'] += seconds
+            entry['bytes_sent'] += transport.bytes_sent
+            entry['bytes_received'] += transport.bytes_received
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    entry['buckets'][i] += 1
+            for name in calls:
+                self._entry(caller, name)['calls'] += 1
+
+    def records(self):
+        """Returns the measurements of every phase, caller and method."""
+        with self.lock:
+            records = []
+            for (phase, caller, method), entry in sorted(self.entries.items()):
+                record = dict(entry, phase=phase, caller=caller,
+                              method=method)
+                record['buckets'] = list(entry['buckets'])
+                records.append(record)
+        return records
+
+    def summary(self):
+        """Returns a table of every phase and method, slowest first."""
+        totals = {}
+        order = []
+        for record in self.records():
+            key = (record['phase'], record['method'])
+            if key not in totals:
+                totals[key] = dict.fromkeys(
+                    ['requests', 'calls', 'errors', 'retries', 'seconds',
+                     'bytes_sent', 'bytes_received'], 0)
+            if record['phase'] not in order:
+                order.append(record['phase'])
+            for field in totals[key]:
+                totals[key][field] += record[field]
+
+        row = "%-12s %-30s %8s %8s %6s %7s %9s %8s %10s %10s"
+        lines = [row % ('phase', 'method', 'requests', 'calls', 'errors',
+                        'retries', 'total s', 'mean ms', 'sent KB',
+                        'recv KB')]
+        keys = sorted(totals, key=lambda k: (order.index(k[0]),
+                                             -totals[k]['seconds'], k[1]))
+        for key in keys:
+            t = totals[key]
+            mean = 1000 * t['seconds'] / t['requests'] if t['requests'] else 0
+            lines.append(row % (key[0], key[1], t['requests'], t['calls'],
+                                t['errors'], t['retries'],
+                                '%.3f' % t['seconds'], '%.1f' % mean,
+                                t['bytes_sent'] / 1024,
+                                t['bytes_received'] / 1024))
+        return "\n".join(lines)
+
+    def prometheus_text(self):
+        """Returns the measurements in the Prometheus text format."""
+        counters = [
+            ('requests', 'requests_total', 'API requests sent.'),
+            ('calls', 'calls_total',
+             'API calls, including calls in system.multicall.'),
+            ('errors', 'errors_total', 'API requests that failed.'),
+            ('retries', 'retries_total', 'API requests that were retried.'),
+            ('bytes_sent', 'request_bytes_total',
+             'Size of the XML-RPC request bodies.'),
+            ('bytes_received', 'response_bytes_total',
+             'Size of the XML-RPC response bodies.'),
+        ]
+        records = self.records()
+        lines = []
+        for field, name, description in counters:
+            name = '%s_%s' % (METRICS_PREFIX, name)
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s counter' % name)
+            for record in records:
+                lines.append('%s{%s} %s' % (name, labels(record),
+                                            record[field]))
+
+        name = '%s_request_duration_seconds' % METRICS_PREFIX
+        lines.append('# HELP %s Latency of API requests.' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for record in records:
+            if not record['requests']:
+                continue
+            bounds = [str(b) for b in LATENCY_BUCKETS] + ['+Inf']
+            counts = record['buckets'] + [record['requests']]
+            for bound, count in zip(bounds, counts):
+                lines.append('%s_bucket{%s,le="%s"} %s' % (
+                    name, labels(record), bound, count))
+            lines.append('%s_sum{%s} %s' % (name, labels(record),
+                                             record['seconds']))
+            lines.append('%s_count{%s} %s' % (name, labels(record),
+                                               record['requests']))
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, filename):
+        """Saves the measurements of every phase, caller and method as JSON."""
+        write_atomic(filename, json.dumps(self.records(), indent=2,
+                                          sort_keys=True))
+
+    def write_textfile(self, filename):
+        """Saves the measurements for the node_exporter textfile collector."""
+        write_atomic(filename, self.prometheus_text())
+
+def labels(record):
+    """Returns the Prometheus labels of a Metrics record."""
+    return ','.join('%s="%s"' % (k, record[k])
+                    for k in ['phase', 'caller', 'method'])
+
+def write_atomic(filename, content):
+    """Replaces filename with content, so readers never see a partial file."""
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as tmp:
+            tmp.write(content)
+        os.chmod(tmpname, 0644)
+        os.rename(tmpname, filename)
+    except:
+        os.remove(tmpname)
+        raise
+
 class API:
-    def __init__(self, auth, url, debug=False, verbose=False):
+    """API wraps the PLC XML-RPC server and adds auth to every call.
+
+    API is safe to use from multiple threads. Every call borrows one of
+    'connections' server proxies from a pool, so up to 'connections' calls
+    run concurrently. Each proxy keeps its HTTPS connection open between
+    calls, and all proxies share one SSLContext.
+
+    Results of CACHEABLE_METHODS are saved in a per-run Cache, and every
+    request is measured in a per-run Metrics.
+    """
+    def __init__(self, auth, url, debug=False, verbose=False, connections=1):
         self.debug = debug
         self.verbose = verbose
         self.auth = auth
-        self.api = get_xmlrpc_server(url)
+        self.connections = connections
+        context = get_ssl_context()
+        self.pool = Queue.Queue()
+        for _ in range(connections):
+            transport = get_transport(url, context)
+            self.pool.put((get_xmlrpc_server(url, context, transport),
+                           transport))
+        self.api = get_xmlrpc_server(url, context)
+        self.multicall_supported = True
+        self.cache = Cache()
+        self.metrics = Metrics()
+
+    def _request(self, method, call, caller, calls=()):
+        """Sends one request with call(server) and measures it.
+
+        Args:
+            method: str, the method of the request.
+            call: callable, sends the request with the given server proxy.
+            caller: str, the name of the function that made the request.
+            calls: list of str, the method of every call in a system.multicall.
+        Returns:
+            the result of call.
+        """
+        # NOTE: blocks until a connection is available.
+        (server, transport) = self.pool.get()
+        transport.reset()
+        start = time.time()
+        error = True
+        try:
+            result = call(server)
+            error = False
+        finally:
+            self.metrics.record(method, caller, time.time() - start,
+                                transport, error, calls)
+            self.pool.put((server, transport))
+        return result
 
     def __repr__(self):
         return self.api.__repr__()
 
+    def multicall(self):
+        """Returns a MultiCall() that sends queued Get* calls in one request."""
+        return MultiCall(self)
+
+    def _multicall(self, calls):
+        """Sends calls with system.multicall.
+
+        Returns:
+            list, the result of each call, or an xmlrpclib.Fault for calls that
+            failed.
+        Raises:
+            xmlrpclib.Fault, when the server rejects system.multicall.
+        """
+        requests = [{'methodName': name, 'params': [self.auth] + list(params)}
+                    for name, params in calls]
+        responses = self._request(
+            'system.multicall',
+            lambda server: server.system.multicall(requests), get_caller(),
+            [name for name, _ in calls])
+
+        results = []
+        for response in responses:
+            if type(response) == dict:
+                results.append(xmlrpclib.Fault(response['faultCode'],
+                                               response['faultString']))
+            else:
+                results.append(response[0])
+        return results
+
+    def _call(self, name, params, generation=None):
+        """Calls name(*params) on the server and updates the cache.
+
+        generation is the one returned by the cache miss for name(*params).
+        """
+        if self.verbose: 
+            print "%s(%s)" % (name, params)
+        try:
+            result = self._request(
+                name, lambda server: getattr(server, name)(self.auth, *params),
+                get_caller())
+        finally:
+            self.cache.invalidate(name)
+        self.cache.put(name, params, result, generation)
+        return result
+
     def __getattr__(self, name):
         run = True
         if self.debug and 'Get' not in name:
             # Do no run when debug=True & not a Get* api call
             run = False
 
-        method = getattr(self.api, name)
-        if method is None:
-            raise AssertionError("method does not exist")
-
         #if self.verbose: 
         #    print "%s(%s)" % (name, params)
 
         def call_method(auth, *params):
-            if self.verbose: 
-                print "%s(%s)" % (name, params)
-            return method(self.auth, *params)
+            (found, result, generation) = self.cache.get(name, params)
+            if found:
+                if self.verbose:
+                    print "cached %s(%s)" % (name, params)
+                return result
+            return self._call(name, params, generation)
 
         if run:
             return lambda *params : call_method(self.auth, *params)
         else:
             print "DEBUG: Skipping %s()" % name
+            self.cache.invalidate(name)
             return lambda *params : 1
 
         #return lambda *params : call_method(*params)
         #return call_method(*params)
 
+class MultiCall:
+    """MultiCall queues read-only API calls and sends them in one request.
+
+    Example:
+        batch = api.multicall()
+        batch.GetNodes(hostname)
+        batch.GetSlices(slicename)
+        (nodes, slices) = batch.run()
+
+    Calls are sent together using 'system.multicall'. If the server rejects
+    system.multicall, the calls are made one at a time, and the API does not
+    try system.multicall again.
+    """
+    def __init__(self, api):
+        self.api = api
+        self.calls = []
+
+    def __getattr__(self, name):
+        if 'Get' not in name:
+            raise AssertionError("only Get* calls can be batched: %s" % name)
+
+        def queue_method(*params):
+            if self.api.verbose:
+                print "queued %s(%s)" % (name, params)
+            self.calls.append((name, params))
+
+        return queue_method
+
+    def run(self):
+        """Sends all queued calls and returns their results, in order.
+
+        Calls with results in the API cache are not sent.
+        """
+        calls = self.calls
+        self.calls = []
+        results = [None] * len(calls)
+        generations = [None] * len(calls)
+        pending = []
+        for i, (name, params) in enumerate(calls):
+            (found, results[i], generations[i]) = self.api.cache.get(name,
+                                                                     params)
+            if not found:
+                pending.append(i)
+
+        if len(pending) > 1 and self.api.multicall_supported:
+            try:
+                responses = self.api._multicall([calls[i] for i in pending])
+            except xmlrpclib.Fault, e:
+                if e.faultCode not in MULTICALL_UNSUPPORTED_CODES:
+                    raise
+                print "WARNING: multicall not supported: %s" % e.faultString
+                self.api.multicall_supported = False
+            else:
+                for i, response in zip(pending, responses):
+                    if isinstance(response, xmlrpclib.Fault):
+                        raise response
+                    (name, params) = calls[i]
+                    self.api.cache.put(name, params, response,
+                                       generations[i])
+                    results[i] = response
+                return results
+
+        for i in pending:
+            (name, params) = calls[i]
+            results[i] = self.api._call(name, params, generations[i])
+        return results
+
 def refreshsession(plcconfig=None):
     # Either read session from disk or create it and save it for later
     if plcconfig is not None and os.path.exists(plcconfig):
@@ -135,7 +594,7 @@ def parse_sessions(session_file, fail_on_open=True):
     return session_map
 
 
-def get_xmlrpc_server(url):
+def get_ssl_context():
     try:
         context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
     except AttributeError:
@@ -146,11 +605,91 @@ def get_xmlrpc_server(url):
     context.load_verify_locations(
         os.path.join(os.path.dirname(os.path.realpath(__file__)),
                      "../../boot.planet-lab.org.ca"))
+    return context
+
+
+class MeteredResponse:
+    """MeteredResponse counts the bytes read from an HTTP response."""
+    def __init__(self, response, transport):
+        self.response = response
+        self.transport = transport
+
+    def read(self, *args):
+        data = self.response.read(*args)
+        self.transport.bytes_received += len(data)
+        return data
+
+    def getheader(self, *args):
+        return self.response.getheader(*args)
+
+    def close(self):
+        self.response.close()
+
+
+class TransportMeter:
+    """TransportMeter counts the attempts and bytes of the requests of an
+    xmlrpclib.Transport that it is mixed into.
+
+    The counts are for the requests since the last call to reset().
+    """
+    def reset(self):
+        self.attempts = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def retries(self):
+        """Returns the number of requests that were sent again."""
+        # NOTE: request() sends a request again when the server closed the
+        # connection that was kept open since the last request.
+        return max(0, self.attempts - 1)
+
+    def single_request(self, host, handler, request_body, verbose=0):
+        self.attempts += 1
+        self.bytes_sent += len(request_body)
+        return xmlrpclib.Transport.single_request(
+            self, host, handler, request_body, verbose)
+
+    def parse_response(self, response):
+        return xmlrpclib.Transport.parse_response(
+            self, MeteredResponse(response, self))
+
+
+class MeteredTransport(TransportMeter, xmlrpclib.Transport):
+    """MeteredTransport is an HTTP transport with a TransportMeter."""
+    def __init__(self, *args, **kwargs):
+        xmlrpclib.Transport.__init__(self, *args, **kwargs)
+        self.reset()
+
+
+class MeteredSafeTransport(TransportMeter, xmlrpclib.SafeTransport):
+    """MeteredSafeTransport is an HTTPS transport with a TransportMeter."""
+    def __init__(self, *args, **kwargs):
+        xmlrpclib.SafeTransport.__init__(self, *args, **kwargs)
+        self.reset()
+
+
+def get_transport(url, context=None):
+    """Returns a metered transport for url; HTTPS uses context."""
+    if url.startswith('https:'):
+        if context is None:
+            context = get_ssl_context()
+        return MeteredSafeTransport(context=context)
+    return MeteredTransport()
+
+
+def get_xmlrpc_server(url, context=None, transport=None):
+    # NOTE: the transport of every ServerProxy reuses its HTTP/1.1 connection
+    # between requests. The SSLContext may be shared by many servers.
+    if transport is not None:
+        return xmlrpclib.ServerProxy(
+            url, transport=transport, verbose=False, allow_none=True)
+    if context is None:
+        context = get_ssl_context()
     return xmlrpclib.ServerProxy(
         url, verbose=False, allow_none=True, context=context)
 
 
-def getapi(debug=False, verbose=False, plcconfig=None):
+def getapi(debug=False, verbose=False, plcconfig=None, connections=1):
     global api
     api = get_xmlrpc_server(API_URL)
     auth = None
@@ -172,5 +711,5 @@ def getapi(debug=False, verbose=False, plcconfig=None):
             refreshsession(plcconfig)
 
     assert auth is not None
-    return API(auth, API_URL, debug, verbose)
+    return API(auth, API_URL, debug, verbose, connections)
 
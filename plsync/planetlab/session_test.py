@@ -0,0 +1,270 @@
+"""Tests for session."""
+
+import mock
+import os
+import plcserver
+import re
+import session
+import shutil
+import StringIO
+import tempfile
+import threading
+import unittest
+import xmlrpclib
+
+
+class MultiCallTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = mock.Mock()
+        patcher = mock.patch.object(session, 'get_xmlrpc_server',
+                                    return_value=self.server)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.api = session.API({'AuthMethod': 'session'}, 'https://plc/')
+
+    def test_multicall_returns_results_in_order(self):
+        self.server.system.multicall.return_value = [[['node']], [['slice']]]
+        batch = self.api.multicall()
+        batch.GetNodes('mlab1.abc01')
+        batch.GetSlices('iupui_ndt')
+
+        results = batch.run()
+
+        self.assertEqual(results, [['node'], ['slice']])
+        self.server.system.multicall.assert_called_once_with([
+            {'methodName': 'GetNodes',
+             'params': [{'AuthMethod': 'session'}, 'mlab1.abc01']},
+            {'methodName': 'GetSlices',
+             'params': [{'AuthMethod': 'session'}, 'iupui_ndt']}])
+
+    def test_multicall_raises_fault_from_single_call(self):
+        self.server.system.multicall.return_value = [
+            [['node']], {'faultCode': 103, 'faultString': 'denied'}]
+        batch = self.api.multicall()
+        batch.GetNodes('mlab1.abc01')
+        batch.GetSlices('iupui_ndt')
+
+        with self.assertRaises(xmlrpclib.Fault):
+            batch.run()
+
+    @mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+    def test_multicall_when_unsupported_falls_back_to_single_calls(
+            self, mock_stdout):
+        self.server.system.multicall.side_effect = xmlrpclib.Fault(
+            100, 'Invalid method')
+        self.server.GetNodes.return_value = ['node']
+        self.server.GetSlices.return_value = ['slice']
+        batch = self.api.multicall()
+        batch.GetNodes('mlab1.abc01')
+        batch.GetSlices('iupui_ndt')
+
+        results = batch.run()
+
+        self.assertEqual(results, [['node'], ['slice']])
+        self.assertFalse(self.api.multicall_supported)
+        self.assertIn('WARNING', mock_stdout.getvalue())
+
+    def test_multicall_rejects_write_calls(self):
+        batch = self.api.multicall()
+
+        with self.assertRaises(AssertionError):
+            batch.AddNode('abc01', {})
+
+    def test_multicall_skips_cached_calls(self):
+        self.server.GetTagTypes.return_value = ['tagtype']
+        self.api.GetTagTypes({'tagname': 'alias'})
+        self.server.system.multicall.return_value = [[['node']], [['slice']]]
+        batch = self.api.multicall()
+        batch.GetTagTypes({'tagname': 'alias'})
+        batch.GetNodes('mlab1.abc01')
+        batch.GetSlices('iupui_ndt')
+
+        results = batch.run()
+
+        self.assertEqual(results, [['tagtype'], ['node'], ['slice']])
+        self.assertEqual(
+            len(self.server.system.multicall.call_args[0][0]), 2)
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = mock.Mock()
+        patcher = mock.patch.object(session, 'get_xmlrpc_server',
+                                    return_value=self.server)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.api = session.API({'AuthMethod': 'session'}, 'https://plc/')
+
+    def test_cache_returns_saved_result(self):
+        self.server.GetNodeGroups.return_value = [{'nodegroup_id': 7}]
+
+        first = self.api.GetNodeGroups({'groupname': 'MeasurementLabCentos'})
+        second = self.api.GetNodeGroups({'groupname': 'MeasurementLabCentos'})
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.server.GetNodeGroups.call_count, 1)
+        self.assertEqual((self.api.cache.hits, self.api.cache.misses), (1, 1))
+
+    def test_cache_ignores_methods_not_allowed(self):
+        self.server.GetInterfaces.return_value = []
+
+        self.api.GetInterfaces({'node_id': 10})
+        self.api.GetInterfaces({'node_id': 10})
+
+        self.assertEqual(self.server.GetInterfaces.call_count, 2)
+        self.assertEqual((self.api.cache.hits, self.api.cache.misses), (0, 0))
+
+    def test_cache_when_mutating_call_invalidates_entries(self):
+        self.server.GetNodes.return_value = [{'slice_ids': []}]
+        self.server.GetTagTypes.return_value = [{'tag_type_id': 1}]
+        self.api.GetNodes('mlab1.abc01')
+        self.api.GetTagTypes('alias')
+
+        self.api.AddSliceToNodes('iupui_ndt', ['mlab1.abc01'])
+        self.api.GetNodes('mlab1.abc01')
+        self.api.GetTagTypes('alias')
+
+        self.assertEqual(self.server.GetNodes.call_count, 2)
+        self.assertEqual(self.server.GetTagTypes.call_count, 1)
+
+    def test_cache_when_unknown_mutating_call_clears_all_entries(self):
+        self.server.GetTagTypes.return_value = [{'tag_type_id': 1}]
+        self.api.GetTagTypes('alias')
+
+        self.api.AddTagType({'tagname': 'other'})
+        self.api.GetTagTypes('alias')
+
+        self.assertEqual(self.server.GetTagTypes.call_count, 2)
+
+    def test_cache_invalidates_lists_every_write(self):
+        # NOTE: plsync writes through s.api.Method() calls, and the Change()s
+        # of reconcile; plcserver implements every write that plsync uses.
+        directory = os.path.dirname(os.path.abspath(__file__))
+        methods = set(name for name in dir(plcserver.PLCAPI)
+                      if name[:1].isupper())
+        for filename in [os.path.join(directory, 'sync.py'),
+                         os.path.join(directory, 'reconcile.py'),
+                         os.path.join(directory, '..', 'plsync.py')]:
+            with open(filename) as source:
+                text = source.read()
+            methods.update(re.findall(r"api\.([A-Z]\w+)\(", text))
+            methods.update(re.findall(r"Change\(\s*'([A-Z]\w+)'", text))
+
+        writes = [name for name in methods
+                  if not name.startswith('Get') and name != 'AuthCheck']
+
+        self.assertIn('AddSliceTag', writes)
+        self.assertEqual(
+            [name for name in sorted(writes)
+             if name not in session.CACHE_INVALIDATES], [])
+
+    def test_cache_drops_read_made_before_concurrent_write(self):
+        api = session.API({'AuthMethod': 'session'}, 'https://plc/',
+                          connections=2)
+        responses = [[{'node_id': 1, 'slice_ids': []}],
+                     [{'node_id': 1, 'slice_ids': [5]}]]
+        started = threading.Event()
+        release = threading.Event()
+
+        def get_nodes(auth, hostname):
+            response = responses.pop(0)
+            started.set()
+            release.wait()
+            return response
+
+        self.server.GetNodes.side_effect = get_nodes
+        reader = threading.Thread(target=api.GetNodes, args=('mlab1.abc01',))
+        reader.start()
+        started.wait()
+        api.AddSliceToNodes('iupui_ndt', ['mlab1.abc01'])
+        release.set()
+        reader.join()
+
+        nodes = api.GetNodes('mlab1.abc01')
+
+        self.assertEqual(nodes, [{'node_id': 1, 'slice_ids': [5]}])
+        self.assertEqual(responses, [])
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = mock.Mock()
+        patcher = mock.patch.object(session, 'get_xmlrpc_server',
+                                    return_value=self.server)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.api = session.API({'AuthMethod': 'session'}, 'https://plc/')
+
+    def sync_node_tag(self):
+        return self.api.GetNodeTags({'node_id': 1})
+
+    def test_metrics_records_phase_caller_and_method(self):
+        self.server.GetNodeTags.return_value = []
+        self.server.system.multicall.return_value = [[['node']], [['slice']]]
+        self.api.metrics.set_phase('syncsite')
+
+        self.sync_node_tag()
+        batch = self.api.multicall()
+        batch.GetNodes('mlab1.abc01')
+        batch.GetSlices('iupui_ndt')
+        batch.run()
+
+        records = dict(((r['phase'], r['caller'], r['method']), r)
+                       for r in self.api.metrics.records())
+        tags = records[('syncsite', 'sync_node_tag', 'GetNodeTags')]
+        multicall = records[('syncsite', 'test_metrics_records_phase_caller_'
+                             'and_method', 'system.multicall')]
+        self.assertEqual((tags['requests'], tags['calls']), (1, 1))
+        self.assertEqual((multicall['requests'], multicall['calls']), (1, 0))
+        self.assertEqual(len(records), 4)
+
+    def test_metrics_counts_errors(self):
+        self.server.GetNodes.side_effect = xmlrpclib.Fault(103, 'denied')
+
+        with self.assertRaises(xmlrpclib.Fault):
+            self.api.GetNodes('mlab1.abc01')
+
+        (record,) = self.api.metrics.records()
+        self.assertEqual((record['phase'], record['errors']), ('setup', 1))
+
+    def test_metrics_summary_and_prometheus_text(self):
+        transport = session.MeteredTransport()
+        transport.bytes_sent = 100
+        transport.bytes_received = 2048
+        self.api.metrics.record('GetNodes', 'MakeNode', 0.2, transport)
+        self.api.metrics.record('GetNodes', 'SyncSlice', 3, transport)
+
+        summary = self.api.metrics.summary().splitlines()
+        text = self.api.metrics.prometheus_text()
+
+        self.assertEqual(len(summary), 2)
+        self.assertEqual(summary[1].split(), ['setup', 'GetNodes', '2', '2',
+                                              '0', '0', '3.200', '1600.0',
+                                              '0', '4'])
+        self.assertIn('plsync_api_requests_total{phase="setup",'
+                      'caller="MakeNode",method="GetNodes"} 1', text)
+        self.assertIn('plsync_api_request_duration_seconds_bucket{'
+                      'phase="setup",caller="SyncSlice",method="GetNodes",'
+                      'le="2.5"} 0', text)
+        self.assertIn('plsync_api_request_duration_seconds_bucket{'
+                      'phase="setup",caller="SyncSlice",method="GetNodes",'
+                      'le="5"} 1', text)
+
+    def test_metrics_write_textfile(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'plsync.prom')
+
+        self.api.metrics.write_textfile(filename)
+
+        self.assertEqual(os.listdir(tmpdir), ['plsync.prom'])
+        with open(filename) as textfile:
+            self.assertIn('# TYPE plsync_api_requests_total counter',
+                          textfile.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,12 @@
 import model
+import os
+import parallel
+# NOTE: reconcile also imports sync; both only use each other at call time.
+import reconcile
 import session as s
 import sys
 import pprint
+import threading
 import time
 import base64
 import xmlrpclib
@@ -10,6 +15,17 @@ import xmlrpclib
 # http://git.planet-lab.org/?p=plcapi.git;a=blob;f=PLC/Faults.py
 PLCAuthenticationFailureCode=103
 
+# NOTE: a multiple of 4, so that every chunk of base64 text decodes on its own.
+BOOTIMAGE_CHUNK_SIZE = 4 * 256 * 1024
+
+# NOTE: the person_id of an email never changes, so every email looked up by
+# GetPersons() is saved for the rest of the run, or None if not in the db.
+_persons = {}
+_persons_lock = threading.Lock()
+# NOTE: MakePerson() holds the lock of an email while it checks for and
+# creates that person, so that concurrent site syncs create it only once.
+_person_locks = {}
+
 def handle_xmlrpclib_Fault(funcname, exception):
     """ Checks if exception.faultCode is due to a PLC authentication/role
     failure and exits if so.  Otherwise, the last exception is re-raised.
@@ -157,41 +173,90 @@ def MakeSite(loginbase,name,abbreviated_name,
 
     return site_id
 
+def GetPersons(emails):
+    """ GetPersons() returns the person of every email found in the db.
+
+    All emails not yet looked up in this run are fetched with a single
+    GetPersons() call, and saved for the rest of the run. Since every site
+    declares the same user_list, later calls make no requests at all.
+
+    Args:
+        emails - list of str, the emails of persons.
+    Returns:
+        dict, email -> person with person_id, email and enabled, for the
+        emails found in the db.
+    """
+    with _persons_lock:
+        unknown = sorted(set(e for e in emails if e not in _persons))
+        if unknown:
+            persons = s.api.GetPersons({"email": unknown},
+                                       ["person_id", "email", "enabled"])
+            for email in unknown:
+                _persons[email] = None
+            for person in persons:
+                _persons[person['email']] = person
+        return dict((e, _persons[e]) for e in emails
+                    if _persons[e] is not None)
+
+def GetPersonIds(emails):
+    """ GetPersonIds() returns the person_id of every email found in the db.
+
+    Args:
+        emails - list of str, the emails of persons.
+    Returns:
+        dict, email -> person_id, for the emails found in the db.
+    """
+    return dict((email, person['person_id'])
+                for email, person in GetPersons(emails).iteritems())
+
 def MakePerson(first_name, last_name, email):
-    persons = s.api.GetPersons({"email":email,"enabled":True},
-                               ["site_ids","email","person_id"])
-    if len(persons)==0:
-        print "Adding person %s" % email
-        fields = {"first_name":first_name, "last_name":last_name, 
-                  "email":email, "password":"clara_abcdefg"}
-        try:
-            s.api.AddPerson(fields)
-        except xmlrpclib.Fault, e:
-            handle_xmlrpclib_Fault("AddPerson()", e)
-        s.api.UpdatePerson(personid, {'enabled': True})
-    return
+    """ MakePerson() creates and enables the person with email, if needed.
 
-def GetPersonsOnSlice(slicename):
+    Returns:
+        person_id of email, int
+    """
+    with _persons_lock:
+        person_lock = _person_locks.setdefault(email, threading.Lock())
+    with person_lock:
+        person = GetPersons([email]).get(email)
+        if person is None:
+            print "Adding person %s" % email
+            fields = {"first_name":first_name, "last_name":last_name, 
+                      "email":email, "password":"clara_abcdefg"}
+            try:
+                person_id = s.api.AddPerson(fields)
+            except xmlrpclib.Fault, e:
+                handle_xmlrpclib_Fault("AddPerson()", e)
+            person = {"person_id": person_id, "email": email,
+                      "enabled": False}
+        if not person['enabled']:
+            print "Enabling person %s" % email
+            s.api.UpdatePerson(person['person_id'], {'enabled': True})
+            with _persons_lock:
+                _persons[email] = dict(person, enabled=True)
+        return person['person_id']
+
+def GetPersonIdsOnSlice(slicename):
     slice_list = s.api.GetSlices(slicename)
     if len(slice_list) == 0:
         raise Exception("WARNING: no slice found for %s" % slicename)
     if len(slice_list) > 1:
         raise Exception("WARNING: multiple slices found for %s" % slicename)
+    return slice_list[0]['person_ids']
 
-    sslice = slice_list[0]
-    person_list = s.api.GetPersons(sslice['person_ids'])
-    return person_list
+def GetPersonsOnSlice(slicename):
+    return s.api.GetPersons(GetPersonIdsOnSlice(slicename))
 
-def GetPersonsOnSite(loginbase):
+def GetPersonIdsOnSite(loginbase):
     site_list = s.api.GetSites({"login_base":loginbase})
     if len(site_list) == 0:
         raise Exception("WARNING: no site found for %s" % loginbase)
     if len(site_list) > 1:
         raise Exception("WARNING: multiple sites found for %s" % loginbase)
+    return site_list[0]['person_ids']
 
-    site = site_list[0]
-    person_list = s.api.GetPersons(site['person_ids'])
-    return person_list
+def GetPersonsOnSite(loginbase):
+    return s.api.GetPersons(GetPersonIdsOnSite(loginbase))
 
 def DeletePersonFromSite(email, loginbase):
     print "Deleting %s from site %s" % (email, loginbase)
@@ -222,21 +287,21 @@ def SyncPersonsOnSite(user_list, loginbase, createusers=False):
 
     This function adds declared users not yet a member of the site and deletes
     undeclared users that are a member of the site.
+
+    Members are compared by person_id, using the person_ids of the site and
+    GetPersonIds(), so only the undeclared members are looked up by id.
     """
-    members_of_site = GetPersonsOnSite(loginbase)
-    member_emails = [ p['email'] for p in members_of_site ]
-    delcared_emails = [ email for fn,ln,email in user_list ]
+    member_ids = GetPersonIdsOnSite(loginbase)
+    declared_ids = GetPersonIds([ email for fn,ln,email in user_list ])
 
     def is_a_current_member(x):
-        return x[2] in member_emails
+        return declared_ids.get(x[2]) in member_ids
     def is_not_a_current_member(x):
-        return x[2] not in member_emails
-    def is_not_a_declared_user(x):
-        return x not in delcared_emails
+        return not is_a_current_member(x)
 
     persons_confirmed = filter(is_a_current_member, user_list)
     persons_to_add = filter(is_not_a_current_member, user_list)
-    emails_to_delete = filter(is_not_a_declared_user, member_emails)
+    ids_to_delete = sorted(set(member_ids) - set(declared_ids.values()))
 
     for person in persons_confirmed:
         print "Confirmed %s is member of site %s" % (person[2], loginbase)
@@ -246,8 +311,9 @@ def SyncPersonsOnSite(user_list, loginbase, createusers=False):
         email = person[2]
         AddPersonToSite(email,loginbase)
 
-    for email in emails_to_delete:
-        DeletePersonFromSite(email,loginbase)
+    if ids_to_delete:
+        for person in s.api.GetPersons(ids_to_delete, ["email"]):
+            DeletePersonFromSite(person['email'],loginbase)
 
     return
 
@@ -339,9 +405,10 @@ def PutNodeInNodegroup(hostname, node_id, nodegroup_name):
 
        Exits on errors.
     """
-    node_list = s.api.GetNodes(node_id, ['nodegroup_ids', 'node_tag_ids'])
-    nodegroup_list = s.api.GetNodeGroups({'groupname' : nodegroup_name}, 
-                                         ['nodegroup_id'])
+    batch = s.api.multicall()
+    batch.GetNodes(node_id, ['nodegroup_ids', 'node_tag_ids'])
+    batch.GetNodeGroups({'groupname' : nodegroup_name}, ['nodegroup_id'])
+    (node_list, nodegroup_list) = batch.run()
     if len(nodegroup_list) != 1:
         print ("ERROR: found %s nodegroups when looking for %s in plc db" % 
                 (len(nodegroup_list), nodegroup_name)) 
@@ -367,8 +434,9 @@ def PutNodeInNodegroup(hostname, node_id, nodegroup_name):
     if nodegroup_name in ['MeasurementLabCentos']:
         SyncNodeTag(hostname, node_id, 'fcdistro', 'centos6')
 
-def setTagTypeId(tagname, tags):
-    tagtype_list = s.api.GetTagTypes({"tagname":tagname})
+def setTagTypeId(tagname, tags, tagtype_list=None):
+    if tagtype_list is None:
+        tagtype_list = s.api.GetTagTypes({"tagname":tagname})
     if len(tagtype_list)==0:
         print "BUG: %s TagType does not exist. Need to update MyPLC" % tagname
         sys.exit(1)
@@ -394,8 +462,16 @@ def SyncInterfaceTags(node_id, interface, tagvalues):
 
             Extra tags already present on interface are ignored.
     """
-    filter_dict = { "node_id" : node_id, 'ip' : interface['ip'] }
-    interface_found = s.api.GetInterfaces(filter_dict)
+    # NOTE: lookup the interface and all tag types in a single request.
+    tagnames = tagvalues.keys()
+    batch = s.api.multicall()
+    batch.GetInterfaces({ "node_id" : node_id, 'ip' : interface['ip'] })
+    for tagname in tagnames:
+        batch.GetTagTypes({"tagname":tagname})
+    results = batch.run()
+    interface_found = results[0]
+    tagtypes = dict(zip(tagnames, results[1:]))
+
     interface_tag_ids_found = interface_found[0]['interface_tag_ids']
     current_tags = s.api.GetInterfaceTags(interface_tag_ids_found)
 
@@ -411,7 +487,7 @@ def SyncInterfaceTags(node_id, interface, tagvalues):
                 new_tags[name]['current_tag']=current_tag
 
         # set tag type so we can pass the tagtypeid to AddTag later.
-        setTagTypeId(tagname, new_tags[tagname])
+        setTagTypeId(tagname, new_tags[tagname], tagtypes[tagname])
 
     for tagname,tag in new_tags.iteritems():
         if tag['current_tag'] is None:
@@ -472,11 +548,12 @@ def SyncInterface(hostname, node_id, interface, is_primary):
     primary_declared = interface
     filter_dict = {"node_id" : node_id, 
                    "ip" : interface['ip']}
-    interface_found = s.api.GetInterfaces(filter_dict)
-
     coarse_filter_dict = {"node_id" : node_id, 
                    "is_primary" : is_primary}
-    all_interfaces = s.api.GetInterfaces(coarse_filter_dict)
+    batch = s.api.multicall()
+    batch.GetInterfaces(filter_dict)
+    batch.GetInterfaces(coarse_filter_dict)
+    (interface_found, all_interfaces) = batch.run()
 
     if (len(interface_found) == 0 and not is_primary) or len(all_interfaces) == 0:
         print ("Adding: node network %s to %s" %
@@ -589,14 +666,13 @@ def SyncPersonsOnSlice(slicename, user_list):
         print "No user_list provided for adding to %s" % slicename
         return
 
-    members_of_slice = GetPersonsOnSlice(slicename)
-    member_emails = [ p['email'] for p in members_of_slice ]
-    delcared_emails = [ email for fn,ln,email in user_list ]
+    member_ids = GetPersonIdsOnSlice(slicename)
+    declared_ids = GetPersonIds([ email for fn,ln,email in user_list ])
 
     def is_a_current_member(x):
-        return x[2] in member_emails
+        return declared_ids.get(x[2]) in member_ids
     def is_not_a_current_member(x):
-        return x[2] not in member_emails
+        return not is_a_current_member(x)
 
     persons_confirmed = filter(is_a_current_member, user_list)
     persons_to_add = filter(is_not_a_current_member, user_list)
@@ -662,13 +738,20 @@ def SyncSliceAttribute(slicename, attr):
     else:
         raise Exception("no attrtype in %s" % attr)
 
+    # NOTE: lookup the slice tags for every key in a single request.
+    keys = [k for k in attr.keys() if k not in ['attrtype', attr['attrtype']]]
+    batch = s.api.multicall()
+    for k in keys:
+        # NOTE: GetSliceTags does not support nodegroup_id filtering :-/
+        batch.GetSliceTags(dict(tag_filter, tagname=k))
+    found_tags = dict(zip(keys, batch.run()))
+
     sub_attr = {}
     for k in attr.keys():
         if k not in ['attrtype', attr['attrtype']]:
             sub_attr[k] = attr[k]
-            # NOTE: GetSliceTags does not support nodegroup_id filtering :-/
             tag_filter['tagname'] = k
-            sliceattrs = s.api.GetSliceTags(tag_filter)
+            sliceattrs = found_tags[k]
             attrsfound = filter(lambda a: a['value'] == attr[k], sliceattrs)
             if k in ['vsys']:
                 # NOTE: these keys can have multiples with different values.
@@ -771,8 +854,10 @@ def RemoveSliceFromNode(slicename, hostname):
         None
 
     """
-    nodes = s.api.GetNodes(hostname)
-    slices = s.api.GetSlices(slicename)
+    batch = s.api.multicall()
+    batch.GetNodes(hostname)
+    batch.GetSlices(slicename)
+    (nodes, slices) = batch.run()
 
     for node in nodes:
         slice_ids_on_node = node["slice_ids"]
@@ -811,8 +896,10 @@ def WhitelistSliceOnNode(slicename, hostname):
     """
 
     # Add slices to Nodes and NodesWhitelist
-    nodes = s.api.GetNodes(hostname)
-    slices = s.api.GetSlices(slicename)
+    batch = s.api.multicall()
+    batch.GetNodes(hostname)
+    batch.GetSlices(slicename)
+    (nodes, slices) = batch.run()
 
     for node in nodes:
         slice_ids_on_node = node["slice_ids"]
@@ -844,6 +931,57 @@ def WhitelistSliceOnNode(slicename, hostname):
     # NOTE: this approach does not delete stray slices from whitelist
     return
 
+def WhitelistSliceOnNodes(slicename, hostnames):
+    """ Adds the slice to every node, and to the whitelist of every node.
+
+    Unlike WhitelistSliceOnNode(), the slice and all nodes are read with one
+    request, and the slice is added to all nodes missing it with one
+    AddSliceToNodesWhitelist() and one AddSliceToNodes() call.
+
+    NOTE: like WhitelistSliceOnNode(), stray slices are not deleted from hosts.
+
+    Args:
+        slicename - string, name of the slice, i.e. 'iupui_ndt'
+        hostnames - list of strings, hostnames of the nodes for the slice.
+    Returns:
+        None
+    """
+    if not hostnames:
+        return
+
+    batch = s.api.multicall()
+    batch.GetSlices(slicename, ['slice_id', 'name'])
+    batch.GetNodes(hostnames, ['hostname', 'slice_ids', 'slice_ids_whitelist'])
+    (slices, nodes) = batch.run()
+
+    for sslice in slices:
+        missing_whitelist = []
+        missing_nodes = []
+        for node in nodes:
+            if sslice['slice_id'] not in node['slice_ids_whitelist']:
+                missing_whitelist.append(node['hostname'])
+            else:
+                print ("Confirmed: %s is whitelisted on %s" %
+                        (sslice['name'], node['hostname']))
+            if sslice['slice_id'] not in node['slice_ids']:
+                missing_nodes.append(node['hostname'])
+            else:
+                print ("Confirmed: %s is assigned to %s" %
+                        (sslice['name'], node['hostname']))
+
+        if missing_whitelist:
+            print ("Adding %s to whitelist on hosts: %s" %
+                    (sslice['name'], " ".join(missing_whitelist)))
+            try:
+                s.api.AddSliceToNodesWhitelist(sslice['slice_id'],
+                                               missing_whitelist)
+            except xmlrpclib.Fault, e:
+                handle_xmlrpclib_Fault("AddSliceToNodesWhitelist()", e)
+        if missing_nodes:
+            print ("Adding %s to hosts: %s" %
+                    (sslice['name'], " ".join(missing_nodes)))
+            s.api.AddSliceToNodes(sslice['slice_id'], missing_nodes)
+
 def GetBootimage(hostname, imagetype="iso", nodekeykeep=False):
     """ get_bootimage() - generate a new boot image for the named node, and
     media type.  Generating a new ISO, replaces the old node key in the myplc
@@ -869,18 +1007,112 @@ def GetBootimage(hostname, imagetype="iso", nodekeykeep=False):
     # NOTE: returns a gigantic blob of base64 encoded text.
     options = [] if not nodekeykeep else ["node-key-keep"]
     x = s.api.GetBootMedium(hostname, 'node-%s' % imagetype, "", options)
-    bindata = base64.b64decode(x)
 
     # NOTE: save file to pwd
     fname = "%s.%s" % (hostname, imagetype)
-    f = open(fname, 'w')
-    f.write(bindata)
-    f.close()
+    print "Saving: boot image %s" % fname
+    WriteBootimage(fname, x)
+
+
+def WriteBootimage(fname, data):
+    """ WriteBootimage() decodes the base64 text of a boot image to fname.
+
+    The text is decoded and written in chunks, so the decoded image is never
+    held in memory. The image is written to a temporary file first and then
+    renamed, so fname is never left with a partial image.
+
+    Args:
+        fname: str, the name of the boot image file.
+        data: str, the base64 encoded boot image returned by GetBootMedium.
+    """
+    tmpname = fname + ".tmp"
+    with open(tmpname, 'wb') as f:
+        for i in xrange(0, len(data), BOOTIMAGE_CHUNK_SIZE):
+            f.write(base64.b64decode(data[i:i + BOOTIMAGE_CHUNK_SIZE]))
+    os.rename(tmpname, fname)
+
+
+def StaleBootimages(hostnames, imagetype="iso"):
+    """ StaleBootimages() returns the hostnames without a current boot image.
+
+    A boot image in the PWD is current when it was saved after the last update
+    of its node and of every interface of the node, since both are part of
+    the image configuration.
+
+    Args:
+        hostnames: list of str, full hostnames of nodes in the myPLC db.
+        imagetype: str, type of boot image, i.e. 'iso' or 'usb'.
+
+    Returns:
+        list of str, the hostnames in order, without the current images.
+    """
+    saved = {}
+    for hostname in hostnames:
+        fname = "%s.%s" % (hostname, imagetype)
+        if os.path.exists(fname):
+            saved[hostname] = os.path.getmtime(fname)
+    if not saved:
+        return list(hostnames)
+
+    nodes = s.api.GetNodes(sorted(saved.keys()),
+                           ['hostname', 'last_updated', 'interface_ids'])
+    interface_ids = [i for node in nodes for i in node['interface_ids']]
+    interfaces = {}
+    if interface_ids:
+        interfaces = dict(
+            (i['interface_id'], i['last_updated']) for i in
+            s.api.GetInterfaces(interface_ids,
+                                ['interface_id', 'last_updated']))
+    updated = {}
+    for node in nodes:
+        updated[node['hostname']] = max(
+            [node['last_updated']] +
+            [interfaces.get(i, 0) for i in node['interface_ids']])
+
+    stale = []
+    for hostname in hostnames:
+        if hostname in updated and saved[hostname] >= updated[hostname]:
+            print "Confirmed: boot image %s.%s is current" % (hostname,
+                                                             imagetype)
+        else:
+            stale.append(hostname)
+    return stale
+
+
+def GetBootimages(hostnames, imagetype="iso", nodekeykeep=False, workers=1):
+    """ GetBootimages() generates and saves the boot images of many nodes.
+
+    Boot images are generated by PLC one at a time per request, so up to
+    'workers' images are requested concurrently. When nodekeykeep is True,
+    nodes with a current boot image in the PWD are skipped. Without it, every
+    image must be regenerated, because each download replaces the node key.
+
+    Args:
+        hostnames: list of str, full hostnames of nodes in the myPLC db.
+        imagetype: str, type of boot image to fetch, see GetBootimage().
+        nodekeykeep: bool, if True, preserve the existing node keys and skip
+            nodes with a current boot image.
+        workers: int, the maximum number of images to fetch concurrently.
+
+    Returns:
+        None
+    """
+    if nodekeykeep:
+        hostnames = StaleBootimages(hostnames, imagetype)
+    parallel.run(lambda hostname: GetBootimage(hostname, imagetype,
+                                               nodekeykeep),
+                 hostnames, workers)
 
 
 def SyncSlice(sslice, hostname_or_site, addwhitelist, addsliceips, addusers,
-              createslice):
-    """Creates and/or Updates a slice object in the PLC DB."""
+              createslice, workers=1):
+    """Creates and/or Updates a slice object in the PLC DB.
+
+    The slice is added to the nodes and whitelists of all selected hosts at
+    once. The slice attributes, including the per-node slice IPs and
+    initscripts, are reconciled against all slice tags of the slice at once,
+    and the needed changes are applied by up to 'workers' threads.
+    """
     if createslice:
         print "Making slice! %s" % sslice['name']
         MakeSlice(sslice['name'])
@@ -889,32 +1121,53 @@ def SyncSlice(sslice, hostname_or_site, addwhitelist, addsliceips, addusers,
     if addusers:
         SyncPersonsOnSlice(sslice['name'], sslice['users'])
 
-    for attr in sslice['attrs']:
-        SyncSliceAttribute(sslice['name'], attr)
-    for h,node in sslice['network_list']:
-        if (hostname_or_site is None or
-            hostname_or_site == h or
-            hostname_or_site in h):
-            if addwhitelist:
-                # Add this slice to the whitelist of all hosts.
-                WhitelistSliceOnNode(sslice['name'], h)
-                #RemoveSliceFromNode(sslice['name'], h)
-            if addsliceips:
-                attr = node.get_interface_attr(sslice)
-                if attr:
-                    SyncSliceAttribute(sslice['name'], attr)
-
-            if sslice['use_initscript'] and hostname_or_site is not None:
-                # Assign the mlab_generic_initscript to slices on this node.
-                # TODO: Make this more flexible.
-                attr = model.Attr(node.hostname(),
-                                  initscript="mlab_generic_initscript")
-                SyncSliceAttribute(sslice['name'], attr)
+    if addwhitelist:
+        # Add this slice to the whitelist of all hosts.
+        networks = SliceNetworks(sslice, hostname_or_site)
+        WhitelistSliceOnNodes(sslice['name'], [h for h, _ in networks])
+
+    attrs = SliceAttributes(sslice, hostname_or_site, addsliceips)
+    reconcile.ReconcileSliceAttributes(sslice['name'], attrs, workers)
     return
 
 
+def SliceNetworks(sslice, hostname_or_site):
+    """Returns the (hostname, node) of the slice, limited to hostname_or_site."""
+    return [(h, node) for h, node in sslice['network_list']
+            if (hostname_or_site is None or
+                hostname_or_site == h or
+                hostname_or_site in h)]
+
+
+def SliceAttributes(sslice, hostname_or_site, addsliceips):
+    """ SliceAttributes() returns every declared attribute of a slice.
+
+    Args:
+        sslice: model.Slice, the slice.
+        hostname_or_site: str, limit per-node attributes to matching hosts.
+        addsliceips: bool, if True, include the slice IPs of every node.
+
+    Returns:
+        list of model.Attr, the slice attributes followed by the per-node
+        slice IPs and initscripts.
+    """
+    attrs = list(sslice['attrs'])
+    for h, node in SliceNetworks(sslice, hostname_or_site):
+        if addsliceips:
+            attr = node.get_interface_attr(sslice)
+            if attr:
+                attrs.append(attr)
+
+        if sslice['use_initscript'] and hostname_or_site is not None:
+            # Assign the mlab_generic_initscript to slices on this node.
+            # TODO: Make this more flexible.
+            attrs.append(model.Attr(node.hostname(),
+                                    initscript="mlab_generic_initscript"))
+    return attrs
+
+
 def SyncSite(site, onhost, addusers, addnodes, addinterfaces, getbootimages,
-             createusers, nodekeykeep):
+             createusers, nodekeykeep, workers=1):
     """Creates and/or Updates a site object (and all children) in the PLC DB.
 
     SyncSite may include creating a new Site() in PLC DB, adding or deleting
@@ -929,6 +1182,7 @@ def SyncSite(site, onhost, addusers, addnodes, addinterfaces, getbootimages,
         getbootimages: bool, if True, also download node bootimages to .iso.
         createusers: bool, if True, also create declared users not found in db.
         nodekeykeep: bool, if True, keep the same node key for boot images.
+        workers: int, the maximum number of nodes to sync concurrently.
     """
     MakeSite(site['login_base'], site['sitename'], site['sitename'])
     SyncLocation(site['login_base'], site['location'])
@@ -936,41 +1190,50 @@ def SyncSite(site, onhost, addusers, addnodes, addinterfaces, getbootimages,
         SyncPersonsOnSite(site['users'], site['login_base'], createusers)
 
     if addnodes or getbootimages:
-        for hostname,node in site['nodes'].iteritems():
-            if onhost is None or hostname == onhost:
-                SyncNode(node, addnodes, addinterfaces, getbootimages,
-                         nodekeykeep)
+        nodes = [node for node in site.sorted_nodes()
+                 if onhost is None or node.hostname() == onhost]
+        parallel.run(lambda node: SyncNode(node, addnodes, addinterfaces),
+                     nodes, workers)
+    if getbootimages:
+        GetBootimages([node.hostname() for node in nodes], imagetype="iso",
+                      nodekeykeep=nodekeykeep, workers=workers)
 
 
-def SyncNode(node, addnodes, addinterfaces, getbootimages, nodekeykeep):
+def SyncNode(node, addnodes, addinterfaces):
     """Creates and/or Updates a node object (and all children) in the PLC DB."""
 
     node_id = MakeNode(node['login_base'], node.hostname())
     MakePCU(node['login_base'], node_id, node['pcu'].fields())
-    interface = node.interface()
     if node['arch'] != '':
         SyncNodeTag(node.hostname(), node_id, 'arch', node['arch'])
     if addnodes:
         PutNodeInNodegroup(node.hostname(), node_id, node['nodegroup'])
-    if addinterfaces:
-        SyncInterface(node.hostname(), node_id, interface,
-                      interface['is_primary'])
-        if node['nodegroup'] == 'MeasurementLabLXC':
-            # NOTE: these tags are needed on the primary interface
-            #       for the lxc build of PlanetLab
-            goal = { "ifname" : "eth0", "ovs_bridge": "public0"}
-            SyncInterfaceTags(node_id, interface, goal)
-
-    if not node['exclude_ipv6']:
-        SyncInterfaceTags(node_id, interface, node.v6interface_tags())
-
-    if addinterfaces and node['nodegroup'] != 'MeasurementLabLXC':
-        for ip in node.iplist():
-            interface['ip'] = ip
-            interface['is_primary'] = False
-            SyncInterface(node.hostname(), node_id, interface,
-                          interface['is_primary'])
-    if getbootimages:
-        GetBootimage(node.hostname(), imagetype="iso", nodekeykeep=nodekeykeep)
-
+    SyncNodeInterfaces(node, node_id, addinterfaces)
     return
+
+
+def SyncNodeInterfaces(node, node_id, addinterfaces):
+    """
+    SyncNodeInterfaces() -- Adds, updates, or confirms all node interfaces.
+
+    All interfaces and interface tags of the node are read at once, keyed by
+    IP, and compared to the declared primary and secondary interfaces by
+    reconcile.DiffInterfaces(). Only missing or different interfaces and tags
+    are added or updated, so a node already in sync takes one request.
+
+    Args:
+        node - model.Node, the declared node.
+        node_id - node_id from plcdb
+        addinterfaces - bool, if True, add and update interfaces. IPv6 tags on
+            the primary interface are always synced.
+
+    Returns:
+        None
+    """
+    # NOTE: MakeNode() already fetched the node, so this is a cache hit.
+    found = s.api.GetNodes(node.hostname())
+    interface_ids = found[0]['interface_ids'] if found else []
+    snapshot = reconcile.Snapshot()
+    snapshot.load_interfaces(s.api, node_id, interface_ids)
+    changes = reconcile.DiffInterfaces(snapshot, node, node_id, addinterfaces)
+    reconcile.ApplyChanges(changes)
@@ -0,0 +1,268 @@
+"""Tests for sync."""
+
+import base64
+import mock
+import model
+import os
+import shutil
+import StringIO
+import sync
+import tempfile
+import threading
+import time
+import unittest
+
+
+class SyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.users = [('User', 'Name', 'username@gmail.com')]
+        self.site = model.makesite(
+            'abc01', '192.168.1.0', '2400:1002:4008::', 'Some City', 'US',
+            36.850000, 74.783000, self.users, count=3,
+            nodegroup='MeasurementLabCentos')
+        self.hostnames = [node.hostname()
+                          for node in self.site.sorted_nodes()]
+        patcher = mock.patch.object(sync.s, 'api')
+        self.api = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.batch = self.api.multicall.return_value
+        # Silence the progress messages printed by the Sync functions.
+        patcher = mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(sync._persons, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_whitelist_slice_on_nodes_adds_missing_hosts_in_bulk(self):
+        self.batch.run.return_value = [
+            [{'slice_id': 5, 'name': 'abc_bar'}],
+            [{'hostname': self.hostnames[0], 'slice_ids': [5],
+              'slice_ids_whitelist': []},
+             {'hostname': self.hostnames[1], 'slice_ids': [],
+              'slice_ids_whitelist': [5]},
+             {'hostname': self.hostnames[2], 'slice_ids': [],
+              'slice_ids_whitelist': []}]]
+
+        sync.WhitelistSliceOnNodes('abc_bar', self.hostnames)
+
+        self.batch.GetNodes.assert_called_once_with(
+            self.hostnames, ['hostname', 'slice_ids', 'slice_ids_whitelist'])
+        self.api.AddSliceToNodesWhitelist.assert_called_once_with(
+            5, [self.hostnames[0], self.hostnames[2]])
+        self.api.AddSliceToNodes.assert_called_once_with(
+            5, [self.hostnames[1], self.hostnames[2]])
+
+    def test_whitelist_slice_on_nodes_when_in_sync_makes_no_changes(self):
+        self.batch.run.return_value = [
+            [{'slice_id': 5, 'name': 'abc_bar'}],
+            [{'hostname': h, 'slice_ids': [5], 'slice_ids_whitelist': [5]}
+             for h in self.hostnames]]
+
+        sync.WhitelistSliceOnNodes('abc_bar', self.hostnames)
+
+        self.assertFalse(self.api.AddSliceToNodesWhitelist.called)
+        self.assertFalse(self.api.AddSliceToNodes.called)
+
+    def test_sync_slice_whitelists_selected_nodes_once(self):
+        sslice = model.Slice(name='abc_bar', index=1, users=self.users)
+        for node in self.site.sorted_nodes():
+            sslice.add_node_address(node)
+        self.api.GetSlices.return_value = [{'expires': 2**31}]
+        self.batch.run.return_value = [[], []]
+
+        sync.SyncSlice(sslice, 'mlab2.abc01', True, False, False, False)
+
+        self.batch.GetNodes.assert_called_once_with(
+            [self.hostnames[1]],
+            ['hostname', 'slice_ids', 'slice_ids_whitelist'])
+
+    def save_images_in_tempdir(self):
+        """Changes to a temporary directory, where boot images are saved."""
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tempdir)
+
+    @mock.patch.object(sync, 'BOOTIMAGE_CHUNK_SIZE', 8)
+    def test_write_bootimage_decodes_in_chunks(self):
+        self.save_images_in_tempdir()
+        image = 'node-iso ' + 'x' * 100
+
+        sync.WriteBootimage('mlab1.iso', base64.b64encode(image))
+
+        with open('mlab1.iso', 'rb') as f:
+            self.assertEqual(f.read(), image)
+        self.assertEqual(os.listdir('.'), ['mlab1.iso'])
+
+    def test_get_bootimages_with_node_key_keep_skips_current_images(self):
+        self.save_images_in_tempdir()
+        for hostname in self.hostnames[:2]:
+            open('%s.iso' % hostname, 'w').close()
+        now = os.path.getmtime('%s.iso' % self.hostnames[0])
+        self.api.GetNodes.return_value = [
+            {'hostname': self.hostnames[0], 'last_updated': now - 10,
+             'interface_ids': [1]},
+            {'hostname': self.hostnames[1], 'last_updated': now - 10,
+             'interface_ids': [2]}]
+        self.api.GetInterfaces.return_value = [
+            {'interface_id': 1, 'last_updated': now - 10},
+            {'interface_id': 2, 'last_updated': now + 10}]
+        self.api.GetBootMedium.return_value = base64.b64encode('image')
+
+        sync.GetBootimages(self.hostnames, nodekeykeep=True, workers=2)
+
+        self.assertItemsEqual(self.api.GetBootMedium.call_args_list, [
+            mock.call(self.hostnames[1], 'node-iso', '', ['node-key-keep']),
+            mock.call(self.hostnames[2], 'node-iso', '', ['node-key-keep'])])
+
+    def test_get_bootimages_without_node_key_keep_fetches_all(self):
+        self.save_images_in_tempdir()
+        open('%s.iso' % self.hostnames[0], 'w').close()
+        self.api.GetBootMedium.return_value = base64.b64encode('image')
+
+        sync.GetBootimages(self.hostnames, workers=2)
+
+        self.assertFalse(self.api.GetNodes.called)
+        for hostname in self.hostnames:
+            with open('%s.iso' % hostname) as f:
+                self.assertEqual(f.read(), 'image')
+
+    def interfaces_in_plc(self, node):
+        """Returns the interfaces and interface tags of node, as in PLC."""
+        primary = dict(node.interface(), interface_id=100, node_id=10)
+        interfaces = [primary]
+        tags = []
+        for tagname, value in node.v6interface_tags().iteritems():
+            tags.append({'interface_tag_id': 1000 + len(tags),
+                         'interface_id': 100, 'tagname': tagname,
+                         'value': value})
+        for i, ip in enumerate(node.iplist()):
+            interface_id = 101 + i
+            interfaces.append(dict(primary, ip=ip, is_primary=False,
+                                   interface_id=interface_id))
+            for tagname, value in [('alias', str(interface_id)),
+                                   ('ifname', 'eth0')]:
+                tags.append({'interface_tag_id': 1000 + len(tags),
+                             'interface_id': interface_id,
+                             'tagname': tagname, 'value': value})
+        return (interfaces, tags)
+
+    def test_sync_node_interfaces_when_in_sync_reads_once(self):
+        node = self.site.sorted_nodes()[0]
+        (interfaces, tags) = self.interfaces_in_plc(node)
+        self.api.GetNodes.return_value = [
+            {'interface_ids': [i['interface_id'] for i in interfaces]}]
+        tagtypes = [{'tag_type_id': 1, 'tagname': name}
+                    for name in ['alias', 'ifname', 'ipv6_defaultgw',
+                                 'ipv6addr', 'ipv6addr_secondaries']]
+        self.batch.run.return_value = [interfaces, tagtypes, tags]
+
+        sync.SyncNodeInterfaces(node, 10, True)
+
+        self.assertEqual(self.api.multicall.call_count, 1)
+        self.assertFalse(self.api.GetInterfaceTags.called)
+        self.assertFalse(self.api.AddInterface.called)
+        self.assertFalse(self.api.AddInterfaceTag.called)
+        self.assertFalse(self.api.UpdateInterface.called)
+
+    def test_sync_node_interfaces_adds_missing_secondary_interface(self):
+        node = self.site.sorted_nodes()[0]
+        (interfaces, tags) = self.interfaces_in_plc(node)
+        interfaces.pop()
+        self.api.GetNodes.return_value = [
+            {'interface_ids': [i['interface_id'] for i in interfaces]}]
+        tagtypes = [{'tag_type_id': 1, 'tagname': name}
+                    for name in ['alias', 'ifname', 'ipv6_defaultgw',
+                                 'ipv6addr', 'ipv6addr_secondaries']]
+        self.batch.run.return_value = [interfaces, tagtypes, tags]
+        self.api.AddInterface.return_value = 200
+
+        sync.SyncNodeInterfaces(node, 10, True)
+
+        self.api.AddInterface.assert_called_once_with(
+            10, dict(node.interface(), ip=node.iplist()[-1],
+                     is_primary=False))
+        self.assertEqual(self.api.AddInterfaceTag.call_args_list, [
+            mock.call(200, 1, '200'), mock.call(200, 1, 'eth0')])
+
+    def test_sync_persons_on_site_resolves_persons_once_per_run(self):
+        users = self.users + [('Other', 'Name', 'other@gmail.com')]
+        self.api.GetPersons.side_effect = [
+            [{'person_id': 1, 'email': 'username@gmail.com'},
+             {'person_id': 2, 'email': 'other@gmail.com'}],
+            [{'email': 'old@gmail.com'}]]
+        self.api.GetSites.side_effect = [
+            [{'person_ids': [1, 2]}], [{'person_ids': [1, 3]}]]
+
+        sync.SyncPersonsOnSite(users, 'mlababc01')
+        sync.SyncPersonsOnSite(users, 'mlababc02')
+
+        self.assertEqual(self.api.GetPersons.call_args_list, [
+            mock.call({'email': ['other@gmail.com', 'username@gmail.com']},
+                      ['person_id', 'email', 'enabled']),
+            mock.call([3], ['email'])])
+        self.api.AddPersonToSite.assert_called_once_with(
+            'other@gmail.com', 'mlababc02')
+        self.api.DeletePersonFromSite.assert_called_once_with(
+            'old@gmail.com', 'mlababc02')
+
+    def test_sync_persons_on_slice_adds_missing_persons(self):
+        users = self.users + [('Other', 'Name', 'other@gmail.com')]
+        self.api.GetPersons.return_value = [
+            {'person_id': 1, 'email': 'username@gmail.com'},
+            {'person_id': 2, 'email': 'other@gmail.com'}]
+        self.api.GetSlices.return_value = [{'person_ids': [1, 3]}]
+
+        sync.SyncPersonsOnSlice('abc_bar', users)
+
+        self.api.AddPersonToSlice.assert_called_once_with(
+            'other@gmail.com', 'abc_bar')
+
+    def test_make_person_adds_and_enables_missing_person(self):
+        self.api.GetPersons.return_value = []
+        self.api.AddPerson.return_value = 7
+
+        person_id = sync.MakePerson('User', 'Name', 'username@gmail.com')
+
+        self.assertEqual(person_id, 7)
+        self.api.UpdatePerson.assert_called_once_with(7, {'enabled': True})
+        self.assertEqual(sync.GetPersonIds(['username@gmail.com']),
+                         {'username@gmail.com': 7})
+        self.assertEqual(self.api.GetPersons.call_count, 1)
+
+    def test_make_person_enables_disabled_person(self):
+        self.api.GetPersons.return_value = [
+            {'person_id': 7, 'email': 'username@gmail.com', 'enabled': False}]
+
+        person_id = sync.MakePerson('User', 'Name', 'username@gmail.com')
+        sync.MakePerson('User', 'Name', 'username@gmail.com')
+
+        self.assertEqual(person_id, 7)
+        self.assertFalse(self.api.AddPerson.called)
+        self.api.UpdatePerson.assert_called_once_with(7, {'enabled': True})
+
+    def test_make_person_from_many_threads_adds_person_once(self):
+        self.api.GetPersons.return_value = []
+
+        def add_person(fields):
+            time.sleep(0.01)
+            return 7
+
+        self.api.AddPerson.side_effect = add_person
+        threads = [threading.Thread(target=sync.MakePerson,
+                                    args=('User', 'Name',
+                                          'username@gmail.com'))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.api.AddPerson.assert_called_once_with(mock.ANY)
+        self.api.UpdatePerson.assert_called_once_with(7, {'enabled': True})
+
+
+if __name__ == '__main__':
+    unittest.main()
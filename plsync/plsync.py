@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+from planetlab import parallel
+from planetlab import reconcile
 from planetlab import session
 from planetlab import sync
 import sys
@@ -15,6 +17,19 @@ def usage():
                 Only perform Get* api calls.  Absolutely no changes are made
                 to the PLC DB. HIGHLY recommended before changes.
 
+        ./plsync.py --syncsite all --syncslice all --allsteps \\
+             --plan mlab.plan
+                Read the PLC DB once, and save every change needed to sync all
+                sites, nodes and slice attributes to mlab.plan, without making
+                any changes. The plan is JSON that can be reviewed. Slice
+                attributes of nodes that the plan creates are included by
+                planning again after it is applied.
+
+        ./plsync.py --apply mlab.plan --workers 8
+                Apply the changes saved in mlab.plan, without reading the PLC
+                DB again. Sites are changed first, then nodes, then slice
+                attributes; up to 8 independent changes are made at once.
+
         ./plsync.py --syncsite nuq01 --allsteps
                 Creating a new site requires admin permission.  First, edit
                 sites.py to add details for nuq01. Next, run this command to
@@ -40,6 +55,11 @@ def usage():
                 --node-key-keep flag. This can optionally be used on a single
                 machine.
 
+        ./plsync.py --syncsite all --getbootimages --node-key-keep --workers 8
+                Boot images are fetched for up to 8 nodes at once. With
+                --node-key-keep, nodes whose image in the PWD is newer than
+                their last update in PLC are skipped.
+
     Add New Operator (rare):
         ./plsync.py --syncsite all --addusers
                 Adding a new operator to all M-Lab sites requires admin
@@ -89,6 +109,20 @@ def usage():
                 current configuration in sites.py & slices.py (which should be
                 identical to PlanetLab's db).
 
+        ./plsync.py --syncsite all --reconcile
+                Same as above, but reads the current state of all selected
+                sites, nodes, PCUs, interfaces and tags with a few bulk
+                queries first, and then only issues the API calls needed to
+                apply the differences.  Much faster for many sites.
+
+    Measure PLC API Calls:
+        ./plsync.py --syncsite all --metrics-textfile plsync.prom
+                At the end of every run, plsync prints the number, latency
+                and size of the PLC API requests of every method.  This
+                command also saves the requests of every phase, calling
+                function and method for the node_exporter textfile
+                collector.  Use --metrics-json to save them as JSON.
+
     Future Notes:
         Since an external sites & slices list was necessary while M-Lab was
         part of PlanetLab to differentiate mlab from non-mlab, 
@@ -124,6 +158,41 @@ def main():
                 default=session.PLC_CONFIG,
                 help="path to file containing plc login information.")
 
+    parser.add_option("", "--metrics-json", metavar="file",
+                dest="metricsjson",
+                default=None,
+                help="save the measurements of every PLC API call as JSON.")
+    parser.add_option("", "--metrics-textfile", metavar="file",
+                dest="metricstextfile",
+                default=None,
+                help=("save the measurements of every PLC API call for the "+
+                      "Prometheus node_exporter textfile collector."))
+
+    parser.add_option("", "--workers", metavar="N", dest="workers",
+                type="int",
+                default=1,
+                help=("the number of concurrent PLC API connections. Sites, "+
+                      "and nodes within a site or slice, are synced "+
+                      "concurrently using up to N workers."))
+
+    parser.add_option("", "--reconcile", dest="reconcile",
+                action="store_true",
+                default=False,
+                help=("[syncsite] read all PLC state for the selected sites "+
+                      "up front and only apply the differences."))
+    parser.add_option("", "--plan", metavar="file", dest="plan",
+                default=None,
+                help=("[syncsite/syncslice] save the changes needed to sync "+
+                      "the selected sites, nodes and slice attributes to "+
+                      "file, without applying them. Users, boot images, "+
+                      "slice whitelists, and new slices are not supported. "+
+                      "Slices, nodes, and nodegroups not found in PLC are "+
+                      "skipped by the slice attributes."))
+    parser.add_option("", "--apply", metavar="file", dest="apply",
+                default=None,
+                help=("apply the changes saved by --plan to file, without "+
+                      "reading PLC state again."))
+
     parser.add_option("", "--on", metavar="hostname", dest="ondest", 
                 default=None,
                 help="only act on the given hostname (or sitename)")
@@ -207,57 +276,122 @@ def main():
         parser.print_help()
         sys.exit(1)
 
-    # NOTE: if allsteps is given, set all steps to True
+    # NOTE: a plan only includes sites, nodes, and slice attributes.
+    if options.plan is not None:
+        unplanned = [flag for flag, value in [
+            ("--addusers", options.addusers),
+            ("--createusers", options.createusers),
+            ("--addwhitelist", options.addwhitelist),
+            ("--createslice", options.createslice),
+            ("--getbootimages", options.getbootimages)] if value]
+        if unplanned:
+            print "ERROR: --plan does not support %s" % ", ".join(unplanned)
+            sys.exit(1)
+
+    # NOTE: if allsteps is given, set all steps to True. A plan includes all
+    # steps, except the users and whitelists that a plan does not support.
     if options.allsteps:
-        options.addwhitelist=True
+        options.addwhitelist=options.plan is None
         options.addsliceips=True
         options.addinterfaces=True
         options.addnodes=True
-        options.addusers=True
+        options.addusers=options.plan is None
 
     site_list =  getattr(__import__(options.sitesname), options.sitelist)
     slice_list =  getattr(__import__(options.slicesname), options.slicelist)
 
     print "setup plc session"
     session.setup_global_session(options.url, options.debug, options.verbose,
-                                 options.plcconfig)
+                                 options.plcconfig, options.workers)
 
     # always setup the configuration for everything (very fast)
     print "loading slice & site configuration"
     for sslice in slice_list:
         for site in site_list:
-            for host in site['nodes']:
-                h = site['nodes'][host]
-                sslice.add_node_address(h)
+            for node in site.sorted_nodes():
+                sslice.add_node_address(node)
+
+    if options.addusers:
+        # NOTE: resolve all declared users with a single GetPersons call.
+        users = [user for site in site_list for user in site['users']]
+        for sslice in slice_list:
+            users += sslice['users'] or []
+        sync.GetPersonIds([email for _, _, email in users])
 
     # begin processing arguments to apply filters, etc
-    if options.syncsite is not None and options.syncslice is None:
+    if options.apply is not None:
+        print "apply plan", options.apply
+        session.api.metrics.set_phase("apply")
+        reconcile.ApplyStages(reconcile.ReadPlan(options.apply),
+                              options.workers)
+
+    elif options.plan is not None and (options.syncsite is not None or
+                                       options.syncslice is not None):
+        print "plan", options.plan
+        session.api.metrics.set_phase("plan")
+        stages = []
+        if options.syncsite is not None:
+            sites = [site for site in site_list
+                     if options.syncsite in ["all", site['name']]]
+            stages += reconcile.PlanSites(sites, options.ondest,
+                                          options.addnodes,
+                                          options.addinterfaces)
+        slices = [sslice for sslice in slice_list
+                  if options.syncslice in ["all", sslice['name']]]
+        stages += reconcile.PlanSlices(slices, options.ondest,
+                                       options.addsliceips)
+        reconcile.WritePlan(options.plan, stages)
+        print "Saved %d changes to %s" % (
+            sum(len(group) for stage in stages for group in stage),
+            options.plan)
+
+    elif (options.syncsite is not None and options.syncslice is None and
+        options.reconcile):
+        print "reconcile sites"
+        session.api.metrics.set_phase("reconcile")
+        sites = [site for site in site_list
+                 if options.syncsite in ["all", site['name']]]
+        reconcile.ReconcileSites(sites, options.ondest, options.addusers,
+                                 options.addnodes, options.addinterfaces,
+                                 options.getbootimages, options.createusers,
+                                 options.nodekeykeep, options.workers)
+
+    elif options.syncsite is not None and options.syncslice is None:
         print "sync site"
-        for site in site_list: 
-            # sync everything when syncsite is None, 
-            # or only when it matches
-            if (options.syncsite == "all" or 
-                options.syncsite == site['name']):
-                print "Syncing: site", site['name']
-                sync.SyncSite(site, options.ondest, options.addusers,
-                              options.addnodes, options.addinterfaces,
-                              options.getbootimages, options.createusers,
-                              options.nodekeykeep)
+        session.api.metrics.set_phase("syncsite")
+        def sync_site(site):
+            print "Syncing: site", site['name']
+            sync.SyncSite(site, options.ondest, options.addusers,
+                          options.addnodes, options.addinterfaces,
+                          options.getbootimages, options.createusers,
+                          options.nodekeykeep, options.workers)
+        # sync everything when syncsite is "all", or only when it matches
+        sites = [site for site in site_list
+                 if options.syncsite in ["all", site['name']]]
+        parallel.run(sync_site, sites, options.workers)
 
     elif options.syncslice is not None and options.syncsite is None:
         print options.syncslice
+        session.api.metrics.set_phase("syncslice")
         for sslice in slice_list: 
             if (options.syncslice == "all" or 
                 options.syncslice == sslice['name']):
                 print "Syncing: slice", sslice['name']
                 sync.SyncSlice(sslice, options.ondest, options.addwhitelist,
                                options.addsliceips, options.addusers,
-                               options.createslice)
+                               options.createslice, options.workers)
 
     else:
         print usage()
         sys.exit(1)
 
+    print "PLC API", session.api.cache.summary()
+    print session.api.metrics.summary()
+    if options.metricsjson:
+        session.api.metrics.write_json(options.metricsjson)
+    if options.metricstextfile:
+        session.api.metrics.write_textfile(options.metricstextfile)
+
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""Benchmarks plsync.py against an in-memory stand-in for PLC.
+
+syncbenchmark starts a planetlab.plcserver seeded with the persons, tag types
+and nodegroups of the site and slice configurations, and runs every phase of
+plsync.py against it:
+    syncsite: plsync.py --syncsite=all --allsteps
+    syncslice: plsync.py --syncslice=all --allsteps --createslice
+
+The phases run --passes times. The first pass creates every object; later
+passes find every object in sync, which is the common case for a real run.
+
+For every phase, the report includes:
+    wall: seconds for plsync.py to run, including its start up.
+    requests: the number of XML-RPC requests, i.e. round trips to PLC.
+    calls: the number of API calls, including calls in system.multicall.
+    bytes in/out: the size of the XML-RPC request and response bodies.
+
+Examples:
+    ./syncbenchmark.py
+    ./syncbenchmark.py --latency=0.1 --workers=8 --methods
+    ./syncbenchmark.py --serve --port=8000
+      (serves the seeded stand-in until interrupted, at
+       http://localhost:8000/PLCAPI/)
+"""
+
+import json
+import logging
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from planetlab import plcserver
+
+PHASES = [
+    ('syncsite', ['--syncsite', 'all', '--allsteps']),
+    ('syncslice', ['--syncslice', 'all', '--allsteps', '--createslice']),
+]
+NODEGROUP_TAGNAME = 'deployment'
+
+
+def seed(api, site_list, slice_list):
+    """Adds the objects that plsync.py expects to exist in PLC to api.
+
+    plsync.py creates sites, nodes and slices, but not the persons, tag types
+    and nodegroups it refers to.
+
+    Args:
+        api: plcserver.PLCAPI, the stand-in to seed.
+        site_list: list of model.Site, the sites to sync.
+        slice_list: list of model.Slice, the slices to sync.
+    """
+    users = []
+    nodegroups = []
+    for site in site_list:
+        users.extend(site['users'])
+        nodegroups.extend(node['nodegroup'] for node in site['nodes'].values())
+    tagnames = []
+    for sslice in slice_list:
+        users.extend(sslice['users'] or [])
+        for attr in sslice['attrs']:
+            if attr['attrtype'] == 'nodegroup':
+                nodegroups.append(attr['nodegroup'])
+            tagnames.extend(k for k in attr.keys()
+                            if k not in ['attrtype', attr['attrtype']])
+
+    for first_name, last_name, email in users:
+        if not api.GetPersons({'email': email}):
+            api.AddPerson({'first_name': first_name, 'last_name': last_name,
+                           'email': email, 'enabled': True})
+    for tagname in tagnames:
+        if not api.GetTagTypes(tagname):
+            api.AddTagType({'tagname': tagname, 'category': 'slice/config'})
+    for nodegroup in nodegroups:
+        if not api.GetNodeGroups(nodegroup):
+            api.AddNodeGroup(nodegroup, NODEGROUP_TAGNAME, nodegroup)
+
+
+def start_server(api, port, latency):
+    """Starts a plcserver.Server for api in a daemon thread and returns it."""
+    server = plcserver.Server(('localhost', port), api, latency)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def write_session(home, url, session):
+    """Saves session for url in the plsync session file under home."""
+    os.makedirs(os.path.join(home, '.ssh'))
+    with open(os.path.join(home, '.ssh', 'mlab_session'), 'w') as sessions:
+        sessions.write('%s %s\n' % (url, session))
+
+
+def run_phase(server, home, args, output):
+    """Runs plsync.py with args against server and returns its measurements.
+
+    Args:
+        server: plcserver.Server, the stand-in for PLC.
+        home: str, the home directory with the plsync session file.
+        args: list of str, the plsync.py arguments.
+        output: file, receives the output of plsync.py.
+
+    Returns:
+        dict, with 'wall' seconds, and the counts of every method.
+
+    Raises:
+        Exception, plsync.py failed.
+    """
+    env = dict(os.environ, HOME=home)
+    command = [sys.executable, 'plsync.py', '--url', server.url()] + args
+    server.api.stats.snapshot(reset=True)
+    start = time.time()
+    status = subprocess.call(command, stdout=output, stderr=output, env=env,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    wall = time.time() - start
+    if status != 0:
+        raise Exception('%s exited with status %s' % (' '.join(args), status))
+    return {'wall': wall, 'methods': server.api.stats.snapshot(reset=True)}
+
+
+def run_benchmarks(server, home, passes, options, output):
+    """Runs every phase of PHASES, passes times.
+
+    Args:
+        server: plcserver.Server, the seeded stand-in for PLC.
+        home: str, the home directory with the plsync session file.
+        passes: int, the number of times to run every phase.
+        options: list of str, plsync.py arguments added to every phase.
+        output: file, receives the output of plsync.py.
+
+    Returns:
+        list of (str, dict), the measurements by '<phase>/<pass>', in order.
+    """
+    results = []
+    for i in range(1, passes + 1):
+        for phase, args in PHASES:
+            key = '%s/%d' % (phase, i)
+            results.append((key, run_phase(server, home, args + options,
+                                           output)))
+            logging.info('%s: %.3fs', key, results[-1][1]['wall'])
+    return results
+
+
+def totals(methods):
+    """Returns the sum of the counts of every method."""
+    total = {'calls': 0, 'requests': 0, 'bytes_in': 0, 'bytes_out': 0}
+    for counts in methods.values():
+        for field in total:
+            total[field] += counts[field]
+    return total
+
+
+def format_report(results, methods=False):
+    """Returns the results as a table, optionally with every method."""
+    row = '%-30s %10s %10s %10s %12s %12s'
+    lines = [row % ('phase', 'wall', 'requests', 'calls', 'bytes in',
+                    'bytes out')]
+    for key, result in results:
+        total = totals(result['methods'])
+        lines.append(row % (key, '%.3fs' % result['wall'], total['requests'],
+                            total['calls'], total['bytes_in'],
+                            total['bytes_out']))
+        if not methods:
+            continue
+        for name in sorted(result['methods'],
+                           key=lambda m: (-result['methods'][m]['calls'], m)):
+            counts = result['methods'][name]
+            lines.append(row % ('  ' + name, '', counts['requests'],
+                                counts['calls'], counts['bytes_in'],
+                                counts['bytes_out']))
+    return '\n'.join(lines) + '\n'
+
+
+def parse_flags():
+    """Parses and returns the command line options."""
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option(
+        '',
+        '--latency',
+        dest='latency',
+        type='float',
+        default=0.0,
+        help='Seconds to delay every request to the stand-in.')
+    parser.add_option(
+        '',
+        '--workers',
+        dest='workers',
+        type='int',
+        default=1,
+        help='The plsync.py --workers value.')
+    parser.add_option(
+        '',
+        '--passes',
+        dest='passes',
+        type='int',
+        default=2,
+        help='The number of times to run every phase.')
+    parser.add_option(
+        '',
+        '--sitesname',
+        dest='sitesname',
+        default='sites',
+        help='The name of the module with Site() definitions.')
+    parser.add_option(
+        '',
+        '--slicesname',
+        dest='slicesname',
+        default='slices',
+        help='The name of the module with Slice() definitions.')
+    parser.add_option(
+        '',
+        '--methods',
+        dest='methods',
+        action='store_true',
+        default=False,
+        help='Report the counts of every method.')
+    parser.add_option(
+        '',
+        '--plsync_output',
+        dest='plsync_output',
+        default=os.devnull,
+        help='Save the output of plsync.py to this file.')
+    parser.add_option(
+        '',
+        '--save',
+        dest='save',
+        default=None,
+        help='Save the results as JSON to this file.')
+    parser.add_option(
+        '',
+        '--serve',
+        dest='serve',
+        action='store_true',
+        default=False,
+        help='Only serve the seeded stand-in, until interrupted.')
+    parser.add_option(
+        '',
+        '--port',
+        dest='port',
+        type='int',
+        default=0,
+        help='The port of the stand-in; 0 picks an unused port.')
+    return parser.parse_args()
+
+
+def main():
+    (options, _) = parse_flags()
+    logging.basicConfig(level=logging.INFO)
+
+    site_list = getattr(__import__(options.sitesname), 'site_list')
+    slice_list = getattr(__import__(options.slicesname), 'slice_list')
+    api = plcserver.PLCAPI()
+    seed(api, site_list, slice_list)
+    server = start_server(api, options.port, options.latency)
+
+    if options.serve:
+        logging.info('Serving %s', server.url())
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            return
+
+    plsync_options = ['--workers', str(options.workers),
+                      '--sitesname', options.sitesname,
+                      '--slicesname', options.slicesname]
+    home = tempfile.mkdtemp()
+    try:
+        write_session(home, server.url(), api.new_session())
+        with open(options.plsync_output, 'w') as output:
+            results = run_benchmarks(server, home, options.passes,
+                                     plsync_options, output)
+    finally:
+        shutil.rmtree(home)
+    sys.stdout.write(format_report(results, options.methods))
+
+    if options.save:
+        with open(options.save, 'w') as save:
+            json.dump(dict(results), save, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
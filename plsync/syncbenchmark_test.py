@@ -0,0 +1,65 @@
+"""Tests for syncbenchmark."""
+
+import os
+import shutil
+import syncbenchmark
+import tempfile
+import unittest
+
+from planetlab import model
+from planetlab import plcserver
+
+
+class SyncBenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.users = [('User', 'Name', 'username@gmail.com')]
+        self.sites = [model.makesite(
+            'abc01', '192.168.1.0', '2400:1002:4008::', 'Some City', 'US',
+            36.850000, 74.783000, self.users,
+            nodegroup='MeasurementLabCentos')]
+        self.slices = [model.Slice(
+            name='abc_bar', index=1, users=self.users,
+            attrs=[model.Attr('MeasurementLabK32', disk_max='60000000'),
+                   model.Attr(None, vsys='slice_restart')])]
+
+    def test_seed(self):
+        api = plcserver.PLCAPI()
+
+        syncbenchmark.seed(api, self.sites, self.slices)
+        syncbenchmark.seed(api, self.sites, self.slices)
+
+        self.assertEqual(len(api.GetPersons({'enabled': True})), 1)
+        self.assertEqual(len(api.GetTagTypes('disk_max')), 1)
+        self.assertEqual(
+            [ng['groupname'] for ng in api.GetNodeGroups(None)],
+            ['MeasurementLabCentos', 'MeasurementLabK32'])
+
+    def test_write_session(self):
+        home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, home)
+
+        syncbenchmark.write_session(home, 'http://localhost:1/PLCAPI/', 'abc')
+
+        with open(os.path.join(home, '.ssh', 'mlab_session')) as sessions:
+            self.assertEqual(sessions.read(),
+                             'http://localhost:1/PLCAPI/ abc\n')
+
+    def test_format_report(self):
+        results = [('syncsite/1', {'wall': 1.5, 'methods': {
+            'GetNodes': {'calls': 3, 'requests': 1, 'bytes_in': 10,
+                         'bytes_out': 20},
+            'system.multicall': {'calls': 0, 'requests': 1, 'bytes_in': 30,
+                                 'bytes_out': 40}}})]
+
+        report = syncbenchmark.format_report(results, methods=True)
+
+        lines = report.splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[1].split(),
+                         ['syncsite/1', '1.500s', '2', '3', '40', '60'])
+        self.assertEqual(lines[2].split(), ['GetNodes', '1', '3', '10', '20'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -39,12 +39,20 @@ def usage():
             status=255   matches all nodes with an error
             status=0     matches all nodes with a success
 
+    --sitecount <N>, --adaptive, --failedfirst
+            Run at most N commands at once on the nodes of one site,
+            adjust the number of simultaneous commands to how fast
+            they finish, and run the nodes that failed in the previous
+            run of the same script (or --outdir) first.
+
     Examples:
 
         ./fetch.py --script procs
         ./fetch.py --script procs --rerun status=255 --list
         ./fetch.py --script procs --rerun status=255
         ./fetch.py --command "ps ax" --nodelist list.txt
+        ./fetch.py --script procs --threadcount 100 --sitecount 2 \\
+                   --adaptive --failedfirst
 """
 
 def csv_to_hash(r):
@@ -92,9 +100,11 @@ def build_vx_args_external(shell_cmd):
     args = shell_cmd.split()
     return args
 
-def vx_start_external(nodelist,outdir,cmd, timeout=0, threadcount=20):
+def vx_start_external(nodelist,outdir,cmd, timeout=0, threadcount=20,
+                      **schedule):
     args = build_vx_args_external(cmd)
-    vxargs.start(None, threadcount, nodelist, outdir, False, args, timeout)
+    vxargs.start(None, threadcount, nodelist, outdir, False, args, timeout,
+                 **schedule)
 
 def build_vx_args(shell_cmd, user):
     ssh_options="-q -o UserKnownHostsFile=junkssh -o StrictHostKeyChecking=no"
@@ -103,9 +113,11 @@ def build_vx_args(shell_cmd, user):
     args.append(shell_cmd)
     return args
 
-def vx_start(nodelist, outdir, cmd, user, timeout=0, threadcount=20):
+def vx_start(nodelist, outdir, cmd, user, timeout=0, threadcount=20,
+             **schedule):
     args = build_vx_args(cmd, user)
-    vxargs.start(None, threadcount, nodelist, outdir, False, args, timeout)
+    vxargs.start(None, threadcount, nodelist, outdir, False, args, timeout,
+                 **schedule)
 
 
 def update_latest_symlink(outdir, latest_symlink):
@@ -130,6 +142,9 @@ if __name__ == "__main__":
                         timeout=120,
                         simple=False,
                         threadcount=20,
+                        sitecount=0,
+                        adaptive=False,
+                        failedfirst=False,
                         external=False,
                         myopsfilter=None,
                         nodelist=None,
@@ -168,6 +183,18 @@ if __name__ == "__main__":
                         help="Stop trying to execute after <timeout> seconds.")
     parser.add_option("", "--threadcount", dest="threadcount", metavar="20",
                         help="Number of simultaneous threads.")
+    parser.add_option("", "--sitecount", dest="sitecount", metavar="0",
+                        help=("Number of simultaneous threads on the nodes "+
+                              "of one site; 0 means no limit."))
+    parser.add_option("", "--adaptive", dest="adaptive", action="store_true",
+                        help=("Reduce the number of simultaneous threads "+
+                              "when commands take longer to finish, and "+
+                              "increase it up to --threadcount again when "+
+                              "they speed up."))
+    parser.add_option("", "--failedfirst", dest="failedfirst",
+                        action="store_true",
+                        help=("Run the nodes that failed or timed out in the "+
+                              "previous run first."))
     parser.add_option("", "--external", dest="external",  action="store_true",
                         help=("Run commands external to the server. The "+
                               "default is internal."))
@@ -184,6 +211,7 @@ if __name__ == "__main__":
     auto_outdir=None
     auto_script=None
     auto_script_post=None
+    previous_outdir=config.outdir
     if config.script:
         if os.path.exists(config.script):
             f = open(config.script, 'r')
@@ -195,6 +223,8 @@ if __name__ == "__main__":
         suffix = time.strftime('-%Y-%m-%dT%H:%M:%S', time.gmtime(time.time()))
         auto_outdir = 'logs/' + config.script.split('.')[0] + suffix
         latest_symlink = 'logs/' + config.script.split('.')[0] + '-latest'
+        if config.outdir is None and os.path.lexists(latest_symlink):
+            previous_outdir = os.path.realpath(latest_symlink)
         err = update_latest_symlink(auto_outdir, latest_symlink)
         if err is not None:
           sys.stderr.write('Failed to update latest symlink: %s' % err)
@@ -246,14 +276,22 @@ if __name__ == "__main__":
             print n[0]
         sys.exit(0)
 
+    failed = set()
+    if (config.failedfirst and previous_outdir is not None and
+        os.path.isdir(previous_outdir)):
+        failed = vxargs.getFailedHosts(previous_outdir)
+    schedule = {'site_max': int(config.sitecount),
+                'adaptive': config.adaptive,
+                'failed': failed}
+
     if config.external:
         vx_start_external(
             nodelist, outdir, cmd_str, int(config.timeout),
-            int(config.threadcount))
+            int(config.threadcount), **schedule)
     else:
         vx_start(
             nodelist, outdir, cmd_str, config.user, int(config.timeout),
-            int(config.threadcount))
+            int(config.threadcount), **schedule)
 
     if auto_script_post is not None and os.path.isfile(auto_script_post):
         os.system("bash %s %s" % (auto_script_post, outdir)) 
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""plccache keeps a local copy of PLC objects in a sqlite database.
+
+Reads are served from the local copy while it is younger than the cache TTL.
+After that, only the objects created or updated since the last refresh are
+fetched from PLC, using the 'date_created' and 'last_updated' fields. Because
+deleted objects cannot be found this way, every object type is fully reloaded
+once per full refresh interval.
+
+Example:
+    cache = plccache.Cache(plccache.CACHE_FILE, lambda: getapi(config))
+    nodes = cache.get('node', {'hostname': '*.measurement-lab.org'},
+                      ['hostname'])
+"""
+
+import fnmatch
+import json
+import operator
+import os
+import sqlite3
+import time
+
+SESSION_DIR=os.environ['HOME'] + "/.ssh"
+CACHE_FILE=SESSION_DIR + "/mlab_plccache.sqlite"
+CACHE_TTL=60*10 # 10 minutes
+CACHE_FULL_REFRESH=60*60*24 # 1 day
+# NOTE: PLC and local clocks differ; refresh a little earlier than needed.
+CLOCK_SKEW=60*5 # 5 minutes
+
+# For each object type: the Get* method, the id field, the name field, and
+# whether the objects have 'date_created' and 'last_updated' timestamps.
+OBJECT_TYPES = {
+    'node' : ('GetNodes', 'node_id', 'hostname', True),
+    'pcu' : ('GetPCUs', 'pcu_id', 'hostname', False),
+    'person' : ('GetPersons', 'person_id', 'email', True),
+    'site' : ('GetSites', 'site_id', 'login_base', True),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    type TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (type, id)
+);
+CREATE TABLE IF NOT EXISTS refreshes (
+    type TEXT PRIMARY KEY,
+    refreshed REAL NOT NULL,
+    full_refreshed REAL NOT NULL
+);
+"""
+
+# Filter keys may start with an operator, e.g. {'>date_created': 0}.
+# NOTE: ']' means >=, '[' means <=.
+FILTER_OPERATORS = {
+    '>': operator.gt,
+    '<': operator.lt,
+    ']': operator.ge,
+    '[': operator.le,
+}
+
+
+# NOTE: match_value(), match_field() and match_object() are also defined in
+# plsync/planetlab/plcserver.py. The tools do not import plsync, so keep the
+# two copies the same.
+def match_value(value, pattern):
+    """Returns True if value matches pattern, like PLC filters do.
+
+    Args:
+        value: the value of an object field.
+        pattern: str, int or list, strings may use '*' wildcards. A list
+            matches when any item matches.
+    Returns:
+        bool
+    """
+    if type(pattern) in [type([]), type(())]:
+        return any(match_value(value, p) for p in pattern)
+    if type(value) in [type([]), type(())]:
+        return pattern in value
+    if type(pattern) in (str, unicode) and type(value) in (str, unicode):
+        return fnmatch.fnmatchcase(value.lower(), pattern.lower())
+    return value == pattern
+
+
+def match_field(obj, key, pattern):
+    """Returns True if the field named by the filter key matches pattern.
+
+    Args:
+        obj: dict, a PLC object.
+        key: str, a field name, optionally prefixed by '~' to negate the match
+            or by one of FILTER_OPERATORS to compare the field with pattern.
+        pattern: the filter value for key.
+    Returns:
+        bool
+    """
+    if key.startswith('~'):
+        return not match_field(obj, key[1:], pattern)
+    if key[:1] in FILTER_OPERATORS:
+        value = obj.get(key[1:])
+        # NOTE: like SQL, comparisons with NULL never match.
+        return value is not None and FILTER_OPERATORS[key[:1]](value, pattern)
+    return match_value(obj.get(key), pattern)
+
+
+def match_object(obj, obj_filter, id_field, name_field):
+    """Returns True if obj matches obj_filter, like PLC Get* calls do.
+
+    Args:
+        obj: dict, a PLC object.
+        obj_filter: None, int, str, list or dict. None matches all objects.
+            An int matches the id_field, and a str matches the name_field. A
+            list matches when any item matches. A dict matches when all named
+            fields match; keys starting with '-', e.g. '-SORT', are ignored.
+        id_field: str, name of the object id field, e.g. 'node_id'.
+        name_field: str, name of the object name field, e.g. 'hostname'.
+    Returns:
+        bool
+    """
+    if obj_filter is None:
+        return True
+    if type(obj_filter) in [type([]), type(())]:
+        return any(match_object(obj, f, id_field, name_field)
+                   for f in obj_filter)
+    if type(obj_filter) == dict:
+        return all(match_field(obj, k, v) for k, v in obj_filter.items()
+                   if not k.startswith('-'))
+    if type(obj_filter) in (int, long):
+        return obj[id_field] == obj_filter
+    return name_field is not None and match_value(obj[name_field], obj_filter)
+
+
+class Cache:
+    """Cache serves PLC Get* queries from a local sqlite database.
+
+    The PLC API is only created, by calling getapi(), when objects must be
+    refreshed. So, queries on a fresh cache never contact PLC.
+    """
+    def __init__(self, filename, getapi, ttl=CACHE_TTL,
+                 full_refresh=CACHE_FULL_REFRESH):
+        """
+        Args:
+            filename: str, path to the sqlite database; created if missing.
+            getapi: callable, returns an authenticated PLC API.
+            ttl: int, seconds that cached objects are used without refresh.
+            full_refresh: int, seconds between complete reloads of objects.
+        """
+        self.getapi = getapi
+        self.api = None
+        self.ttl = ttl
+        self.full_refresh = full_refresh
+        # NOTE: the cache may contain PCU passwords; like the session file,
+        # it is only readable by the user.
+        old_umask = os.umask(077)
+        try:
+            self.db = sqlite3.connect(filename)
+        finally:
+            os.umask(old_umask)
+        self.db.executescript(SCHEMA)
+
+    def get(self, obj_type, obj_filter=None, fields=None):
+        """Returns the cached objects of obj_type that match obj_filter.
+
+        Args:
+            obj_type: str, one of OBJECT_TYPES, e.g. 'node'.
+            obj_filter: a filter accepted by match_object().
+            fields: list of str, fields to return for each object. When None,
+                all fields are returned.
+        Returns:
+            list of dict, the matching objects sorted by id.
+        """
+        (_, id_field, name_field, _) = OBJECT_TYPES[obj_type]
+        self.refresh(obj_type)
+        objects = []
+        rows = self.db.execute(
+            'SELECT data FROM objects WHERE type = ? ORDER BY id', (obj_type,))
+        for (data,) in rows:
+            obj = json.loads(data)
+            if match_object(obj, obj_filter, id_field, name_field):
+                if fields is not None:
+                    obj = dict((f, obj[f]) for f in fields if f in obj)
+                objects.append(obj)
+        return objects
+
+    def refresh(self, obj_type, now=None):
+        """Updates the cached objects of obj_type from PLC, if needed."""
+        (method, id_field, _, timestamps) = OBJECT_TYPES[obj_type]
+        if now is None:
+            now = time.time()
+        row = self.db.execute(
+            'SELECT refreshed, full_refreshed FROM refreshes WHERE type = ?',
+            (obj_type,)).fetchone()
+        (refreshed, full_refreshed) = row if row else (0, 0)
+        if now - refreshed < self.ttl:
+            return
+
+        if self.api is None:
+            self.api = self.getapi()
+        get_objects = getattr(self.api, method)
+        full = now - full_refreshed >= self.full_refresh or not timestamps
+        if full:
+            objects = get_objects(None)
+            full_refreshed = now
+        else:
+            since = int(refreshed - CLOCK_SKEW)
+            objects = (get_objects({'>date_created' : since}) +
+                       get_objects({'>last_updated' : since}))
+
+        with self.db:
+            if full:
+                self.db.execute('DELETE FROM objects WHERE type = ?',
+                                (obj_type,))
+            self.db.executemany(
+                'INSERT OR REPLACE INTO objects (type, id, data) '
+                'VALUES (?, ?, ?)',
+                [(obj_type, obj[id_field], json.dumps(obj))
+                 for obj in objects])
+            self.db.execute(
+                'INSERT OR REPLACE INTO refreshes '
+                '(type, refreshed, full_refreshed) VALUES (?, ?, ?)',
+                (obj_type, now, full_refreshed))
+
+
+class CachedAPI:
+    """CachedAPI serves Get* calls for OBJECT_TYPES from a Cache.
+
+    Only Get* calls for cached object types are supported.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.types = dict((method, obj_type) for obj_type, (method, _, _, _)
+                          in OBJECT_TYPES.items())
+
+    def __getattr__(self, name):
+        if name not in self.types:
+            raise AssertionError("%s is not supported by the cache" % name)
+        return lambda obj_filter=None, fields=None : self.cache.get(
+            self.types[name], obj_filter, fields)
@@ -0,0 +1,148 @@
+"""Tests for plccache."""
+
+import inspect
+import mock
+import os
+import plccache
+import shutil
+import tempfile
+import unittest
+
+# NOTE: a fixed time for the cache clock; a fresh cache fully loads objects.
+NOW = 1500000000
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        patcher = mock.patch.object(plccache, 'time')
+        self.clock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.clock.time.return_value = NOW
+        self.api = mock.Mock()
+        self.getapi = mock.Mock(return_value=self.api)
+        self.cache = plccache.Cache(
+            os.path.join(self.tempdir, 'plccache.sqlite'), self.getapi,
+            ttl=600, full_refresh=86400)
+        self.nodes = [
+            {'node_id': 1, 'hostname': 'mlab1.abc01.measurement-lab.org',
+             'site_id': 10, 'boot_state': 'boot'},
+            {'node_id': 2, 'hostname': 'mlab2.abc01.measurement-lab.org',
+             'site_id': 10, 'boot_state': 'boot'},
+            {'node_id': 3, 'hostname': 'mlab1.xyz02.measurement-lab.org',
+             'site_id': 11, 'boot_state': 'disabled'},
+        ]
+
+    def test_get_when_fresh_does_not_contact_plc(self):
+        self.api.GetNodes.return_value = self.nodes
+
+        first = self.cache.get('node')
+        second = self.cache.get('node', None, ['hostname'])
+
+        self.assertEqual(first, self.nodes)
+        self.assertEqual(second, [{'hostname': n['hostname']}
+                                  for n in self.nodes])
+        self.getapi.assert_called_once_with()
+        self.api.GetNodes.assert_called_once_with(None)
+
+    def test_refresh_after_ttl_merges_created_and_updated_objects(self):
+        self.api.GetNodes.return_value = self.nodes
+        self.cache.get('node')
+        created = {'node_id': 4, 'hostname': 'mlab3.abc01.measurement-lab.org',
+                   'site_id': 10, 'boot_state': 'boot'}
+        updated = dict(self.nodes[2], boot_state='boot')
+        self.api.GetNodes.side_effect = lambda node_filter: (
+            [created] if '>date_created' in node_filter else [updated])
+
+        self.clock.time.return_value = NOW + 600
+        nodes = self.cache.get('node')
+
+        since = NOW - plccache.CLOCK_SKEW
+        self.assertEqual(self.api.GetNodes.call_args_list, [
+            mock.call(None),
+            mock.call({'>date_created': since}),
+            mock.call({'>last_updated': since})])
+        self.assertEqual(nodes, self.nodes[:2] + [updated, created])
+
+    def test_refresh_after_full_refresh_interval_drops_deleted_objects(self):
+        self.api.GetNodes.return_value = self.nodes
+        self.cache.get('node')
+        self.api.GetNodes.return_value = self.nodes[1:]
+
+        self.clock.time.return_value = NOW + 86400
+        nodes = self.cache.get('node')
+
+        self.assertEqual(self.api.GetNodes.call_args_list,
+                         [mock.call(None), mock.call(None)])
+        self.assertEqual(nodes, self.nodes[1:])
+
+    def test_refresh_of_objects_without_timestamps_is_always_full(self):
+        pcus = [{'pcu_id': 5, 'hostname': 'mlab1d.abc01.measurement-lab.org'}]
+        self.api.GetPCUs.return_value = pcus
+
+        self.cache.get('pcu')
+        self.clock.time.return_value = NOW + 300
+        self.cache.get('pcu')
+        self.clock.time.return_value = NOW + 600
+        found = self.cache.get('pcu')
+
+        self.assertEqual(self.api.GetPCUs.call_args_list,
+                         [mock.call(None), mock.call(None)])
+        self.assertEqual(found, pcus)
+
+    def test_get_matches_filters_locally(self):
+        self.api.GetNodes.return_value = self.nodes
+        api = plccache.CachedAPI(self.cache)
+
+        by_pattern = api.GetNodes('MLAB1.*', ['node_id'])
+        by_list = api.GetNodes([2, 'mlab1.xyz02.measurement-lab.org'],
+                               ['node_id'])
+        by_fields = api.GetNodes({'site_id': 10, 'boot_state': 'boot'},
+                                 ['node_id'])
+
+        self.assertEqual(by_pattern, [{'node_id': 1}, {'node_id': 3}])
+        self.assertEqual(by_list, [{'node_id': 2}, {'node_id': 3}])
+        self.assertEqual(by_fields, [{'node_id': 1}, {'node_id': 2}])
+        self.api.GetNodes.assert_called_once_with(None)
+
+    def test_get_matches_filters_with_operators(self):
+        self.api.GetNodes.return_value = [
+            dict(node, last_updated=NOW + node['node_id'])
+            for node in self.nodes]
+        api = plccache.CachedAPI(self.cache)
+
+        newer = api.GetNodes({'>last_updated': NOW + 1}, ['node_id'])
+        in_range = api.GetNodes({']node_id': 2, '[node_id': 2, '-SORT': 'x'},
+                                ['node_id'])
+        not_booted = api.GetNodes({'~boot_state': 'boot'}, ['node_id'])
+        no_field = api.GetNodes({'<date_created': NOW}, ['node_id'])
+
+        self.assertEqual(newer, [{'node_id': 2}, {'node_id': 3}])
+        self.assertEqual(in_range, [{'node_id': 2}])
+        self.assertEqual(not_booted, [{'node_id': 3}])
+        self.assertEqual(no_field, [])
+
+    def test_cached_api_rejects_uncached_methods(self):
+        api = plccache.CachedAPI(self.cache)
+
+        with self.assertRaises(AssertionError):
+            api.GetSlices()
+
+
+class MatchTest(unittest.TestCase):
+
+    def test_match_functions_are_the_same_as_in_plcserver(self):
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'plsync', 'planetlab', 'plcserver.py')
+        with open(filename) as plcserver:
+            source = plcserver.read()
+
+        for func in [plccache.match_value, plccache.match_field,
+                     plccache.match_object]:
+            self.assertIn(inspect.getsource(func), source)
+
+
+if __name__ == '__main__':
+    unittest.main()
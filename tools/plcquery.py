@@ -9,6 +9,8 @@ import sys
 import re
 import ssl
 
+import plccache
+
 SESSION_DIR=os.environ['HOME'] + "/.ssh"
 SESSION_FILE=SESSION_DIR + "/query_mlab_session"
 SESSION_TIMEOUT=60*60*24*30 # 30 days
@@ -157,6 +159,8 @@ def parse_options():
                         byrole=None,
                         verbose=False, 
                         debug=False, 
+                        cached=False,
+                        cache_ttl=plccache.CACHE_TTL,
                         )
 
     parser.add_option("-v", "--verbose", dest="verbose", action="store_true", 
@@ -169,6 +173,15 @@ def parse_options():
                         metavar="[get|update|delete|add]", 
                         help="Set the action type for query")
 
+    parser.add_option("", "--cached", dest="cached", action="store_true",
+                        help=("For action=get: answer from a local cache of "+
+                              "PLC objects in %s. " % plccache.CACHE_FILE +
+                              "Changed objects are fetched from PLC once "+
+                              "the cache is older than --cache_ttl."))
+
+    parser.add_option("", "--cache_ttl", dest="cache_ttl", type="int",
+                        help="Seconds that --cached results are used as is.")
+
     parser.add_option("", "--session_timeout", dest="session_timeout",
                         type="int", help="Set the session timeout in seconds")
 
@@ -334,7 +347,13 @@ def handle_get(api, config, filtr, fields):
 
 def main():
     (config, args) = parse_options()
-    api = getapi(config)
+    if config.action == "get" and config.cached:
+        # NOTE: PLC is only contacted when the cache needs a refresh.
+        cache = plccache.Cache(plccache.CACHE_FILE, lambda: getapi(config),
+                               config.cache_ttl)
+        api = plccache.CachedAPI(cache)
+    else:
+        api = getapi(config)
 
     if config.action == "checksession":
         sys.exit(0)
@@ -25,9 +25,17 @@ version = "0.3.1"
 import os, sys, time, signal, errno
 import curses, random
 import getopt
+from glob import glob
 
 update_rate = 1
 
+# adaptive scheduling: weight of the latest completion latency in the average,
+# and how much slower than the best average counts as overloaded.
+latency_weight = 0.2
+slowdown_factor = 2.0
+# latencies below this many seconds are never considered slow.
+min_latency = 1.0
+
 final_stats = {}
 gsl = None
 stopping = 0
@@ -47,6 +55,34 @@ def getListFromFile(f):
             hostlist[-1][1] = line.strip()[1:]
     return hostlist
 
+def getFailedHosts(outdir):
+    """Reads the results of a previous run in outdir.
+
+    @param outdir: the output directory of a previous run
+    @return: a set of the names with a non-zero exit status, or killed
+    """
+    failed = set()
+    try:
+        failed.update(open(os.path.join(outdir, 'killed_list')).read().split())
+    except IOError:
+        pass
+    for fn in glob(os.path.join(outdir, '*.status')):
+        try:
+            if int(open(fn).read().strip()) != 0:
+                failed.add(os.path.basename(fn)[:-len('.status')])
+        except (IOError, ValueError):
+            pass
+    return failed
+
+def getSite(name):
+    """The site of a hostname like mlab1.abc01.measurement-lab.org is abc01.
+    Names with fewer than three labels, like IPs, are their own site.
+    """
+    labels = name.split('.')
+    if len(labels) < 3 or name.replace('.', '').isdigit():
+        return name
+    return labels[1]
+
 def get_last_line(fn):
     #equ to tail -n1 fn
     try:
@@ -136,6 +172,12 @@ class Slots:
         self.t = timeout
         self.outdir = outdir
         
+    def release(self, slot):
+        """make the slot number of a finished job available again
+        """
+        self.slots.append(slot.slotnum)
+        self.slots.sort()
+
     def getSlot(self, name, count):
         if not self.slots:
             #it's empty, wait until other jobs finish
@@ -166,6 +208,7 @@ class Slots:
             if status >>8:
                 open(os.path.join(self.outdir, 'abnormal_list'),'a').write('%s\n' % (slot.name))
         del self.pids[pid]
+        slot.status = status
         s = status >> 8
         if final_stats.has_key(s):
             final_stats[s]+= 1
@@ -199,6 +242,72 @@ class Slots:
                 v.stop(k)
         return
 
+class Scheduler:
+    """Decides which argument runs next, and how many run at once.
+
+    Arguments listed in failed run first, then the rest in list order.
+    At most max_child commands run at once, and at most site_max commands
+    (if site_max > 0) for the same site, so that one site's uplink is not
+    saturated.
+
+    With adaptive, the number of concurrent commands is adjusted to the
+    observed completion latency: it is halved when the average latency
+    grows to slowdown_factor times the best average seen, and grows by one
+    for every completion otherwise, up to max_child.
+    """
+    def __init__(self, hlist, max_child, site_max=0, adaptive=False,
+                 failed=()):
+        failed = set(failed)
+        self.pending = ([i for i in hlist if i[0] in failed] +
+                        [i for i in hlist if i[0] not in failed])
+        self.maxChild = max_child
+        self.limit = max_child
+        self.siteMax = site_max
+        self.adaptive = adaptive
+        self.active = 0
+        self.sites = {}
+        self.average = None
+        self.best = None
+        self.sinceDecrease = 0
+
+    def next(self):
+        """@return: the next argument that may start now, or None
+        """
+        if self.active >= self.limit:
+            return None
+        for n, i in enumerate(self.pending):
+            site = getSite(i[0])
+            if self.siteMax <= 0 or self.sites.get(site, 0) < self.siteMax:
+                del self.pending[n]
+                self.sites[site] = self.sites.get(site, 0) + 1
+                self.active += 1
+                return i
+        return None
+
+    def done(self, name, elapsed):
+        """record that the command for name finished after elapsed seconds
+        """
+        self.sites[getSite(name)] -= 1
+        self.active -= 1
+        if not self.adaptive:
+            return
+        if self.average is None:
+            self.average = elapsed
+        else:
+            self.average = (latency_weight * elapsed +
+                            (1 - latency_weight) * self.average)
+        if self.best is None or self.average < self.best:
+            self.best = self.average
+        self.sinceDecrease += 1
+        if self.average > slowdown_factor * max(self.best, min_latency):
+            # wait for a full round of completions at the new limit before
+            # deciding again.
+            if self.sinceDecrease >= self.limit:
+                self.limit = max(1, self.limit / 2)
+                self.sinceDecrease = 0
+        elif self.limit < self.maxChild:
+            self.limit += 1
+
 def handler(signum, frame_unused):
     global gsl
     if signum==signal.SIGALRM:
@@ -232,12 +341,14 @@ def spawn(cmdline, outfn, errfn, setpgrp = False):
    #father process
    return pid
 
-def start(win, max_child, hlist, outdir, randomize, command_line, timeout):
+def start(win, max_child, hlist, outdir, randomize, command_line, timeout,
+          site_max=0, adaptive=False, failed=()):
 
     total = len(hlist)
 
     if randomize:
         random.shuffle(hlist)
+    scheduler = Scheduler(hlist, max_child, site_max, adaptive, failed)
 
     signal.signal(signal.SIGALRM, handler)
     signal.signal(signal.SIGINT, handler)
@@ -248,12 +359,25 @@ def start(win, max_child, hlist, outdir, randomize, command_line, timeout):
     global stopping
     gsl = sl
     count = 0
-    for i in hlist:
+
+    def finish(slot):
+        slot.drawLine('Done', done = True) #Done
+        sl.release(slot)
+        scheduler.done(slot.name, time.time() - slot.startTime)
+
+    while stopping == 0:
+        i = scheduler.next()
+        if i is None:
+            if not sl.pids:
+                break
+            try:
+                finish(sl.waitJobs())
+            except RuntimeError:
+                print >> sys.stderr, 'Warning: lost tracking of %d jobs' % len(sl.pids)
+                return
+            continue
         slot = sl.getSlot(i[0], count)
-        if stopping>0:
-            slot.drawLine('Done', done=True)
-            break
-            
+
         count += 1
         slot.drawLine(i[1])
         x = generateCommands(command_line, i)
@@ -275,7 +399,7 @@ def start(win, max_child, hlist, outdir, randomize, command_line, timeout):
         except RuntimeError:
             print >> sys.stderr, 'Warning: lost tracking of %d jobs' % len(sl.pids)
             return
-        slot.drawLine('Done', done = True) #Done
+        finish(slot)
 
 def get_output(outdir, argument_list, out= True, err=False, status=False):
     """
@@ -320,8 +444,9 @@ def get_output(outdir, argument_list, out= True, err=False, status=False):
     return result[0], result[1], int_status
 
 def main():
-    options = 'hP:ra:o:yt:pn'
-    long_opts = ['help','max-procs=','randomize','args=','output=','noprompt','timeout=','plain', 'version','no-exec']
+    options = 'hP:ra:o:yt:pns:f'
+    long_opts = ['help','max-procs=','randomize','args=','output=','noprompt','timeout=','plain', 'version','no-exec',
+                 'max-per-site=','failed-first','adaptive']
     try:
         opts,args = getopt.getopt(sys.argv[1:], options,long_opts)
     except getopt.GetoptError:
@@ -337,6 +462,9 @@ def main():
     timeout = 0
     plain = False
     no_exec = False
+    site_max = 0
+    adaptive = False
+    failed_first = False
     if os.environ.has_key('VXARGS_OUTDIR'):
         outdir = os.environ['VXARGS_OUTDIR']
     for o,a in opts:
@@ -369,6 +497,12 @@ def main():
             plain = True
         elif o in ['-n','--no-exec']:
             no_exec = True
+        elif o in ['-s','--max-per-site']:
+            site_max = int(a)
+        elif o in ['-f','--failed-first']:
+            failed_first = True
+        elif o in ['--adaptive']:
+            adaptive = True
         else:
             print 'Unknown options'
             usage()
@@ -378,6 +512,10 @@ def main():
         usage()
         sys.exit(1)
     #now test outdir
+    failed = set()
+    if failed_first and outdir:
+        #read the results of the last run before they are wiped
+        failed = getFailedHosts(outdir)
     if outdir:
         if os.path.exists(outdir):
             if not os.path.isdir(outdir):
@@ -406,11 +544,13 @@ def main():
         sys.exit(0)
         
     if plain: # no fancy output
-        return start(None, maxchild, hlist, outdir, randomize, args, timeout)
+        return start(None, maxchild, hlist, outdir, randomize, args, timeout,
+                     site_max, adaptive, failed)
     else:
         # use fancy curses-based animation
         try:
-            curses.wrapper(start, maxchild, hlist, outdir, randomize, args, timeout)
+            curses.wrapper(start, maxchild, hlist, outdir, randomize, args, timeout,
+                           site_max, adaptive, failed)
         except curses.error:
             sys.exit(4)
     #post execution, output some stats
@@ -472,6 +612,21 @@ OPTIONS
     stop after 2 seconds, vxargs will send SIGTERM signal, and send SIGKILL
     if it still keeps running after 3 seconds.
 
+  --max-per-site=max, -s max
+    Run up to max processes at a time for the same site; the default
+    is 0, i.e. no limit. The site of a hostname is its second label,
+    e.g. abc01 for mlab1.abc01.measurement-lab.org.
+
+  --failed-first, -f
+    Run the arguments that failed or timed out in the previous run
+    with the same outdir first.
+
+  --adaptive
+    Adjust the number of processes run at a time to the time the
+    processes take to finish: halve it when processes finish twice as
+    slowly as before, and grow it again up to max-procs when they
+    speed up.
+
   --noprompt, -y
     Wipe out the outdir without confirmation.
 
@@ -0,0 +1,107 @@
+"""Tests for vxargs."""
+
+import os
+import shutil
+import tempfile
+import unittest
+import vxargs
+
+
+def hostlist(*names):
+    """Returns a vxargs argument list of names, without descriptions."""
+    return [[name, ''] for name in names]
+
+
+class VxargsTest(unittest.TestCase):
+
+    def start_all(self, scheduler):
+        """Starts arguments until the scheduler returns None."""
+        started = []
+        while True:
+            arg = scheduler.next()
+            if arg is None:
+                return started
+            started.append(arg[0])
+
+    def test_get_site(self):
+        self.assertEqual(vxargs.getSite('mlab1.abc01.measurement-lab.org'),
+                         'abc01')
+        self.assertEqual(vxargs.getSite('192.168.1.10'), '192.168.1.10')
+        self.assertEqual(vxargs.getSite('2400:1002::10'), '2400:1002::10')
+        self.assertEqual(vxargs.getSite('localhost'), 'localhost')
+
+    def test_get_failed_hosts(self):
+        outdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outdir)
+        for name, status in [('a.abc01.org', '0'), ('b.abc01.org', '1'),
+                             ('c.abc01.org', 'garbage')]:
+            with open(os.path.join(outdir, name + '.status'), 'w') as f:
+                f.write(status)
+        with open(os.path.join(outdir, 'killed_list'), 'w') as f:
+            f.write('d.abc01.org\n')
+
+        failed = vxargs.getFailedHosts(outdir)
+
+        self.assertEqual(failed, set(['b.abc01.org', 'd.abc01.org']))
+
+    def test_scheduler_runs_failed_arguments_first(self):
+        scheduler = vxargs.Scheduler(
+            hostlist('mlab1.abc01.org', 'mlab2.abc01.org', 'mlab1.xyz02.org'),
+            max_child=2, failed=['mlab1.xyz02.org'])
+
+        started = self.start_all(scheduler)
+        scheduler.done('mlab1.xyz02.org', 1.0)
+
+        self.assertEqual(started, ['mlab1.xyz02.org', 'mlab1.abc01.org'])
+        self.assertEqual(self.start_all(scheduler), ['mlab2.abc01.org'])
+
+    def test_scheduler_limits_commands_per_site(self):
+        scheduler = vxargs.Scheduler(
+            hostlist('mlab1.abc01.org', 'mlab2.abc01.org', 'mlab1.xyz02.org',
+                     '192.168.1.10', '192.168.1.11'),
+            max_child=10, site_max=1)
+
+        started = self.start_all(scheduler)
+        scheduler.done('mlab1.abc01.org', 1.0)
+
+        self.assertEqual(started, ['mlab1.abc01.org', 'mlab1.xyz02.org',
+                                   '192.168.1.10', '192.168.1.11'])
+        self.assertEqual(self.start_all(scheduler), ['mlab2.abc01.org'])
+
+    def test_scheduler_without_adaptive_keeps_limit(self):
+        scheduler = vxargs.Scheduler(
+            hostlist(*['mlab1.abc%02d.org' % i for i in range(4)]),
+            max_child=2)
+
+        started = self.start_all(scheduler)
+        scheduler.done(started[0], 100.0)
+
+        self.assertEqual(len(started), 2)
+        self.assertEqual(scheduler.limit, 2)
+        self.assertEqual(len(self.start_all(scheduler)), 1)
+
+    def test_scheduler_adaptive_halves_when_slow_and_grows_when_fast(self):
+        scheduler = vxargs.Scheduler(
+            hostlist(*['mlab1.abc%02d.org' % i for i in range(40)]),
+            max_child=8, adaptive=True)
+        for name in self.start_all(scheduler):
+            scheduler.done(name, 1.0)
+        self.assertEqual(scheduler.limit, 8)
+
+        started = self.start_all(scheduler)
+        scheduler.done(started[0], 10.0)
+        halved = scheduler.limit
+        blocked = scheduler.next()
+        limits = []
+        for name in started[1:]:
+            scheduler.done(name, 0.1)
+            limits.append(scheduler.limit)
+
+        self.assertEqual(len(started), 8)
+        self.assertEqual(halved, 4)
+        self.assertIsNone(blocked)
+        self.assertEqual(limits, [4, 5, 6, 7, 8, 8, 8])
+
+
+if __name__ == '__main__':
+    unittest.main()